@@ -0,0 +1,98 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+import math
+from threading import Lock
+from time import monotonic
+
+# defining constants
+EMERGENCY_PRIORITY = 0 # immediate sleep and reset; always admitted, run first
+COMMAND_PRIORITY = 1 # everything that changes the timers, the volume or the schedule
+READ_PRIORITY = 2 # status and schedule reads; shed first
+PRIORITY_NAMES = ['emergency', 'command', 'read']
+SHED_RETRY_AFTER = 1 # seconds a client whose command was shed is asked to wait
+MAX_TRACKED_CLIENTS = 4096 # token buckets kept; full (idle) buckets are dropped beyond this
+
+# the priority a sleep server command is queued with in the command bus
+def commandPriority(command):
+    if command.get('set') == 'immediateSleep' or command.get('unset') == 'timer':
+        return EMERGENCY_PRIORITY
+    if 'get' in command:
+        return READ_PRIORITY
+    return COMMAND_PRIORITY
+
+# queue depth at which commands of each priority are shed: reads at the configured depth, other commands at twice
+# the depth, emergency commands never. No depth (None or 0) disables shedding
+def depthLimits(maxDepth):
+    if not maxDepth:
+        return [None, None, None]
+    return [None, 2 * maxDepth, maxDepth]
+
+
+class CommandQueueFull(Exception):
+    """
+    Raised by the command bus when it sheds a command; the network manager answers it with HTTP 503 and Retry-After.
+    """
+
+    def __init__(self, priority, retryAfter = SHED_RETRY_AFTER):
+        Exception.__init__(self, 'command queue full, ' + PRIORITY_NAMES[priority] + ' command shed')
+        # define members:
+        self.priority = priority
+        self.retryAfter = retryAfter
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        # define members:
+        self.rate = rate # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = now
+
+    # takes a token; returns 0 if there was one, otherwise the seconds until there is
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def isFull(self, now):
+        return self.tokens + (now - self.updatedAt) * self.rate >= self.burst
+
+
+class ClientRateLimiter:
+    """
+    One token bucket per client address: a client may send burst requests at once and rate requests per second
+    after that. Shared by the request threads; taking a token is a dictionary lookup and a few float operations under
+    a lock.
+    """
+
+    def __init__(self, rate, burst, clock = None):
+        # define members:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.lock = Lock()
+        self.buckets = {} # client address -> TokenBucket
+
+    # returns 0 if the client may send the request, otherwise the seconds until it may
+    def admit(self, clientAddress):
+        now = self.clock.monotonic() if self.clock is not None else monotonic()
+        with self.lock:
+            bucket = self.buckets.get(clientAddress)
+            if bucket is None:
+                if len(self.buckets) >= MAX_TRACKED_CLIENTS:
+                    self.dropIdleBuckets(now)
+                bucket = self.buckets[clientAddress] = TokenBucket(self.rate, self.burst, now)
+            return bucket.take(now)
+
+    # a full bucket is the same as a new one
+    def dropIdleBuckets(self, now):
+        self.buckets = {address: bucket for address, bucket in self.buckets.items() if not bucket.isFull(now)}
+
+
+# a Retry-After header value: whole seconds, at least 1
+def retryAfterHeader(seconds):
+    return str(max(1, int(math.ceil(seconds))))
@@ -0,0 +1,258 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from functools import lru_cache
+from time import perf_counter
+from urllib.parse import parse_qsl, unquote
+import sys
+
+# defining constants
+API_PREFIX = 'sleepApi'
+API_VERSIONS = ['1.0'] # sleepApi/[version]/[task]; requests without a version get the current one
+JSONP_CALLBACK_PARAMETER = 'callback'
+REST_TYPE = 'rest' # parameter type of the remaining path
+MATCH_CACHE_SIZE = 1024 # recently requested paths; polling clients repeat the same few paths
+
+# path parameter types; a converter returns the parsed value or None if the segment isn't valid
+def positiveInt(segment):
+    try:
+        value = int(segment)
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+def nonNegativeInt(segment):
+    try:
+        value = int(segment)
+    except ValueError:
+        return None
+    return value if value >= 0 else None
+
+def nonNegativeFloat(segment):
+    try:
+        value = float(segment)
+    except ValueError:
+        return None
+    return value if value >= 0 else None
+
+def anyText(segment):
+    return segment
+
+PARAMETER_TYPES = {
+    'positiveInt': positiveInt,
+    'nonNegativeInt': nonNegativeInt,
+    'nonNegativeFloat': nonNegativeFloat,
+    'text': anyText,
+}
+
+# parameters is None if the route matched but one of its parameters didn't parse; matches are cached and shared,
+# so the parameters must not be modified
+RouteMatch = namedtuple('RouteMatch', ['route', 'parameters', 'jsonpCallback'])
+# what a route handler gets: the parsed parameters, the JSONP callback, the If-None-Match header, the method, the body
+# and the Authorization header
+ApiRequest = namedtuple('ApiRequest', ['parameters', 'jsonpCallback', 'ifNoneMatch', 'method', 'body', 'authorization'], defaults = (None,))
+
+class Route:
+    """
+    One compiled entry of the route table, e.g. 'setSilenceTime/{time:positiveInt}'.
+    Options are named parameters that may follow the pattern as .../[name]/[value] pairs in any order or be passed
+    in the query string. A last parameter of the type 'rest' (e.g. 'fleet/{path:rest}') takes the remaining path
+    instead; its query parameters are passed on as 'query'.
+    Emergency routes (immediate sleep and reset) are rate limited with buckets of their own, so a client over its
+    request rate can still stop a timer, and a client retrying them in a loop can't flood the control thread.
+    """
+
+    def __init__(self, pattern, handler, parameterTypes, name = None, options = None, errorMessage = None, streamHandler = None,
+                 methods = ('GET',), emergency = False):
+        # define members:
+        self.pattern = pattern
+        self.handler = handler
+        self.methods = methods
+        self.emergency = emergency
+        self.streamHandler = streamHandler
+        self.errorMessage = errorMessage or 'bad parameters'
+        self.segments = [] # (literal, None) or (parameter name, converter)
+        self.options = {} # option name -> converter
+        self.literalCount = 0
+        self.restParameter = None
+
+        for segment in pattern.split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                parameterName, parameterType = segment[1:-1].split(':')
+                if parameterType == REST_TYPE:
+                    self.restParameter = parameterName
+                    break
+                self.segments.append((parameterName, parameterTypes[parameterType]))
+            else:
+                self.segments.append((segment, None))
+                self.literalCount += 1
+        for optionName, optionType in (options or {}).items():
+            self.options[optionName] = parameterTypes[optionType]
+
+        self.name = name or self.segments[0][0]
+
+    # whether the path belongs to this route at all; its parameters may still be invalid
+    def claims(self, segments):
+        if len(segments) < len(self.segments) + (1 if self.restParameter else 0):
+            return False
+        for segment, (literal, converter) in zip(segments, self.segments):
+            if converter is None and segment != literal:
+                return False
+        return True
+
+    # the parameters parsed from the path or None
+    def parsePathParameters(self, segments):
+        parameters = {}
+        for segment, (parameterName, converter) in zip(segments, self.segments):
+            if converter is not None:
+                value = converter(segment)
+                if value is None:
+                    return None
+                parameters[parameterName] = value
+
+        if self.restParameter is not None:
+            parameters[self.restParameter] = '/'.join(segments[len(self.segments):])
+            parameters['query'] = {}
+            return parameters
+
+        # remaining segments are option pairs
+        optionSegments = segments[len(self.segments):]
+        if len(optionSegments) % 2 != 0:
+            return None
+        for optionName, value in zip(optionSegments[0::2], optionSegments[1::2]):
+            if not self.parseOption(parameters, optionName, value):
+                return None
+        return parameters
+
+    # the path parameters with the query added or None; query options fill in what the path doesn't set, unknown
+    # query parameters (like cache busters) are ignored. The path parameters are shared and stay unchanged
+    def addQueryParameters(self, pathParameters, query):
+        if pathParameters is None:
+            return None
+        if self.restParameter is not None:
+            return dict(pathParameters, query = query)
+
+        parameters = pathParameters
+        for optionName, value in query.items():
+            if optionName in self.options and optionName not in pathParameters:
+                if parameters is pathParameters:
+                    parameters = dict(pathParameters)
+                if not self.parseOption(parameters, optionName, value):
+                    return None
+        return parameters
+
+    def parseOption(self, parameters, optionName, value):
+        converter = self.options.get(optionName)
+        if converter is None:
+            return False
+        value = converter(value)
+        if value is None:
+            return False
+        parameters[optionName] = value
+        return True
+
+
+class ApiRouter:
+    """
+    Table of the sleepApi routes, dispatched by the task segment that follows 'sleepApi' (and the optional API
+    version). Each task has a short list of routes, so a lookup costs one dictionary access however many routes exist.
+    """
+
+    def __init__(self, parameterTypes = None):
+        # define members:
+        self.routesByTask = {} # task -> routes, the most specific (most literal, then most segments) first
+        self.parameterTypes = dict(PARAMETER_TYPES, **(parameterTypes or {}))
+        self.matchRoute = lru_cache(maxsize = MATCH_CACHE_SIZE)(self.findRoute)
+
+    def addRoute(self, pattern, handler, **routeOptions):
+        route = Route(pattern, handler, self.parameterTypes, **routeOptions)
+        routes = self.routesByTask.setdefault(route.segments[0][0], [])
+        routes.append(route)
+        routes.sort(key = lambda candidate: (candidate.literalCount, len(candidate.segments)), reverse = True)
+        self.matchRoute.cache_clear()
+        return route
+
+    # path -> RouteMatch or None if no route (or API version) fits. The path without its query is matched once and
+    # cached (matchRoute), the query is parsed per request, so cache busters (_=[timestamp]) don't defeat the cache.
+    # The benchmark passes findRoute to measure the uncached match
+    def match(self, path, routeMatcher = None):
+        path, separator, queryString = path.partition('?')
+        routeMatch = (routeMatcher or self.matchRoute)(path.partition('#')[0])
+        if routeMatch is None or not queryString:
+            return routeMatch
+
+        query = dict(parse_qsl(queryString.partition('#')[0]))
+        jsonpCallback = query.pop(JSONP_CALLBACK_PARAMETER, '')
+        return RouteMatch(routeMatch.route, routeMatch.route.addQueryParameters(routeMatch.parameters, query), jsonpCallback)
+
+    # path without query -> RouteMatch with the path parameters or None; use matchRoute(), which caches the result
+    def findRoute(self, path):
+        segments = splitPath(path)
+        try:
+            position = segments.index(API_PREFIX) + 1
+        except ValueError:
+            return None
+
+        if position < len(segments) and segments[position][:1].isdigit():
+            if segments[position] not in API_VERSIONS:
+                return None
+            position += 1
+        segments = segments[position:]
+        if not segments:
+            return None
+
+        routes = self.routesByTask.get(segments[0])
+        if routes is None:
+            return None
+
+        for route in routes:
+            if route.claims(segments):
+                return RouteMatch(route, route.parsePathParameters(segments), '')
+        # a known task with missing parameters
+        return RouteMatch(routes[-1], None, '')
+
+
+# path without query -> non empty, percent-decoded segments
+def splitPath(path):
+    return [unquote(segment) if '%' in segment else segment for segment in path.split('/') if segment]
+
+
+# microbenchmark of the parse-and-dispatch step: python3 apiRouter.py [iterations]
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    def handler(request):
+        return request.parameters
+
+    def routeTable(extraRoutes):
+        router = ApiRouter({'fadeCurve': anyText})
+        router.addRoute('metrics', handler)
+        router.addRoute('metrics/prometheus', handler)
+        router.addRoute('immediateSleep', handler)
+        router.addRoute('setSleepTime/{time:positiveInt}', handler)
+        for task in ['setSilenceTime', 'setGoodNightTime']:
+            router.addRoute(task + '/{time:positiveInt}', handler, options = {'curve': 'fadeCurve', 'fadeWindow': 'positiveInt'})
+        router.addRoute('setVolume/{percent:nonNegativeFloat}', handler)
+        router.addRoute('reset', handler)
+        router.addRoute('stream', handler)
+        router.addRoute('status', handler)
+        router.addRoute('status/since/{version:nonNegativeInt}', handler)
+        for number in range(extraRoutes):
+            router.addRoute('task' + str(number) + '/{value:positiveInt}', handler)
+        return router
+
+    paths = ['/sleepApi/status', '/sleepApi/1.0/setVolume/42', '/sleepApi/status/?callback=jQuery1&_=1',
+             '/sleepApi/setSilenceTime/1800/curve/logarithmic/fadeWindow/600', '/sleepApi/nothing/here']
+    for extraRoutes in [0, 1000]:
+        router = routeTable(extraRoutes)
+        print('%d routes                                                            parse    cached' %
+              sum(len(routes) for routes in router.routesByTask.values()))
+        for path in paths:
+            timings = []
+            for routeMatcher in [router.findRoute, None]:
+                startTime = perf_counter()
+                for iteration in range(iterations):
+                    router.match(path, routeMatcher)
+                timings.append((perf_counter() - startTime) / iterations * 1000000)
+            print('  %-66s %6.2f us %6.2f us' % (path, timings[0], timings[1]))
@@ -0,0 +1,163 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+# defining constants
+MAX_REQUEST_HEAD_SIZE = 8192 # bytes
+REQUEST_WORKERS = 8 # threads waiting for the sleep server's replies
+SERVER_VERSION = 'SleepServer'
+
+class AsyncioHTTPServer:
+    """
+    Minimal asyncio based HTTP server for the sleepApi GET (and POST, DELETE) requests.
+    Every connection is handled as a coroutine, so a slow or stalled client only blocks itself. The request handler
+    is a blocking callable (path, If-None-Match, method, body, client address, Authorization -> responseCode, contentType, message
+    bytes, extra headers); it runs in a small thread pool. POST bodies need a Content-Length of at most maxBodySize. Connections are persistent (HTTP/1.1 keep-alive); the read timeout closes idle ones.
+    The optional stream handler (path, client address -> None or responseCode, contentType, async generator of bytes)
+    is asked first;
+    streamed responses are delimited by closing the connection and cost no thread while they wait.
+    """
+
+    # an already bound listening socket (e.g. one of the HTTP worker processes sharing the port) replaces the port
+    def __init__(self, requestHandler, port, readTimeout, beVerbose, streamHandler = None, maxBodySize = 0, listeningSocket = None):
+        # define members:
+        self.requestHandler = requestHandler
+        self.streamHandler = streamHandler
+        self.port = port
+        self.listeningSocket = listeningSocket
+        self.readTimeout = readTimeout
+        self.maxBodySize = maxBodySize
+        self.beVerbose = beVerbose
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers = REQUEST_WORKERS)
+        self.server = None
+
+    def serveForever(self):
+        asyncio.set_event_loop(self.loop)
+        if self.listeningSocket is not None:
+            startServer = asyncio.start_server(self.handleConnection, sock = self.listeningSocket, limit = MAX_REQUEST_HEAD_SIZE)
+        else:
+            startServer = asyncio.start_server(self.handleConnection, host = None, port = self.port, limit = MAX_REQUEST_HEAD_SIZE)
+        self.server = self.loop.run_until_complete(startServer)
+        self.loop.run_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handleConnection(self, reader, writer):
+        try:
+            keepAlive = True
+            while keepAlive:
+                keepAlive = await self.handleRequest(reader, writer)
+        except ConnectionError:
+            if self.beVerbose: print('AsyncioHTTPServer: current connection failed (broken pipe)')
+        finally:
+            writer.close()
+
+    # answers one request of the connection; returns whether the connection stays open for the next one
+    async def handleRequest(self, reader, writer):
+        try:
+            requestHead = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.readTimeout)
+        except asyncio.TimeoutError:
+            if self.beVerbose: print('AsyncioHTTPServer: closing connection; client did not send a request in time')
+            return False
+        except asyncio.IncompleteReadError as error:
+            if error.partial and self.beVerbose: print('AsyncioHTTPServer: closing connection; incomplete request')
+            return False
+        except asyncio.LimitOverrunError:
+            if self.beVerbose: print('AsyncioHTTPServer: closing connection; oversized request')
+            return False
+
+        headLines = requestHead.decode('latin-1').split('\r\n')
+        requestLine = headLines[0].split()
+        if len(requestLine) != 3:
+            await self.respond(writer, 400, 'text/plain', b'bad request', {}, False)
+            return False
+        method, path, version = requestLine
+        headers = parseHeaders(headLines[1:])
+
+        # HTTP/1.1 connections are persistent unless the client asks to close; HTTP/1.0 ones only on request
+        connectionHeader = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keepAlive = connectionHeader != 'close'
+        else:
+            keepAlive = connectionHeader == 'keep-alive'
+
+        body = b''
+        if method == 'POST':
+            contentLength = headers.get('content-length', '')
+            if not contentLength.isdigit():
+                await self.respond(writer, 411, 'text/plain', b'length required', {}, False)
+                return False
+            if int(contentLength) > self.maxBodySize:
+                await self.respond(writer, 413, 'text/plain', b'request body too large', {}, False)
+                return False
+            try:
+                body = await asyncio.wait_for(reader.readexactly(int(contentLength)), self.readTimeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                if self.beVerbose: print('AsyncioHTTPServer: closing connection; incomplete request body')
+                return False
+        elif method not in ('GET', 'DELETE'):
+            await self.respond(writer, 501, 'text/plain', b'unsupported method', {}, False)
+            return False
+
+        peer = writer.get_extra_info('peername')
+        clientAddress = peer[0] if peer else None
+        stream = self.streamHandler(path, clientAddress) if self.streamHandler is not None and method == 'GET' else None
+        if stream is not None:
+            await self.respondWithStream(writer, *stream)
+            return False
+
+        responseCode, contentType, message, responseHeaders = await self.loop.run_in_executor(
+            self.executor, self.requestHandler, path, headers.get('if-none-match'), method, body, clientAddress, headers.get('authorization'))
+        await self.respond(writer, responseCode, contentType, message, responseHeaders, keepAlive)
+        return keepAlive
+
+    def responseHead(self, responseCode, contentType, contentLength = None, responseHeaders = {}, keepAlive = False):
+        head = ('HTTP/1.1 ' + str(responseCode) + ' ' + reasonPhrase(responseCode) + '\r\n' +
+                'Server: ' + SERVER_VERSION + '\r\n' +
+                'Content-type: ' + contentType + '\r\n')
+        if contentLength is None:
+            head += 'Cache-Control: no-cache\r\n'
+        else:
+            head += 'Content-Length: ' + str(contentLength) + '\r\n'
+        for name, value in responseHeaders.items():
+            head += name + ': ' + value + '\r\n'
+        head += 'Connection: keep-alive\r\n' if keepAlive else 'Connection: close\r\n'
+        return (head + '\r\n').encode('latin-1')
+
+    async def respond(self, writer, responseCode, contentType, message, responseHeaders, keepAlive):
+        writer.write(self.responseHead(responseCode, contentType, len(message), responseHeaders, keepAlive) + message)
+        await writer.drain()
+
+    async def respondWithStream(self, writer, responseCode, contentType, chunks):
+        try:
+            writer.write(self.responseHead(responseCode, contentType))
+            async for chunk in chunks:
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            if self.beVerbose: print('AsyncioHTTPServer: stream subscriber disconnected')
+        finally:
+            await chunks.aclose()
+
+
+# header names are case-insensitive; they are stored in lower case
+def parseHeaders(headerLines):
+    headers = {}
+    for line in headerLines:
+        name, separator, value = line.partition(':')
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def reasonPhrase(responseCode):
+    try:
+        return HTTPStatus(responseCode).phrase
+    except ValueError:
+        return ''
@@ -0,0 +1,451 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+# Audio backends used by SystemControl to read and write the system volume.
+# Run this file directly to compare the per call latency of the backends available on this platform; with volume
+# targets (python3 audioBackends.py 50 app:spotify sink:0 ...) it compares writing the first target with all of them.
+
+import subprocess
+import os
+import re
+import sys
+from time import monotonic, perf_counter
+
+# defining constants
+MASTER_TARGET = 'master' # the system volume; the only target of backends without supportsTargets
+SINK_TARGET = 'sink:' # sink:[name or index], e.g. sink:alsa_output.usb-headset.analog-stereo
+APP_TARGET = 'app:' # app:[application name or binary], every stream of that application, e.g. app:spotify
+PULSE_VOLUME_NORM = 65536 # PulseAudio's raw volume of 100%
+STREAM_REFRESH_INTERVAL = 10 # seconds the streams of application targets are written without listing them again
+MAX_PACMD_RESTARTS = 2 # a pacmd session that keeps dying (e.g. PipeWire without pacmd support) isn't started again
+
+# sink and application names are single words: pacmd reads its commands line by line and word by word, so a space,
+# a newline or another control character in a name would add words or whole commands of the sender's choice
+def isPlainName(name):
+    return name.isprintable() and not any(character.isspace() for character in name)
+
+# a list of volume targets ('master', 'sink:...', 'app:...') without duplicates; raises ValueError with a message
+# for the client
+def parseVolumeTargets(targets):
+    if isinstance(targets, str):
+        targets = targets.split(',')
+    if not isinstance(targets, list) or not targets:
+        raise ValueError('volume targets are a list of master, sink:[name] or app:[name]')
+    parsedTargets = []
+    for target in targets:
+        if not isinstance(target, str):
+            raise ValueError('volume targets are a list of master, sink:[name] or app:[name]')
+        target = target.strip()
+        if not isPlainName(target):
+            raise ValueError('volume targets can\'t contain spaces or control characters')
+        if target != MASTER_TARGET and not (target.startswith((SINK_TARGET, APP_TARGET)) and target.partition(':')[2].strip()):
+            raise ValueError('unknown volume target ' + target + '; use master, sink:[name] or app:[name]')
+        if target not in parsedTargets:
+            parsedTargets.append(target)
+    return parsedTargets
+
+
+class AudioBackend:
+    """
+    Interface of all audio backends. Volumes are percentages (0 - 100); clamping is done by SystemControl.
+    Forking backends end a call that takes longer than the timeout; session backends are stopped by abort().
+    Backends with supportsTargets also control single sinks and application streams: getVolumes() reads and
+    setVolumes() writes any number of them in one operation.
+    """
+
+    timeout = None # seconds a forked command may take; None waits forever
+    supportsTargets = False
+
+    # called from another thread when a call overran its deadline; makes the stuck call fail
+    def abort(self):
+        pass
+
+    def getVolume(self):
+        raise NotImplementedError
+
+    def setVolume(self, percent):
+        raise NotImplementedError
+
+    # {target: percent} of the targets that exist right now; an application that isn't playing is left out
+    def getVolumes(self, targets):
+        raise NotImplementedError
+
+    # writes {target: percent} at once
+    def setVolumes(self, volumes):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class AmixerBackend(AudioBackend):
+    # one amixer process per call
+    def getVolume(self):
+        volume = subprocess.check_output(['amixer', '-D', 'pulse', 'get', 'Master'], timeout = self.timeout)
+        volume = re.search('([0-9]+)%', str(volume))
+        volume = volume.group(1)
+        return int(volume)
+
+    def setVolume(self, percent):
+        subprocess.call(['amixer', '-D', 'pulse', 'sset', 'Master', str(percent) + '%'], timeout = self.timeout)
+
+
+class AmixerSessionBackend(AmixerBackend):
+    """
+    Keeps one `amixer -s` process alive and writes volume changes to its stdin, so ramps don't fork at all.
+    amixer doesn't answer on stdin, so reads still fork (SystemControl caches them). If the session dies it is
+    restarted once per call before falling back to the forking backend.
+    """
+
+    def __init__(self, beVerbose):
+        self.beVerbose = beVerbose
+        self.session = None
+
+    def startSession(self):
+        self.session = subprocess.Popen(['amixer', '-D', 'pulse', '-q', '-s'], stdin = subprocess.PIPE,
+                                        universal_newlines = True)
+
+    def setVolume(self, percent):
+        for attempt in range(2):
+            try:
+                if self.session is None or self.session.poll() is not None:
+                    self.startSession()
+                self.session.stdin.write('sset Master ' + str(percent) + '%\n')
+                self.session.stdin.flush()
+                return
+            except (OSError, ValueError):
+                if self.beVerbose: print('AmixerSessionBackend: amixer session failed; restarting it')
+                self.session = None
+
+        AmixerBackend.setVolume(self, percent)
+
+    def abort(self):
+        session = self.session
+        if session is not None:
+            session.kill()
+
+    def close(self):
+        if self.session is not None:
+            self.session.stdin.close()
+            self.session.wait()
+            self.session = None
+
+
+class PulseAudioBackend(AmixerBackend):
+    """
+    The amixer backend plus sinks and application streams of PulseAudio (or PipeWire's pulse server) as targets.
+    A read lists the sinks and the streams (pactl) once, however many targets there are; the streams of application
+    targets are remembered, so writes don't list them again for a while. Writes fork one pactl per sink or stream.
+    """
+
+    supportsTargets = True
+
+    def __init__(self):
+        # define members:
+        self.streams = {} # application target -> indices of its streams (sink inputs)
+        self.streamsListedAt = None
+
+    def getVolumes(self, targets):
+        volumes = {}
+        if MASTER_TARGET in targets:
+            volumes[MASTER_TARGET] = AmixerBackend.getVolume(self)
+
+        sinkTargets = [target for target in targets if target.startswith(SINK_TARGET)]
+        if sinkTargets:
+            for sink in self.listObjects('sinks'):
+                for target in sinkTargets:
+                    if target[len(SINK_TARGET):] in (sink.get('name'), sink['index']) and 'volume' in sink:
+                        volumes[target] = sink['volume']
+
+        if any(target.startswith(APP_TARGET) for target in targets):
+            for target, streamVolumes in self.listStreams(targets).items():
+                volumes[target] = max(streamVolumes)
+        return volumes
+
+    def setVolumes(self, volumes):
+        self.runVolumeCommands(self.volumeCommands(volumes))
+
+    # (command, sink or stream, raw volume) of every sink and stream of the targets, as pactl and pacmd take them
+    def volumeCommands(self, volumes):
+        targets = list(volumes)
+        if any(target.startswith(APP_TARGET) for target in targets):
+            if self.streamsListedAt is None or monotonic() - self.streamsListedAt > STREAM_REFRESH_INTERVAL:
+                self.listStreams(targets)
+
+        commands = []
+        for target, percent in volumes.items():
+            rawVolume = str(int(round(percent * PULSE_VOLUME_NORM / 100)))
+            if target == MASTER_TARGET:
+                commands.append(('set-sink-volume', '@DEFAULT_SINK@', rawVolume))
+            elif target.startswith(SINK_TARGET):
+                commands.append(('set-sink-volume', target[len(SINK_TARGET):], rawVolume))
+            else:
+                for index in self.streams.get(target, []):
+                    commands.append(('set-sink-input-volume', index, rawVolume))
+        return commands
+
+    def runVolumeCommands(self, commands):
+        for command in commands:
+            subprocess.call(['pactl'] + list(command), timeout = self.timeout)
+
+    # remembers the streams of the application targets; returns {target: [volume of every stream]}
+    def listStreams(self, targets):
+        applications = {target[len(APP_TARGET):].lower(): target for target in targets if target.startswith(APP_TARGET)}
+        streams = {}
+        streamVolumes = {}
+        for stream in self.listObjects('sink-inputs'):
+            properties = stream['properties']
+            for name in (properties.get('application.name', ''), properties.get('application.process.binary', '')):
+                target = applications.get(name.lower())
+                if target is not None and 'volume' in stream:
+                    streams.setdefault(target, []).append(stream['index'])
+                    streamVolumes.setdefault(target, []).append(stream['volume'])
+                    break
+        self.streams = streams
+        self.streamsListedAt = monotonic()
+        return streamVolumes
+
+    # 'sinks' or 'sink-inputs' -> [{'index': ..., 'name': ..., 'volume': percent, 'properties': {...}}]
+    def listObjects(self, kind):
+        listing = subprocess.check_output(['pactl', 'list', kind], timeout = self.timeout, universal_newlines = True,
+                                          env = dict(os.environ, LC_ALL = 'C'))
+        return parsePulseListing(listing)
+
+
+class PulseAudioSessionBackend(PulseAudioBackend, AmixerSessionBackend):
+    """
+    The amixer session for the master volume and one long-lived pacmd process for sinks and streams: a ramp step
+    writes the commands of all targets in one go, so fading ten streams costs one pipe write like fading one.
+    pacmd doesn't answer either. Where it can't run (PipeWire without pacmd support), writes fall back to pactl.
+    """
+
+    def __init__(self, beVerbose):
+        PulseAudioBackend.__init__(self)
+        AmixerSessionBackend.__init__(self, beVerbose)
+        # define members:
+        self.pacmd = None
+        self.pacmdRestarts = 0
+
+    # a command with a name pacmd would split (only possible if a target bypassed parseVolumeTargets) goes to pactl,
+    # which gets every name as one argument
+    def runVolumeCommands(self, commands):
+        unsafeCommands = [command for command in commands if not all(isPlainName(argument) for argument in command)]
+        if unsafeCommands:
+            PulseAudioBackend.runVolumeCommands(self, unsafeCommands)
+            commands = [command for command in commands if command not in unsafeCommands]
+            if not commands:
+                return
+        script = ''.join(' '.join(command) + '\n' for command in commands)
+        while self.pacmdRestarts <= MAX_PACMD_RESTARTS:
+            try:
+                if self.pacmd is None or self.pacmd.poll() is not None:
+                    if self.pacmd is not None:
+                        self.pacmdRestarts += 1
+                        if self.beVerbose: print('PulseAudioSessionBackend: pacmd session ended; restarting it')
+                    self.pacmd = subprocess.Popen(['pacmd'], stdin = subprocess.PIPE, stdout = subprocess.DEVNULL,
+                                                  stderr = subprocess.DEVNULL, universal_newlines = True)
+                self.pacmd.stdin.write(script)
+                self.pacmd.stdin.flush()
+                return
+            except (OSError, ValueError):
+                self.pacmdRestarts += 1
+                self.pacmd = None
+        PulseAudioBackend.runVolumeCommands(self, commands)
+
+    def abort(self):
+        AmixerSessionBackend.abort(self)
+        pacmd = self.pacmd
+        if pacmd is not None:
+            pacmd.kill()
+
+    def close(self):
+        AmixerSessionBackend.close(self)
+        if self.pacmd is not None:
+            self.pacmd.stdin.close()
+            self.pacmd.wait()
+            self.pacmd = None
+
+
+# `pactl list sinks` / `pactl list sink-inputs` (C locale) -> the objects with their index, name, volume (the
+# loudest channel, percent) and properties
+def parsePulseListing(listing):
+    objects = []
+    current = None
+    for line in listing.splitlines():
+        if line and not line[0].isspace():
+            current = {'index': line.rpartition('#')[2].strip(), 'properties': {}}
+            objects.append(current)
+            continue
+        line = line.strip()
+        if current is None:
+            continue
+        if line.startswith('Name:'):
+            current['name'] = line[len('Name:'):].strip()
+        elif line.startswith('Volume:'):
+            rawVolumes = [int(rawVolume) for rawVolume in re.findall(r'(\d+) /', line)]
+            if rawVolumes:
+                current['volume'] = round(max(rawVolumes) * 100 / PULSE_VOLUME_NORM, 2)
+        elif ' = ' in line:
+            key, separator, value = line.partition(' = ')
+            current['properties'][key] = value.strip('"')
+    return objects
+
+
+class OsascriptBackend(AudioBackend):
+    # one osascript process per call
+    def getVolume(self):
+        volume = subprocess.check_output(['osascript', '-e', 'get volume settings'], timeout = self.timeout)
+        volume = re.search('([0-9]+)', str(volume))
+        volume = volume.group(1)
+        return int(volume)
+
+    def setVolume(self, percent):
+        targetVolume = (7 * percent) / 100
+        subprocess.call(['osascript', '-e', 'Set volume ' + str(targetVolume)], timeout = self.timeout)
+
+
+class OsascriptSessionBackend(OsascriptBackend):
+    """
+    Keeps one interactive `osascript -l JavaScript -i` session alive and evaluates the volume statements in it.
+    The session echoes every result as `=> [value]`, which is used to read the volume and to wait for writes.
+    If the session fails, the forking backend takes over.
+    """
+
+    def __init__(self, beVerbose):
+        self.beVerbose = beVerbose
+        self.session = None
+
+    def startSession(self):
+        self.session = subprocess.Popen(['osascript', '-l', 'JavaScript', '-i'], stdin = subprocess.PIPE,
+                                        stdout = subprocess.PIPE, universal_newlines = True, bufsize = 1)
+        self.evaluate('var app = Application.currentApplication(); app.includeStandardAdditions = true')
+
+    def evaluate(self, statement):
+        self.session.stdin.write(statement + '\n')
+        self.session.stdin.flush()
+
+        while True:
+            line = self.session.stdout.readline()
+            if line == '':
+                raise EOFError('osascript session closed')
+            if '=> ' in line:
+                return line.split('=> ', 1)[1].strip()
+
+    def sessionEvaluate(self, statement):
+        try:
+            if self.session is None or self.session.poll() is not None:
+                self.startSession()
+            return self.evaluate(statement)
+        except (OSError, ValueError, EOFError):
+            if self.beVerbose: print('OsascriptSessionBackend: osascript session failed; using a single call')
+            self.session = None
+            return None
+
+    def getVolume(self):
+        volume = self.sessionEvaluate('app.getVolumeSettings().outputVolume')
+        if volume is None or not volume.isdigit():
+            return OsascriptBackend.getVolume(self)
+        return int(volume)
+
+    def setVolume(self, percent):
+        if self.sessionEvaluate('app.setVolume(null, {outputVolume: ' + str(percent) + '})') is None:
+            OsascriptBackend.setVolume(self, percent)
+
+    def abort(self):
+        session = self.session
+        if session is not None:
+            session.kill()
+
+    def close(self):
+        if self.session is not None:
+            self.session.stdin.close()
+            self.session.wait()
+            self.session = None
+
+
+class UnsupportedAudioBackend(AudioBackend):
+    def getVolume(self):
+        print('setting the volume for this platform not yet implemented!')
+        return 100
+
+    def setVolume(self, percent):
+        print('setting the volume for this platform not yet implemented!')
+
+
+class FakeAudioBackend(AudioBackend):
+    # in-memory mixer for tests and benchmarks; every write is recorded in volumeWrites. Every sink and application
+    # target exists and has the master volume until it's written
+    supportsTargets = True
+
+    def __init__(self, volume = 50):
+        self.volume = volume
+        self.volumeWrites = []
+        self.targetVolumes = {} # targets other than the master volume
+
+    def getVolume(self):
+        return self.volume
+
+    def setVolume(self, percent):
+        self.volume = percent
+        self.volumeWrites.append(percent)
+
+    def getVolumes(self, targets):
+        volumes = dict(self.targetVolumes, master = self.volume)
+        return {target: volumes.get(target, self.volume) for target in targets}
+
+    def setVolumes(self, volumes):
+        self.targetVolumes.update(volumes)
+        self.volume = volumes.get(MASTER_TARGET, self.volume)
+        self.volumeWrites.append(dict(volumes))
+
+
+def measureLatency(backend, calls):
+    startTime = perf_counter()
+    for call in range(calls):
+        backend.setVolume(call % 2 + 40)
+    setLatency = (perf_counter() - startTime) / calls
+
+    startTime = perf_counter()
+    for call in range(calls):
+        backend.getVolume()
+    getLatency = (perf_counter() - startTime) / calls
+
+    return setLatency, getLatency
+
+def measureTargetLatency(backend, targets, calls):
+    originalVolumes = backend.getVolumes(targets)
+    latencies = []
+    for writtenTargets in [targets[:1], targets]:
+        startTime = perf_counter()
+        for call in range(calls):
+            backend.setVolumes({target: call % 2 + 40 for target in writtenTargets})
+        latencies.append((perf_counter() - startTime) / calls)
+    backend.setVolumes(originalVolumes)
+    return latencies
+
+# check if this code is run as a module or was included into another project
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    targets = parseVolumeTargets(sys.argv[2:]) if len(sys.argv) > 2 else None
+
+    if sys.platform == 'darwin':
+        backends = [OsascriptBackend(), OsascriptSessionBackend(False)]
+    elif sys.platform.startswith('linux'):
+        backends = [PulseAudioBackend(), PulseAudioSessionBackend(False)]
+    else:
+        backends = []
+    backends.append(FakeAudioBackend())
+
+    for backend in backends:
+        if targets is not None:
+            if backend.supportsTargets:
+                oneTarget, allTargets = measureTargetLatency(backend, targets, calls)
+                backend.close()
+                print('%-24s setVolumes: %9.3f ms for 1 target, %9.3f ms for %d' %
+                      (type(backend).__name__, oneTarget * 1000, allTargets * 1000, len(targets)))
+            continue
+
+        originalVolume = backend.getVolume()
+        setLatency, getLatency = measureLatency(backend, calls)
+        backend.setVolume(originalVolume)
+        backend.close()
+        print('%-24s setVolume: %9.3f ms   getVolume: %9.3f ms' % (type(backend).__name__, setLatency * 1000, getLatency * 1000))
@@ -0,0 +1,208 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+# Load test for the sleepApi: starts a SleepServer with the fake system control on a local port, drives a mix of
+# requests from many concurrent clients and prints throughput and latency percentiles as JSON.
+# With --startup it measures the cold start instead: process spawn until the first successful status response.
+#
+#   python3 benchmark.py --engine threaded asyncio --clients 16 --requests 200
+#   python3 benchmark.py --engine threaded asyncio --startup 20
+
+from threading import Thread
+from time import perf_counter, sleep
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+
+# defining constants
+DEFAULT_MIX = 'status=70,setVolume=20,setSleepTime=5,reset=5'
+SERVER_STARTUP_TIMEOUT = 10 # seconds
+STARTUP_POLL_INTERVAL = 0.001 # seconds between connection attempts while measuring the cold start
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sleepServer.py')
+# all clients share 127.0.0.1, so the per-client rate limits would answer most of the load with 429; arguments after
+# -- come later and can turn them on again
+SERVER_ARGUMENTS = ['-b', 'fake', '--rate-limit', '0', '--emergency-rate-limit', '0']
+
+def parseMix(mixDescription):
+    mix = []
+    for entry in mixDescription.split(','):
+        route, weight = entry.split('=')
+        mix.append((route.strip(), float(weight)))
+    return mix
+
+def pathForRoute(route, randomGenerator):
+    if route == 'setVolume':
+        return '/sleepApi/setVolume/' + str(randomGenerator.randint(0, 100))
+    elif route == 'setSleepTime':
+        # long enough to never expire while the benchmark runs
+        return '/sleepApi/setSleepTime/' + str(randomGenerator.randint(3600, 7200))
+    return '/sleepApi/' + route
+
+def percentile(sortedValues, share):
+    if not sortedValues:
+        return None
+    index = min(len(sortedValues) - 1, int(round(share * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+# 2xx and 3xx (304 for an unchanged status); a 4xx is a rejected request, a 5xx or no response a failed one
+def isSuccess(status):
+    return status is not None and status < 400
+
+def latencySummary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+    }
+
+class BenchmarkClient(Thread):
+    def __init__(self, port, mix, numberOfRequests, seed, keepAlive):
+        # define members:
+        self.port = port
+        self.routes = [route for route, weight in mix]
+        self.weights = [weight for route, weight in mix]
+        self.numberOfRequests = numberOfRequests
+        self.randomGenerator = random.Random(seed)
+        self.keepAlive = keepAlive
+        self.results = [] # (route, latency in seconds, HTTP status or None on connection errors)
+
+        # inital method calls
+        Thread.__init__(self)
+
+    def run(self):
+        connection = None
+        for requestNumber in range(self.numberOfRequests):
+            route = self.randomGenerator.choices(self.routes, self.weights)[0]
+            path = pathForRoute(route, self.randomGenerator)
+
+            startTime = perf_counter()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout = 10)
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if not self.keepAlive or response.will_close:
+                    connection.close()
+                    connection = None
+            except (OSError, http.client.HTTPException):
+                status = None
+                if connection is not None:
+                    connection.close()
+                connection = None
+            self.results.append((route, perf_counter() - startTime, status))
+
+        if connection is not None:
+            connection.close()
+
+def startServer(engine, port, extraArguments, pollInterval = 0.05):
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '-p', str(port), '-e', engine] + SERVER_ARGUMENTS + extraArguments,
+                              stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    # wait for the first successful status response
+    startTime = perf_counter()
+    while perf_counter() - startTime < SERVER_STARTUP_TIMEOUT:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 1)
+            connection.request('GET', '/sleepApi/status')
+            status = connection.getresponse().status
+            connection.close()
+            if status == 200:
+                return server
+        except (OSError, http.client.HTTPException):
+            pass
+        sleep(pollInterval)
+
+    server.kill()
+    raise RuntimeError('SleepServer did not answer on port ' + str(port))
+
+def runStartupBenchmark(engine, port, runs, extraArguments):
+    startupTimes = []
+    for run in range(runs):
+        startTime = perf_counter()
+        server = startServer(engine, port, extraArguments, STARTUP_POLL_INTERVAL)
+        startupTimes.append(perf_counter() - startTime)
+        server.terminate()
+        server.wait()
+
+    startupTimes.sort()
+    return {
+        'engine': engine,
+        'runs': runs,
+        'startup_p50_ms': round(percentile(startupTimes, 0.50) * 1000, 1),
+        'startup_min_ms': round(startupTimes[0] * 1000, 1),
+        'startup_max_ms': round(startupTimes[-1] * 1000, 1),
+    }
+
+def runBenchmark(engine, port, mix, clients, requestsPerClient, keepAlive, extraArguments):
+    server = startServer(engine, port, extraArguments)
+    try:
+        benchmarkClients = [BenchmarkClient(port, mix, requestsPerClient, seed, keepAlive) for seed in range(clients)]
+        startTime = perf_counter()
+        for client in benchmarkClients:
+            client.start()
+        for client in benchmarkClients:
+            client.join()
+        duration = perf_counter() - startTime
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = [result for client in benchmarkClients for result in client.results]
+    succeeded = [latency for route, latency, status in results if isSuccess(status)]
+    rejected = [status for route, latency, status in results if status is not None and 400 <= status < 500]
+    perRoute = {}
+    for route, weight in mix:
+        routeResults = [(latency, status) for resultRoute, latency, status in results if resultRoute == route]
+        perRoute[route] = latencySummary([latency for latency, status in routeResults if isSuccess(status)])
+        perRoute[route]['errors'] = len([status for latency, status in routeResults if not isSuccess(status)])
+
+    report = {
+        'engine': engine,
+        'clients': clients,
+        'keepAlive': keepAlive,
+        'duration_s': round(duration, 3),
+        'requests': len(results),
+        'errors': len(results) - len(succeeded), # rejected ones included
+        'rejected': len(rejected),
+        'throughput_rps': round(len(succeeded) / duration, 1),
+        'latency': latencySummary(succeeded),
+        'routes': perRoute,
+    }
+    return report
+
+# check if this code is run as a module or was included into another project
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load test for the SleepServer HTTP API.")
+    parser.add_argument("-e", "--engine", nargs = '+', default = ['threaded'], help = "network engines to compare")
+    parser.add_argument("-p", "--port", type=int, default = 4555, help = "first local port; every engine gets its own")
+    parser.add_argument("-c", "--clients", type=int, default = 8, help = "number of concurrent clients")
+    parser.add_argument("-n", "--requests", type=int, default = 250, help = "requests per client")
+    parser.add_argument("-m", "--mix", default = DEFAULT_MIX, help = "weighted request mix, e.g. " + DEFAULT_MIX)
+    parser.add_argument("-k", "--keep-alive", action = "store_true", dest = "keepAlive", help = "reuse connections between requests")
+    parser.add_argument("-s", "--startup", type=int, metavar = "RUNS", help = "measure the cold start (spawn to first status response) RUNS times instead")
+    parser.add_argument("-o", "--output", help = "also write the JSON report to this file")
+    parser.add_argument("serverArguments", nargs = argparse.REMAINDER, help = "extra arguments for sleepServer.py (after --)")
+    args = parser.parse_args()
+
+    extraArguments = [argument for argument in args.serverArguments if argument != '--']
+    reports = []
+    for position, engine in enumerate(args.engine):
+        if args.startup:
+            reports.append(runStartupBenchmark(engine, args.port + position, args.startup, extraArguments))
+        else:
+            reports.append(runBenchmark(engine, args.port + position, parseMix(args.mix), args.clients, args.requests,
+                                        args.keepAlive, extraArguments))
+
+    output = json.dumps(reports, indent = 2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output + '\n')
@@ -0,0 +1,37 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+import time
+
+class SystemClock:
+    """
+    The clocks of the sleep server: monotonic() for timer deadlines and time() (seconds since the epoch) for what has
+    to survive a restart or refers to the calendar, like schedule entries.
+    """
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+
+class VirtualClock(SystemClock):
+    """
+    A clock that only moves when it's told to; the simulation fast-forwards timers and ramps with it.
+    Both clocks advance together, time() starts at the given epoch seconds.
+    """
+
+    def __init__(self, startTime):
+        # define members:
+        self.now = 0.0 # virtual monotonic seconds
+        self.startTime = startTime
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.startTime + self.now
+
+    def advance(self, seconds):
+        self.now += max(0, seconds)
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition
+from time import monotonic
+from admissionControl import EMERGENCY_PRIORITY, PRIORITY_NAMES, CommandQueueFull, commandPriority, depthLimits
+
+# passes the reply (or the error) of a command on to the caller of a command that joined it
+def copyReply(sourceFuture, targetFuture):
+    if sourceFuture.exception() is not None:
+        targetFuture.set_exception(sourceFuture.exception())
+    else:
+        targetFuture.set_result(sourceFuture.result())
+
+
+class CommandFailed(Exception):
+    """
+    Set on the reply future of a command the sleep server raised an error on; the network manager answers HTTP 500.
+    """
+
+
+class CommandBus:
+    """
+    Transport of commands from any number of network threads to the sleep server thread.
+    Every command travels together with its own reply future, so replies can't be mixed up between callers and a
+    request can never be read back as a reply.
+    Commands wait in one queue per priority (see admissionControl): immediate sleep and reset go ahead of everything,
+    status reads come last. Once maxDepth commands wait, reads are shed right away instead of queued, other commands
+    at twice that depth; submit raises CommandQueueFull then. Emergency commands are never shed; one that repeats the
+    last queued emergency command joins it and gets its reply, so a client retrying a reset in a loop queues it once.
+    """
+
+    def __init__(self, metrics = None, maxDepth = None):
+        # define members:
+        self.condition = Condition()
+        self.queues = [deque() for priority in PRIORITY_NAMES] # (command, reply future, submit time)
+        self.depth = 0
+        self.depthLimits = depthLimits(maxDepth)
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.addGauge('command_queue_depth', self.queueDepths)
+
+    # called by the network side; returns a future that resolves to the reply dictionary
+    def submit(self, command):
+        priority = commandPriority(command)
+        replyFuture = Future()
+        with self.condition:
+            if priority == EMERGENCY_PRIORITY and self.queues[priority] and self.queues[priority][-1][0] == command:
+                self.queues[priority][-1][1].add_done_callback(lambda queuedFuture: copyReply(queuedFuture, replyFuture))
+                if self.metrics is not None:
+                    self.metrics.increment('commands_coalesced_total')
+                return replyFuture
+            limit = self.depthLimits[priority]
+            if limit is not None and self.depth >= limit:
+                if self.metrics is not None:
+                    self.metrics.increment('commands_shed_total', (('priority', PRIORITY_NAMES[priority]),))
+                raise CommandQueueFull(priority)
+            self.queues[priority].append((command, replyFuture, monotonic()))
+            self.depth += 1
+            self.condition.notify()
+        return replyFuture
+
+    # blocking shortcut of submit for callers that need the reply right away
+    def request(self, command, timeout = None):
+        return self.submit(command).result(timeout)
+
+    # called by the sleep server thread; returns (command, replyFuture) of the most urgent command or (None, None)
+    # after the timeout
+    def nextCommand(self, timeout = None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.depth > 0, timeout):
+                return None, None
+            queue = next(queue for queue in self.queues if queue)
+            command, replyFuture, submitTime = queue.popleft()
+            self.depth -= 1
+
+        if self.metrics is not None:
+            self.metrics.observe('command_queue_wait_seconds', monotonic() - submitTime)
+        return command, replyFuture
+
+    # ((labels, depth), ...) for the metrics
+    def queueDepths(self):
+        with self.condition:
+            return [((('priority', name),), len(queue)) for name, queue in zip(PRIORITY_NAMES, self.queues)]
+
+
+# stress test of the reply matching: clients fire interleaved status and setVolume commands at a sleep server with the
+# fake system control; every setVolume reply must carry the client's own volume, every status reply must be a status.
+#   python3 commandBus.py [commands per client] [clients]
+if __name__ == "__main__":
+    from threading import Thread
+    import sys
+    from systemControl import FakeSystemControl
+    from sleepServer import SleepServer
+
+    commandsPerClient = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    numberOfClients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    server = SleepServer(systemControl = FakeSystemControl(False, 0, commandWorkers = 0), startNetworkManager = False)
+    server.daemon = True
+    server.start()
+    mismatches = []
+
+    def client(clientNumber):
+        for number in range(commandsPerClient):
+            if number % 2 == 0:
+                reply = server.commandBus.request({'get': 'status'}, 10)
+                if 'status' not in reply or 'acknowledge' in reply:
+                    mismatches.append((clientNumber, number, reply))
+            else:
+                # a volume no other command asks for: percent with the client and command number in its decimals
+                percent = (number % 100) + (clientNumber * commandsPerClient + number) / (numberOfClients * commandsPerClient + 1)
+                reply = server.commandBus.request({'set': 'volume', 'percent': percent}, 10)
+                if reply.get('currentVolume') != percent:
+                    mismatches.append((clientNumber, number, reply))
+
+    startTime = monotonic()
+    clients = [Thread(target = client, args = (clientNumber,)) for clientNumber in range(numberOfClients)]
+    for clientThread in clients:
+        clientThread.start()
+    for clientThread in clients:
+        clientThread.join()
+    duration = monotonic() - startTime
+
+    print('%d commands from %d clients in %.2f s, %d mismatched replies' % (commandsPerClient * numberOfClients, numberOfClients, duration, len(mismatches)))
+    for mismatch in mismatches[:10]:
+        print('client %d, command %d got %r' % mismatch)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,161 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.client import HTTPConnection, HTTPException, RemoteDisconnected
+from queue import LifoQueue, Empty, Full
+from time import perf_counter
+import json
+
+# defining constants
+IDLE_CONNECTIONS_PER_PEER = 4 # kept-alive connections to one peer; more are opened while many requests are in flight
+FLEET_WORKERS = 32 # threads talking to peers at the same time
+
+class PeerConnectionPool:
+    """
+    Kept-alive HTTP connections to one SleepServer peer.
+    Connections are reused most recently released first, so rarely used ones are the first to be closed by the peer.
+    """
+
+    def __init__(self, address, timeout):
+        # define members:
+        self.address = address
+        self.host, separator, port = address.rpartition(':')
+        self.port = int(port)
+        self.timeout = timeout
+        self.idleConnections = LifoQueue(maxsize = IDLE_CONNECTIONS_PER_PEER)
+
+    # returns (connection, whether it was used before)
+    def acquire(self):
+        try:
+            return self.idleConnections.get_nowait(), True
+        except Empty:
+            return HTTPConnection(self.host, self.port, timeout = self.timeout), False
+
+    def release(self, connection):
+        try:
+            self.idleConnections.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    # one request (GET, POST or DELETE); returns (HTTP status, decoded JSON answer). A kept-alive connection the peer closed in the meantime
+    # is replaced once, every other failure raises
+    def request(self, method, path, body = None):
+        connection, reused = self.acquire()
+        try:
+            return self.requestOn(connection, method, path, body)
+        except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        connection = HTTPConnection(self.host, self.port, timeout = self.timeout)
+        try:
+            return self.requestOn(connection, method, path, body)
+        except Exception:
+            connection.close()
+            raise
+
+    def requestOn(self, connection, method, path, body):
+        headers = {'Content-Type': 'application/json'} if body else {}
+        connection.request(method, path, body = body, headers = headers)
+        response = connection.getresponse()
+        answer = json.loads(response.read().decode('UTF-8'))
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+        return response.status, answer
+
+    def close(self):
+        while True:
+            try:
+                self.idleConnections.get_nowait().close()
+            except Empty:
+                return
+
+
+class FleetCoordinator:
+    """
+    Forwards sleepApi requests to a fleet of SleepServer peers (host:port) in parallel and aggregates their answers.
+    Every peer gets its own timeout; peers that fail or don't answer in time are reported per host and don't hold up
+    the others.
+    """
+
+    def __init__(self, peers, timeout, metrics = None):
+        # define members:
+        self.timeout = timeout
+        self.metrics = metrics
+        self.pools = [PeerConnectionPool(peer, timeout) for peer in peers]
+        self.executor = ThreadPoolExecutor(max_workers = min(FLEET_WORKERS, max(1, len(self.pools))))
+
+    # returns {peer: (HTTP status, answer)} for the peers that answered and {peer: error message} for the others
+    def forward(self, method, path, body = None):
+        futures = {self.executor.submit(self.timedRequest, pool, method, path, body): pool for pool in self.pools}
+        # a request that got stuck in the pool's queue is given up after two timeouts (connect and read)
+        done, notDone = wait(futures, timeout = 2 * self.timeout)
+
+        answers = {}
+        failures = {}
+        for future, pool in futures.items():
+            if future in notDone:
+                future.cancel()
+                failures[pool.address] = 'timed out'
+                self.countFailure(pool.address)
+            elif future.exception() is not None:
+                failures[pool.address] = describeFailure(future.exception())
+                self.countFailure(pool.address)
+            else:
+                answers[pool.address] = future.result()
+        return answers, failures
+
+    def timedRequest(self, pool, method, path, body):
+        startTime = perf_counter()
+        try:
+            return pool.request(method, path, body)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('fleet_peer_request_duration_seconds', perf_counter() - startTime, (('peer', pool.address),))
+
+    def countFailure(self, address):
+        if self.metrics is not None:
+            self.metrics.increment('fleet_peer_failures_total', (('peer', address),))
+
+    # combined answer of the whole fleet: every peer's answer (or error) and how many peers are in which status
+    def aggregate(self, answers, failures):
+        peers = {}
+        statusCounts = {}
+        for address, (responseCode, answer) in answers.items():
+            peers[address] = dict(answer, code = responseCode) if isinstance(answer, dict) else {'code': responseCode, 'answer': answer}
+            if isinstance(answer, dict) and 'status' in answer:
+                statusCounts[answer['status']] = statusCounts.get(answer['status'], 0) + 1
+        for address, error in failures.items():
+            peers[address] = {'error': error}
+
+        return {
+            'status': 'fleet',
+            'peers': peers,
+            'statusCounts': statusCounts,
+            'answered': len(answers),
+            'failed': len(failures),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait = False)
+        for pool in self.pools:
+            pool.close()
+
+
+def describeFailure(exception):
+    if isinstance(exception, TimeoutError) or 'timed out' in str(exception):
+        return 'timed out'
+    if isinstance(exception, ConnectionRefusedError):
+        return 'connection refused'
+    if isinstance(exception, ValueError):
+        return 'no JSON answer'
+    if isinstance(exception, (OSError, HTTPException)):
+        return type(exception).__name__ + ': ' + str(exception)
+    return 'failed: ' + str(exception)
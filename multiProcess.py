@@ -0,0 +1,219 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import Future
+from itertools import count
+from queue import SimpleQueue
+from threading import Thread, Lock
+from admissionControl import CommandQueueFull
+from commandBus import CommandFailed
+import json
+import os
+import signal
+import socket
+import struct
+
+# defining constants
+FRAME_HEADER = struct.Struct('!I') # length of the JSON frame that follows
+MAX_FRAME_SIZE = 1048576 # bytes; a longer frame means the channel is out of sync
+
+# The control channel connects every HTTP worker process with the control process over a Unix domain socket pair.
+# Frames are a 4 byte length and a compact JSON object:
+#   worker -> control: {"id": [int], "command": {...}}                 a command for the sleep server
+#   control -> worker: {"id": [int], "reply": {...}}                   its reply
+#                      {"id": [int], "shed": [priority, retryAfter]}    the command bus shed it (queue full)
+#                      {"id": [int], "failed": [message]}              the sleep server raised an error on it
+#                      {"status": [version, snapshot, deadline, verifiedAt]}  a published status
+#                      {"confirm": [verifiedAt]}                       the status was checked and is unchanged
+# Deadlines and check times are monotonic seconds, which are the same in every process of the machine.
+
+def sendFrame(connection, message):
+    payload = json.dumps(message, separators = (',', ':')).encode('UTF-8')
+    connection.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+# the next decoded frame or None if the other side closed the connection
+def readFrame(connectionFile):
+    header = connectionFile.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length = FRAME_HEADER.unpack(header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ValueError('control channel frame of ' + str(length) + ' bytes')
+    payload = connectionFile.read(length)
+    if len(payload) < length:
+        return None
+    return json.loads(payload.decode('UTF-8'))
+
+
+class ControlChannelServer:
+    """
+    The control process' end of the channels: commands of the workers go to the sleep server's command bus, replies
+    and every status change go back. Each worker has a writer thread, so a slow worker never blocks the control thread.
+    """
+
+    def __init__(self, connections, commandBus, statusPublisher, beVerbose):
+        # define members:
+        self.commandBus = commandBus
+        self.statusPublisher = statusPublisher
+        self.beVerbose = beVerbose
+        self.connections = connections
+
+    def start(self):
+        for connection in self.connections:
+            outgoing = SimpleQueue()
+            for target, arguments in [(self.readCommands, (connection, outgoing)), (self.writeFrames, (connection, outgoing))]:
+                thread = Thread(target = target, args = arguments)
+                thread.daemon = True
+                thread.start()
+
+    def readCommands(self, connection, outgoing):
+        def forwardStatus(version, snapshot, deadline, verifiedAt, changed):
+            outgoing.put({'status': [version, snapshot, deadline, verifiedAt]} if changed else {'confirm': verifiedAt})
+
+        self.statusPublisher.subscribe(forwardStatus)
+        connectionFile = connection.makefile('rb')
+        try:
+            while True:
+                frame = readFrame(connectionFile)
+                if frame is None:
+                    break
+                try:
+                    replyFuture = self.commandBus.submit(frame['command'])
+                except CommandQueueFull as error:
+                    outgoing.put({'id': frame['id'], 'shed': [error.priority, error.retryAfter]})
+                    continue
+                replyFuture.add_done_callback(lambda future, commandId = frame['id']: outgoing.put(replyFrame(commandId, future)))
+        except (OSError, ValueError, KeyError) as error:
+            print('ControlChannelServer: dropping a worker connection:', error)
+        finally:
+            self.statusPublisher.unsubscribe(forwardStatus)
+            outgoing.put(None)
+            if self.beVerbose: print('ControlChannelServer: a worker disconnected')
+
+    def writeFrames(self, connection, outgoing):
+        try:
+            while True:
+                message = outgoing.get()
+                if message is None:
+                    break
+                sendFrame(connection, message)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+
+def replyFrame(commandId, replyFuture):
+    if replyFuture.exception() is not None:
+        return {'id': commandId, 'failed': str(replyFuture.exception())}
+    return {'id': commandId, 'reply': replyFuture.result()}
+
+
+class ControlChannelClient:
+    """
+    An HTTP worker's end of the channel. It stands in for the command bus of the network manager (request()) and keeps
+    the worker's status publisher a mirror of the control process' one, so status requests, ETags, streams and long
+    polls are answered in the worker. A worker without its control process can't do anything and exits.
+    """
+
+    def __init__(self, connection, statusPublisher):
+        # define members:
+        self.connection = connection
+        self.statusPublisher = statusPublisher
+        self.sendLock = Lock()
+        self.commandIds = count()
+        self.pendingReplies = {} # command id -> Future
+
+        reader = Thread(target = self.readFrames)
+        reader.daemon = True
+        reader.start()
+
+    def submit(self, command):
+        replyFuture = Future()
+        with self.sendLock:
+            commandId = next(self.commandIds)
+            self.pendingReplies[commandId] = replyFuture
+            sendFrame(self.connection, {'id': commandId, 'command': command})
+        return replyFuture
+
+    def request(self, command, timeout = None):
+        return self.submit(command).result(timeout)
+
+    # the status frames of a command arrive before its reply, so a caller sees the command's effect in the mirror
+    def readFrames(self):
+        connectionFile = self.connection.makefile('rb')
+        try:
+            while True:
+                frame = readFrame(connectionFile)
+                if frame is None:
+                    break
+                if 'reply' in frame:
+                    with self.sendLock:
+                        replyFuture = self.pendingReplies.pop(frame['id'])
+                    replyFuture.set_result(frame['reply'])
+                elif 'shed' in frame:
+                    with self.sendLock:
+                        replyFuture = self.pendingReplies.pop(frame['id'])
+                    replyFuture.set_exception(CommandQueueFull(*frame['shed']))
+                elif 'failed' in frame:
+                    with self.sendLock:
+                        replyFuture = self.pendingReplies.pop(frame['id'])
+                    replyFuture.set_exception(CommandFailed(frame['failed']))
+                elif 'status' in frame:
+                    version, snapshot, deadline, verifiedAt = frame['status']
+                    self.statusPublisher.publish(snapshot, deadline, verifiedAt, version)
+                elif 'confirm' in frame:
+                    self.statusPublisher.confirm(frame['confirm'])
+        except (OSError, ValueError, KeyError) as error:
+            print('ControlChannelClient: control channel failed:', error)
+        print('HTTP worker', os.getpid(), 'lost its control process; exiting')
+        os._exit(1)
+
+
+# forks the HTTP workers; must be called before the calling process starts any thread. Every worker gets its end of
+# a Unix socket pair and runs workerMain(connection) until it exits. Returns {pid: the control process' end}
+def forkWorkers(numberOfWorkers, workerMain):
+    workers = {}
+    for number in range(numberOfWorkers):
+        controlEnd, workerEnd = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            controlEnd.close()
+            for otherEnd in workers.values():
+                otherEnd.close()
+            try:
+                workerMain(workerEnd)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        workerEnd.close()
+        workers[pid] = controlEnd
+    return workers
+
+def stopWorkers(workerPids):
+    for pid in workerPids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+# a listening TCP socket every worker binds on its own; the kernel spreads new connections across them
+def listenOnPort(port, backlog = 128):
+    listeningSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listeningSocket.bind(('', port))
+    listeningSocket.listen(backlog)
+    return listeningSocket
+
+# the workers never need the privileges sleep and shutdown may require; they give them up once the port is bound
+def dropPrivileges(userName):
+    if os.getuid() != 0:
+        return
+    import pwd
+    user = pwd.getpwnam(userName)
+    os.setgroups([])
+    os.setgid(user.pw_gid)
+    os.setuid(user.pw_uid)
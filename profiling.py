@@ -0,0 +1,331 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from threading import Condition, Event, Lock, Timer, current_thread, local
+from time import monotonic, strftime
+import os
+import re
+import sys
+
+# defining constants
+MAX_CAPTURE_TIME = 3600 # seconds
+REPORT_LINES = 40 # functions (CPU) or source lines (memory) in the text reports
+TRACEMALLOC_FRAMES = 10 # stack frames stored per traced allocation
+SECTION_DRAIN_TIMEOUT = 1 # seconds a finishing capture waits for sections still running in other threads
+# up to Python 3.11 cProfile only sees the thread that enables it, so every thread gets its own profiler; from 3.12 on
+# it is built on sys.monitoring, sees every thread and allows only one active profiler in the process
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+# cProfile, pstats, tracemalloc and pickle are imported when a capture starts, they would slow down every start
+
+# 'Thread-12 (process_request_thread)' -> 'Thread (process_request_thread)'; request threads are numbered one by one
+def threadRole(threadName):
+    return re.sub(r'-[0-9_]+', '', threadName)
+
+
+class InactiveSection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+INACTIVE_SECTION = InactiveSection()
+
+
+class ProfiledSection:
+    def __init__(self, capture):
+        # define members:
+        self.capture = capture
+
+    # a failing profiler must never fail the work it measures (the control loop, a request)
+    def __enter__(self):
+        try:
+            self.entered = self.capture.enterSection()
+        except Exception as error:
+            self.entered = False
+            self.capture.reportSectionError(error)
+        return self
+
+    def __exit__(self, *exception):
+        if self.entered:
+            try:
+                self.capture.exitSection()
+            except Exception as error:
+                self.capture.reportSectionError(error)
+        return False
+
+
+class ThreadProfile:
+    def __init__(self, threadName, profile):
+        # define members:
+        self.threadName = threadName
+        self.profile = profile # None if one profiler covers all threads
+        self.depth = 0 # sections of the thread currently running; the profile is enabled while it's above 0
+        self.sections = 0
+
+
+class ProfileCapture:
+    """
+    One capture of seconds. Up to Python 3.11 every thread gets its own cProfile profiler, which runs while the thread
+    is inside a section, i.e. while it handles a request, runs the control loop or a system command, and not while it
+    waits for work. From 3.12 on one profiler runs for the whole capture and sees every thread, waits included; the
+    sections are only counted. Optionally tracemalloc is snapshot at the start and the end.
+    The results are kept as text reports and as files for pstats / tracemalloc.Snapshot.load().
+    """
+
+    def __init__(self, seconds, traceMemory, outputDirectory = None):
+        # define members:
+        self.seconds = seconds
+        self.traceMemory = traceMemory
+        self.outputDirectory = outputDirectory # the results are written there too when the capture finishes
+        self.startedAt = monotonic()
+        self.startTime = strftime('%Y%m%d-%H%M%S')
+        self.condition = Condition()
+        self.threadProfiles = []
+        self.local = local()
+        self.activeSections = 0
+        self.sectionErrors = 0
+        self.finished = False # no section starts any more
+        self.sharedProfile = None # the profiler of all threads (Python 3.12 and later)
+        self.resultsReady = Event()
+        self.startedTracemalloc = False
+        self.startSnapshot = None
+        self.summary = {}
+        self.cpuReport = None
+        self.cpuStats = None # marshalled pstats, as written by pstats.Stats.dump_stats
+        self.memoryReport = None
+        self.memorySnapshot = None # pickled tracemalloc snapshot at the end of the capture
+        self.files = []
+
+        # raises ValueError if another profiling tool is active
+        if not PROFILE_PER_THREAD:
+            import cProfile
+            self.sharedProfile = cProfile.Profile()
+            self.sharedProfile.enable()
+        if traceMemory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.startedTracemalloc = True
+            self.startSnapshot = tracemalloc.take_snapshot()
+
+    # the counters only change once the profiler runs, so a failing enable() leaves nothing behind
+    def enterSection(self):
+        with self.condition:
+            if self.finished:
+                return False
+            self.activeSections += 1
+
+        try:
+            threadProfile = getattr(self.local, 'threadProfile', None)
+            if threadProfile is None:
+                profile = None
+                if PROFILE_PER_THREAD:
+                    import cProfile
+                    profile = cProfile.Profile()
+                threadProfile = self.local.threadProfile = ThreadProfile(current_thread().name, profile)
+                with self.condition:
+                    self.threadProfiles.append(threadProfile)
+            if threadProfile.depth == 0 and threadProfile.profile is not None:
+                threadProfile.profile.enable()
+        except Exception:
+            self.leaveSection()
+            raise
+        threadProfile.depth += 1
+        threadProfile.sections += 1
+        return True
+
+    def exitSection(self):
+        threadProfile = self.local.threadProfile
+        threadProfile.depth -= 1
+        try:
+            if threadProfile.depth == 0 and threadProfile.profile is not None:
+                threadProfile.profile.disable()
+        finally:
+            self.leaveSection()
+
+    def leaveSection(self):
+        with self.condition:
+            self.activeSections -= 1
+            if self.activeSections == 0:
+                self.condition.notify_all()
+
+    def reportSectionError(self, error):
+        with self.condition:
+            self.sectionErrors += 1
+            if self.sectionErrors > 1:
+                return
+        print('ProfileCapture: not profiling', current_thread().name + ':', error)
+
+    def secondsLeft(self):
+        return max(0, int(round(self.startedAt + self.seconds - monotonic())))
+
+    # ends the capture and builds its results; a thread still inside a section after the drain timeout (e.g. a hung
+    # system command) is left out. A second caller waits for the results
+    def finish(self):
+        with self.condition:
+            alreadyFinished = self.finished
+            self.finished = True
+        if alreadyFinished:
+            self.resultsReady.wait()
+            return
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.activeSections == 0, SECTION_DRAIN_TIMEOUT)
+            threadProfiles = list(self.threadProfiles)
+
+        if self.sharedProfile is not None:
+            self.sharedProfile.disable()
+            finishedProfiles = threadProfiles
+        else:
+            finishedProfiles = [threadProfile for threadProfile in threadProfiles if threadProfile.depth == 0]
+        threads = {}
+        for threadProfile in finishedProfiles:
+            threads[threadRole(threadProfile.threadName)] = threads.get(threadRole(threadProfile.threadName), 0) + 1
+        self.summary = {
+            'seconds': round(monotonic() - self.startedAt, 3),
+            'threads': threads,
+            'sections': sum(threadProfile.sections for threadProfile in finishedProfiles),
+            'threadsLeftOut': len(threadProfiles) - len(finishedProfiles),
+            'sectionErrors': self.sectionErrors,
+        }
+        if self.sharedProfile is not None:
+            self.buildCpuResults([self.sharedProfile])
+        else:
+            self.buildCpuResults([threadProfile.profile for threadProfile in finishedProfiles if threadProfile.sections])
+        if self.traceMemory:
+            self.buildMemoryResults()
+        if self.outputDirectory is not None:
+            self.writeFiles()
+        self.resultsReady.set()
+
+    def buildCpuResults(self, profiles):
+        import io
+        import marshal
+        import pstats
+
+        report = io.StringIO()
+        threads = ', '.join('%s (%d)' % thread for thread in sorted(self.summary['threads'].items()))
+        report.write('cProfile capture of %s seconds; %d sections in the threads %s\n' % (self.summary['seconds'], self.summary['sections'], threads or '-'))
+        if not profiles:
+            self.cpuReport = report.getvalue() + 'nothing ran while the capture was active\n'
+            self.cpuStats = marshal.dumps({})
+            return
+
+        stats = pstats.Stats(profiles[0], stream = report)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        stats.sort_stats('tottime').print_stats(REPORT_LINES)
+        self.cpuReport = report.getvalue()
+        self.cpuStats = marshal.dumps(stats.stats)
+
+    def buildMemoryResults(self):
+        import pickle
+        import tracemalloc
+
+        endSnapshot = tracemalloc.take_snapshot()
+        currentSize, peakSize = tracemalloc.get_traced_memory()
+        if self.startedTracemalloc:
+            tracemalloc.stop()
+
+        # the allocations of the profiler itself (and of importing it) aren't the server's
+        import cProfile
+        import pstats
+        filters = [tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats)]
+        filters += [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+        endSnapshot = endSnapshot.filter_traces(filters)
+        differences = endSnapshot.compare_to(self.startSnapshot.filter_traces(filters), 'lineno')
+
+        lines = ['tracemalloc capture of %s seconds; traced now %.1f KiB, peak %.1f KiB' % (self.summary['seconds'], currentSize / 1024, peakSize / 1024),
+                 '', 'largest growth (source line, size now, difference, allocations):']
+        lines += [str(difference) for difference in differences[:REPORT_LINES]]
+        lines += ['', 'largest allocations at the end:']
+        lines += [str(statistic) for statistic in endSnapshot.statistics('lineno')[:REPORT_LINES]]
+        self.memoryReport = '\n'.join(lines) + '\n'
+        self.memorySnapshot = pickle.dumps(endSnapshot, pickle.HIGHEST_PROTOCOL)
+        self.startSnapshot = None
+
+    def fileName(self, kind):
+        return 'sleepServer-' + str(os.getpid()) + '-' + self.startTime + '-' + kind
+
+    def writeFiles(self):
+        results = [('cpu.pstats', self.cpuStats), ('cpu.txt', self.cpuReport), ('memory.snapshot', self.memorySnapshot), ('memory.txt', self.memoryReport)]
+        for kind, content in results:
+            if content is None:
+                continue
+            path = os.path.join(self.outputDirectory, self.fileName(kind))
+            try:
+                with open(path, 'wb') as resultFile:
+                    resultFile.write(content if isinstance(content, bytes) else content.encode('UTF-8'))
+                self.files.append(path)
+            except OSError as error:
+                print('ProfileCapture: can\'t write', path + ':', error)
+        print('ProfileCapture: profile written to', ', '.join(self.files))
+
+    def asDictionary(self):
+        dictionary = {'running': not self.resultsReady.is_set(), 'seconds': self.seconds, 'memory': self.traceMemory}
+        if self.resultsReady.is_set():
+            dictionary.update(self.summary)
+            if self.files:
+                dictionary['files'] = self.files
+        else:
+            dictionary['secondsLeft'] = self.secondsLeft()
+        return dictionary
+
+
+class Profiler:
+    """
+    On-demand profiling of the running process, one capture at a time. Threads mark their work as sections
+    (with processProfiler.section(): ...); outside a capture a section costs one attribute check.
+    """
+
+    def __init__(self):
+        # define members:
+        self.lock = Lock()
+        self.capture = None # the running capture
+        self.lastCapture = None # the running or the last finished capture
+        self.timer = None
+
+    def section(self):
+        capture = self.capture
+        if capture is None:
+            return INACTIVE_SECTION
+        return ProfiledSection(capture)
+
+    # returns the new capture or None if one is running or still building its results
+    def start(self, seconds, traceMemory = False, outputDirectory = None):
+        with self.lock:
+            if self.lastCapture is not None and not self.lastCapture.resultsReady.is_set():
+                return None
+            capture = ProfileCapture(min(seconds, MAX_CAPTURE_TIME), traceMemory, outputDirectory)
+            self.capture = self.lastCapture = capture
+            self.timer = Timer(capture.seconds, self.finish, (capture,))
+            self.timer.daemon = True
+            self.timer.start()
+        return capture
+
+    # ends the running capture early; returns it or None if none runs
+    def stop(self):
+        with self.lock:
+            capture = self.capture
+            if capture is None:
+                return None
+            self.timer.cancel()
+        self.finish(capture)
+        return capture
+
+    def finish(self, capture):
+        capture.finish()
+        with self.lock:
+            if self.capture is capture:
+                self.capture = None
+
+
+# the profiler of this process; captures are started by the --profile flag or the sleepApi/profile routes
+processProfiler = Profiler()
+
+# runs the function as a profiled section, e.g. on a worker thread of a pool
+def profiledCall(function, *arguments):
+    with processProfiler.section():
+        return function(*arguments)
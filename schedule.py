@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import heapq
+import math
+import re
+
+# defining constants
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DAY_SETS = {'daily': WEEKDAYS, 'weekdays': WEEKDAYS[:5], 'weekends': WEEKDAYS[5:]}
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+TIME_OF_DAY_PATTERN = re.compile(r'^([01]?[0-9]|2[0-3]):([0-5][0-9])$')
+MAX_DELAY = 366 * 24 * 3600 # seconds; the furthest a one-shot entry can be scheduled ahead
+
+class ScheduleEntry:
+    """
+    A named command for the sleep server that is due at a wall clock deadline.
+    One-shot entries run once; recurring ones run at a time of day (local time) on the given weekdays and are
+    rescheduled to their next occurrence every time they ran.
+    """
+
+    def __init__(self, name, command, deadline, timeOfDay = None, days = None):
+        # define members:
+        self.name = name
+        self.command = command
+        self.deadline = deadline # seconds since the epoch
+        self.timeOfDay = timeOfDay # 'HH:MM' of recurring entries
+        self.days = days # weekday numbers (0 = monday) of recurring entries
+        self.cancelled = False
+
+    def isRecurring(self):
+        return self.days is not None
+
+    # the first occurrence of the time of day after the given time on one of the entry's days; computed on the
+    # calendar, so daylight saving time changes don't shift it
+    def nextOccurrence(self, after, days = None):
+        hour, minute = [int(part) for part in self.timeOfDay.split(':')]
+        days = self.days if days is None else days
+        afterDate = datetime.fromtimestamp(after)
+        for dayOffset in range(8):
+            candidate = datetime.combine(afterDate.date() + timedelta(days = dayOffset), datetime.min.time()).replace(hour = hour, minute = minute)
+            if candidate.weekday() in days and candidate.timestamp() > after:
+                return candidate.timestamp()
+        return None
+
+    def asDictionary(self, now = None):
+        dictionary = {'name': self.name, 'command': self.command, 'deadline': round(self.deadline, 3)}
+        if self.isRecurring():
+            dictionary['at'] = self.timeOfDay
+            dictionary['days'] = [WEEKDAYS[day] for day in self.days]
+        if now is not None:
+            dictionary['next'] = datetime.fromtimestamp(int(self.deadline)).isoformat()
+            dictionary['nextIn'] = max(0, int(round(self.deadline - now)))
+        return dictionary
+
+
+# builds an entry from its API description; raises ValueError with a message for the client
+#   {'name': ..., 'command': {...}, 'in': [seconds]}                       once, after the given seconds
+#   {'name': ..., 'command': {...}, 'at': 'HH:MM'}                         once, at the next HH:MM
+#   {'name': ..., 'command': {...}, 'at': 'HH:MM', 'days': [...] | name}   at HH:MM on every given day
+def parseEntry(description, now):
+    if not isinstance(description, dict):
+        raise ValueError('a schedule entry is an object')
+    name = description.get('name')
+    if not isinstance(name, str) or not NAME_PATTERN.match(name):
+        raise ValueError('a schedule entry needs a name of up to 64 letters, digits, dots, dashes or underscores')
+    command = description.get('command')
+
+    if 'in' in description:
+        seconds = description['in']
+        # JSON lets Infinity, NaN and 1e20 through; their deadline has no date
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or not math.isfinite(seconds) or not 0 < seconds <= MAX_DELAY:
+            raise ValueError('bad delay value (seconds, at most ' + str(MAX_DELAY) + ')')
+        return ScheduleEntry(name, command, now + seconds)
+
+    timeOfDay = description.get('at')
+    if not isinstance(timeOfDay, str) or not TIME_OF_DAY_PATTERN.match(timeOfDay):
+        raise ValueError('a schedule entry needs a delay (in) or a time of day (at, HH:MM)')
+    timeOfDay = '%02d:%s' % (int(timeOfDay.split(':')[0]), timeOfDay.split(':')[1])
+
+    days = None
+    if 'days' in description:
+        days = parseDays(description['days'])
+    entry = ScheduleEntry(name, command, 0, timeOfDay, days)
+    entry.deadline = entry.nextOccurrence(now, days if days is not None else list(range(7)))
+    return entry
+
+def parseDays(days):
+    if isinstance(days, str):
+        days = DAY_SETS.get(days, [days])
+    if not isinstance(days, list) or not days or any(day not in WEEKDAYS for day in days):
+        raise ValueError('days are a list of ' + ', '.join(WEEKDAYS) + ' or one of ' + ', '.join(sorted(DAY_SETS)))
+    return sorted(set(WEEKDAYS.index(day) for day in days))
+
+# an entry stored by asDictionary
+def entryFromDictionary(dictionary):
+    days = None
+    if 'days' in dictionary:
+        days = parseDays(dictionary['days'])
+    deadline = float(dictionary['deadline'])
+    if not math.isfinite(deadline):
+        raise ValueError('bad deadline')
+    return ScheduleEntry(dictionary['name'], dictionary['command'], deadline, dictionary.get('at'), days)
+
+
+class Scheduler:
+    """
+    Schedule entries in a heap ordered by deadline, so finding the next due entry costs the same for 2 or 2000 of
+    them. Cancelled or replaced entries are only marked and skipped when they reach the top; the heap is rebuilt
+    when they make up half of it.
+    """
+
+    def __init__(self):
+        # define members:
+        self.heap = [] # (deadline, sequence number, entry)
+        self.entries = {} # name -> entry
+        self.sequence = 0
+        self.cancelledInHeap = 0
+        self.version = 0 # changes with every added, cancelled or run entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    # adds the entry; an entry of the same name is replaced
+    def add(self, entry):
+        if entry.name in self.entries:
+            self.cancel(entry.name)
+        self.entries[entry.name] = entry
+        self.push(entry)
+        self.version += 1
+
+    def push(self, entry):
+        self.sequence += 1
+        heapq.heappush(self.heap, (entry.deadline, self.sequence, entry))
+
+    # returns the cancelled entry or None
+    def cancel(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.version += 1
+            entry.cancelled = True
+            self.cancelledInHeap += 1
+            if self.cancelledInHeap * 2 > len(self.heap):
+                self.heap = [item for item in self.heap if not item[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelledInHeap = 0
+        return entry
+
+    def nextDeadline(self):
+        self.dropCancelledTop()
+        return self.heap[0][0] if self.heap else None
+
+    def dropCancelledTop(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelledInHeap -= 1
+
+    # removes and returns (deadline, entry) of the entries due at the given time in deadline order; recurring entries
+    # are put back with their next occurrence
+    def popDue(self, now):
+        dueEntries = []
+        self.dropCancelledTop()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, sequence, entry = heapq.heappop(self.heap)
+            dueEntries.append((deadline, entry))
+            if entry.isRecurring():
+                entry.deadline = entry.nextOccurrence(now)
+                self.push(entry)
+            else:
+                del self.entries[entry.name]
+            self.dropCancelledTop()
+        if dueEntries:
+            self.version += 1
+        return dueEntries
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def sortedEntries(self):
+        return sorted(self.entries.values(), key = lambda entry: entry.deadline)
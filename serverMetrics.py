@@ -0,0 +1,134 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from threading import Lock
+
+# defining constants
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # seconds
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+class Histogram:
+    def __init__(self, buckets):
+        # define members:
+        self.buckets = buckets
+        self.bucketCounts = [0] * (len(buckets) + 1) # the last one counts observations above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucketCounts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # (upper bound, cumulative count) pairs as used by Prometheus; the last bound is '+Inf'
+    def cumulativeBuckets(self):
+        cumulativeCount = 0
+        cumulative = []
+        for bound, bucketCount in zip(self.buckets + ['+Inf'], self.bucketCounts):
+            cumulativeCount += bucketCount
+            cumulative.append((bound, cumulativeCount))
+        return cumulative
+
+
+class ServerMetrics:
+    """
+    Counters and latency histograms of the server, shared by all threads.
+    Updating a value is one dictionary lookup and a bisect under a lock, cheap enough to be always on.
+    Labels are passed as a tuple of (name, value) pairs, e.g. (('route', 'status'),).
+    Gauges are read when the metrics are requested: a callable returns ((labels, value), ...).
+    """
+
+    def __init__(self):
+        # define members:
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {} # name -> callable
+
+    def increment(self, name, labels = (), amount = 1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels = ()):
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def addGauge(self, name, readValues):
+        with self.lock:
+            self.gauges[name] = readValues
+
+    # (name, labels, value) of every gauge, sorted; read outside the lock, a gauge may take locks of its own
+    def gaugeValues(self):
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+        return [(name, labels, value) for name, readValues in gauges for labels, value in readValues()]
+
+    def observeRequest(self, route, responseCode, duration):
+        self.increment('sleepapi_requests_total', (('route', route), ('code', str(responseCode))))
+        self.observe('sleepapi_request_duration_seconds', duration, (('route', route),))
+
+    def observeSystemCall(self, call, duration, failed):
+        self.observe('system_call_duration_seconds', duration, (('call', call),))
+        if failed:
+            self.increment('system_call_failures_total', (('call', call),))
+
+    def asDictionary(self):
+        gauges = {}
+        for name, labels, value in self.gaugeValues():
+            gauges.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'buckets': [[bound, count] for bound, count in histogram.cumulativeBuckets()],
+                })
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    # Prometheus text exposition format (version 0.0.4)
+    def asPrometheusText(self):
+        lines = []
+        lastName = None
+        for name, labels, value in self.gaugeValues():
+            if name != lastName:
+                lines.append('# TYPE ' + name + ' gauge')
+                lastName = name
+            lines.append(name + formatLabels(labels) + ' ' + str(value))
+
+        with self.lock:
+            lastName = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != lastName:
+                    lines.append('# TYPE ' + name + ' counter')
+                    lastName = name
+                lines.append(name + formatLabels(labels) + ' ' + str(value))
+
+            lastName = None
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != lastName:
+                    lines.append('# TYPE ' + name + ' histogram')
+                    lastName = name
+                for bound, count in histogram.cumulativeBuckets():
+                    lines.append(name + '_bucket' + formatLabels(labels + (('le', str(bound)),)) + ' ' + str(count))
+                lines.append(name + '_sum' + formatLabels(labels) + ' ' + repr(histogram.sum))
+                lines.append(name + '_count' + formatLabels(labels) + ' ' + str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + value + '"' for key, value in labels) + '}'
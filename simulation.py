@@ -0,0 +1,161 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+# Runs the sleep server in virtual time: API calls and timer expirations of hours take milliseconds, every mixer
+# write and sleep / shutdown event is recorded with its virtual time.
+#
+#   python3 simulation.py                      an 8 hour good night timer with a logarithmic fade
+#   python3 simulation.py setSilenceTime/3600 +1800 status run --trace
+#   python3 simulation.py 'POST:schedule={"name": "late", "at": "23:30", "command": {"set": "immediateSleep"}}' run
+#   python3 simulation.py setVolumeTargets/app:spotify,app:vlc setSilenceTime/600 run --trace
+
+from concurrent.futures import Future
+from datetime import datetime
+from time import perf_counter, time
+import argparse
+import json
+from clock import VirtualClock
+from audioBackends import FakeAudioBackend
+from systemControl import FakeSystemControl, completedFuture
+from sleepServer import SleepServer
+
+# defining constants
+MINIMUM_STEP = 0.000001 # seconds; a deadline's floating point residue can't stall the simulated loop
+IDLE_LIMIT = 7 * 24 * 3600 # seconds run() simulates at most; recurring schedule entries never get idle
+DEFAULT_STEPS = ['setGoodNightTime/28800/curve/logarithmic/fadeWindow/28800', 'run']
+
+class TracingAudioBackend(FakeAudioBackend):
+    # the in-memory mixer recording (virtual seconds, volume) of every write; with volume targets the volume is
+    # {target: volume}
+    def __init__(self, clock, volume):
+        FakeAudioBackend.__init__(self, volume)
+        self.clock = clock
+        self.volumeTrace = []
+
+    def setVolume(self, percent):
+        FakeAudioBackend.setVolume(self, percent)
+        self.volumeTrace.append((self.clock.monotonic(), percent))
+
+    def setVolumes(self, volumes):
+        FakeAudioBackend.setVolumes(self, volumes)
+        self.volumeTrace.append((self.clock.monotonic(), {target: round(volume, 2) for target, volume in volumes.items()}))
+
+
+class SimulatedSystemControl(FakeSystemControl):
+    """
+    The fake system control on the virtual clock: commands run inline (no worker threads), so the volume trace has
+    every write in order, and the volume isn't cached, so every read sees the simulated mixer.
+    """
+
+    def __init__(self, clock, volume):
+        FakeSystemControl.__init__(self, False, 0, commandWorkers = 0)
+        self.clock = clock
+        self.audioBackend = TracingAudioBackend(clock, volume)
+
+    def setSleep(self):
+        self.powerEvents.append((self.clock.monotonic(), 'sleep'))
+        return completedFuture(None)
+
+    def setShutdown(self):
+        self.powerEvents.append((self.clock.monotonic(), 'shutdown'))
+        return completedFuture(None)
+
+
+class Simulation:
+    """
+    A sleep server without threads or network, driven step by step: call() runs a sleepApi request through the same
+    route table as the network engines, advance() jumps the virtual clock from one timer event to the next.
+    """
+
+    def __init__(self, volume = 50, startTime = None):
+        # define members:
+        self.clock = VirtualClock(time() if startTime is None else startTime)
+        self.systemControl = SimulatedSystemControl(self.clock, volume)
+        self.server = SleepServer(self.clock, self.systemControl, startNetworkManager = False)
+        self.server.replyFuture = Future()
+        self.server.networkManager.commandBus = self # requests reach the simulated control loop directly
+        self.eventCount = 0
+
+        self.server.startControlLoop()
+        self.server.runDueEvents()
+
+    # the command bus of the network manager; the command is executed right away, like the control thread would
+    def request(self, command, timeout = None):
+        return self.command(command)
+
+    # a command dictionary (see SleepServer) -> its reply
+    def command(self, command):
+        reply = self.server.executeCommand(command)
+        self.server.runDueEvents()
+        return reply
+
+    # a sleepApi request, e.g. 'setVolume/30' -> (HTTP status, decoded answer or None)
+    def call(self, path, method = 'GET', body = b''):
+        if not path.startswith('/'):
+            path = '/sleepApi/' + path
+        responseCode, contentType, message, responseHeaders = self.server.networkManager.handleApiRequest(path, None, method, body)
+        return responseCode, json.loads(message.decode('UTF-8')) if message else None
+
+    # runs every timer event and schedule entry due within the next seconds
+    def advance(self, seconds):
+        target = self.clock.monotonic() + seconds
+        self.runEvents(target)
+        self.clock.advance(target - self.clock.monotonic())
+
+    # runs until no timer or schedule entry is left (at most IDLE_LIMIT seconds)
+    def run(self):
+        self.runEvents(self.clock.monotonic() + IDLE_LIMIT)
+
+    def runEvents(self, target):
+        while True:
+            wait = self.server.secondsToNextTimerEvent()
+            if wait is None or self.clock.monotonic() + wait > target:
+                return
+            self.clock.advance(max(wait, MINIMUM_STEP))
+            self.server.runDueEvents()
+            self.eventCount += 1
+
+    # (virtual seconds since the start, volume) of every mixer write
+    def volumeTrace(self):
+        return self.systemControl.audioBackend.volumeTrace
+
+    # (virtual seconds since the start, 'sleep' | 'shutdown')
+    def powerEvents(self):
+        return self.systemControl.powerEvents
+
+
+# runs the steps: an API path (GET), METHOD:path[=JSON body], +[seconds] to advance the clock or run (until idle)
+def runSteps(simulation, steps, printAnswers):
+    for step in steps:
+        if step.startswith('+'):
+            simulation.advance(float(step[1:]))
+        elif step == 'run':
+            simulation.run()
+        else:
+            method, separator, path = step.partition(':') if step.split(':', 1)[0].isupper() else ('GET', '', step)
+            path, separator, body = path.partition('=')
+            responseCode, answer = simulation.call(path, method, body.encode('UTF-8'))
+            if printAnswers:
+                print('%8.1f s  %-6s %-45s %d %s' % (simulation.clock.monotonic(), method, path, responseCode, json.dumps(answer)))
+
+# check if this code is run as a module or was included into another project
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs the SleepServer in virtual time.")
+    parser.add_argument("steps", nargs = '*', help = "API paths, METHOD:path=[JSON body], +[seconds] or run (default: an 8 hour good night timer)")
+    parser.add_argument("--volume", type=float, default = 50, help = "initial volume of the simulated mixer (default 50)")
+    parser.add_argument("--start", help = "virtual start time as YYYY-MM-DDTHH:MM (default now)")
+    parser.add_argument("--trace", action = "store_true", help = "prints every mixer write")
+    args = parser.parse_args()
+
+    startTime = datetime.strptime(args.start, '%Y-%m-%dT%H:%M').timestamp() if args.start else None
+    startupTime = perf_counter()
+    simulation = Simulation(args.volume, startTime)
+    runSteps(simulation, args.steps or DEFAULT_STEPS, True)
+    realTime = perf_counter() - startupTime
+
+    if args.trace:
+        for virtualTime, volume in simulation.volumeTrace():
+            print('%8.1f s  volume %s' % (virtualTime, volume))
+    for virtualTime, event in simulation.powerEvents():
+        print('%8.1f s  %s' % (virtualTime, event))
+    print('simulated %.1f hours in %.1f ms: %d timer events, %d mixer writes, %d power events' %
+          (simulation.clock.monotonic() / 3600, realTime * 1000, simulation.eventCount, len(simulation.volumeTrace()), len(simulation.powerEvents())))
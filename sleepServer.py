@@ -2,14 +2,27 @@
 # -*- coding: utf-8 -*-
 # Read the description.md for a basic understanding of the server API.
 
-from threading import Thread, Event, Timer
-from queue import Queue
-from daemonize import Daemonize
-import argparse
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread, Event
+from concurrent.futures import Future, TimeoutError as CommandTimeout
+from time import perf_counter
+import math
 import json
-import pprint
-from systemControl import SystemControl
+import os
+import traceback
+from urllib.parse import quote, urlencode
+from systemControl import SystemControl, FakeSystemControl, SESSION_BACKEND, SUBPROCESS_BACKEND, FAKE_BACKEND
+from audioBackends import parseVolumeTargets
+from commandBus import CommandBus, CommandFailed
+from admissionControl import ClientRateLimiter, CommandQueueFull, retryAfterHeader
+from serverMetrics import ServerMetrics, PROMETHEUS_CONTENT_TYPE
+from statusStream import StatusPublisher
+from volumeRamp import VolumeRamp, FADE_CURVES, LINEAR_CURVE
+from apiRouter import ApiRouter, ApiRequest, positiveInt
+from timerState import TimerStateFile, defaultStatePath
+from clock import SystemClock
+from schedule import Scheduler, parseEntry, entryFromDictionary
+from profiling import processProfiler
+# the network engines, fleet, multi-process and daemon mode import their modules when they are used, to keep the start fast
 
 
 class IssetHelper:
@@ -29,6 +42,14 @@ class IssetHelper:
         else:
             return True
 
+    # an actual integer > 0, as decoded from JSON (no string, no boolean)
+    def isPositiveInteger(self, value):
+        return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+    # timer times and fade windows are whole seconds up to MAX_TIMER_TIME
+    def isTimerTime(self, value):
+        return self.isPositiveInteger(value) and value <= MAX_TIMER_TIME
+
     def isFloat(self, floatingValue):
         try:
             float(floatingValue)
@@ -37,371 +58,973 @@ class IssetHelper:
         else:
             return True
 
-    def isValueForIndex(self, array, valueForIndex):
-        try:
-            array.index(valueForIndex)
-        except ValueError:
-            return False
-        else:
-            return True
 
-    # return a positive (and > 0) integer (the one that comes next in the array) or -1
-    def getIntAfterToken(self, array, token):
-        if (self.isValueForIndex(array, token) and
-            self.isInt(array[array.index(token) + 1]) and
-            int(array[array.index(token) + 1]) > 0):
+class AsyncNetworkManager(Thread, IssetHelper):
+    def __init__(self, commandBus, metrics, statusPublisher, clock):
+        # define members:
+        self.commandBus = commandBus
+        self.clock = clock
+        self.metrics = metrics
+        self.statusPublisher = statusPublisher
+        self.statusResponseCache = (None, None, None) # (version, time left, encoded JSON) of the last status response
+        self.fleet = None
+        if FLEET_PEERS:
+            from fleet import FleetCoordinator
+            self.fleet = FleetCoordinator(FLEET_PEERS, FLEET_TIMEOUT, metrics)
+        self.router = self.buildRouter()
+        self.rateLimiter = ClientRateLimiter(CLIENT_REQUEST_RATE, CLIENT_REQUEST_BURST, clock) if CLIENT_REQUEST_RATE > 0 else None
+        self.emergencyRateLimiter = ClientRateLimiter(EMERGENCY_REQUEST_RATE, EMERGENCY_REQUEST_BURST, clock) if EMERGENCY_REQUEST_RATE > 0 else None
+        self.listeningSocket = None # set for HTTP worker processes, which share the port
 
-            return int(array[array.index(token) + 1])
-        return -1
+        # inital method calls
+        Thread.__init__(self)
+
+    def run(self):
+        if NETWORK_ENGINE == ASYNCIO_ENGINE:
+            self.runAsyncioServer()
+        else:
+            self.runHTTPServer()
 
-    # return a positive float (the one that comes next in the array) or -1.0
-    def getFloatAfterToken(self, array, token):
-        if (self.isValueForIndex(array, token) and
-            self.isFloat(array[array.index(token) + 1]) and
-            float(array[array.index(token) + 1]) >= 0):
+    def runHTTPServer(self):
+        from threadedServer import HTTPHandler, SleepHTTPServer
+        httpHandler = HTTPHandler
+        httpHandler.setSleepServer(httpHandler, self)
+        httpHandler.timeout = CONNECTION_READ_TIMEOUT
+        httpHandler.maxBodySize = MAX_REQUEST_BODY_SIZE
+        httpHandler.beVerbose = BE_VERBOSE
 
-            return float(array[array.index(token) + 1])
-        return -1.0
+        try:
+            # Create a web server and define the handler to manage the incoming request;
+            # every (persistent) connection gets its own thread, so one client can't block the others
+            if self.listeningSocket is None:
+                server = SleepHTTPServer(('', HTTPSERVERPORT), httpHandler)
+            else:
+                server = SleepHTTPServer(('', HTTPSERVERPORT), httpHandler, bind_and_activate = False)
+                server.socket.close()
+                server.socket = self.listeningSocket
+            server.daemon_threads = True
+            print('SleepServer is up and running at port:', HTTPSERVERPORT)
 
+            # Wait forever for incoming http requests
+            server.serve_forever()
 
-class HTTPHandler(BaseHTTPRequestHandler, IssetHelper):
-    def setSleepServer(self, networkManager):
-        self.networkManager = networkManager
+        except KeyboardInterrupt:
+            print(' AsyncNetworkManager: received interrupt signal; shutting down the HTTP server')
+            server.socket.close()
 
-    def prepareResourceElements(self):
-        self.resourceElements = []
-        self.jsonpCallback = ''
+    def runAsyncioServer(self):
+        from asyncioServer import AsyncioHTTPServer
+        server = AsyncioHTTPServer(self.handleApiRequest, HTTPSERVERPORT, CONNECTION_READ_TIMEOUT, BE_VERBOSE, self.streamApiRequest,
+                                   MAX_REQUEST_BODY_SIZE, self.listeningSocket)
+        print('SleepServer is up and running at port:', HTTPSERVERPORT, '(asyncio engine)')
 
-        for element in self.path.split('/'):
-            if 'callback' in element:
-                secondArgumentPosition = element.find('&')
-                self.jsonpCallback = element[10:secondArgumentPosition]
-            else:
-                self.resourceElements.append(element)
-
-    def do_GET(self):
-        self.prepareResourceElements()
-        returnDict = {}
-        if 'sleepApi' in self.resourceElements:
-
-            # set requests:
-            if 'immediateSleep' in self.resourceElements:
-                returnDict = self.networkManager.sleepServerRequest({'set': 'immediateSleep'})
-                self.send_response(202)
-
-            # set sleep time
-            elif 'setSleepTime' in self.resourceElements:
-                time = self.getIntAfterToken(self.resourceElements, 'setSleepTime') # identify sleep time
-                if time > 0:
-                    returnDict = self.networkManager.sleepServerRequest({'set': 'sleepTimer', 'time': time})
-                    self.send_response(202)
-                else:
-                    if BE_VERBOSE: print('NetworkManager: error parsing sleep time')
-                    returnDict = {'error': 'bad sleep time value'}
-                    self.send_response(400)
-
-            # set silence time
-            elif 'setSilenceTime' in self.resourceElements:
-                time = self.getIntAfterToken(self.resourceElements, 'setSilenceTime') # identify silence time
-                if time > 0:
-                    returnDict = self.networkManager.sleepServerRequest({'set': 'silenceTimer', 'time': time})
-                    self.send_response(202)
-                else:
-                    if BE_VERBOSE: print('NetworkManager: error parsing silence time')
-                    returnDict = {'error': 'bad silence time value'}
-                    self.send_response(400)
-
-            # set good night time
-            elif 'setGoodNightTime' in self.resourceElements:
-                time = self.getIntAfterToken(self.resourceElements, 'setGoodNightTime') # identify good night time
-                if time:
-                    returnDict = self.networkManager.sleepServerRequest({'set': 'goodNightTimer', 'time': time})
-                    self.send_response(202)
-                else:
-                    if BE_VERBOSE: print('NetworkManager: error parsing good night time')
-                    returnDict = {'error': 'bad good night time value'}
-                    self.send_response(400)
-
-            # set volume
-            elif 'setVolume' in self.resourceElements:
-                volume = self.getFloatAfterToken(self.resourceElements, 'setVolume') # identify the volume value
-                if volume >= 0:
-                    returnDict = self.networkManager.sleepServerRequest({'set': 'volume', 'percent': volume})
-                    self.send_response(202)
-                else:
-                    if BE_VERBOSE: print('NetworkManager: error parsing the volume percentage')
-                    returnDict = {'error': 'bad volume value'}
-                    self.send_response(400)
-
-            # unset / reset requests:
-            elif 'reset' in self.resourceElements:
-                returnDict = self.networkManager.sleepServerRequest({'unset': 'timer'})
-                self.send_response(202)
-
-            # status requests:
-            elif 'status' in self.resourceElements:
-                returnDict = self.networkManager.sleepServerRequest({'get': 'status'})
-                self.send_response(200)
-
-        # error handling for all other requests:
-        if returnDict == {}:
+        try:
+            server.serveForever()
+        except KeyboardInterrupt:
+            print(' AsyncNetworkManager: received interrupt signal; shutting down the asyncio server')
+            server.close()
+
+    # the sleepApi route table; handlers take an ApiRequest and return the response code, content type, encoded
+    # message and extra headers. Stream handlers are used by the asyncio engine instead
+    def buildRouter(self):
+        router = ApiRouter({'fadeCurve': self.parseFadeCurve, 'timerTime': self.parseTimerTime})
+        fadeOptions = {'curve': 'fadeCurve', 'fadeWindow': 'timerTime'}
+
+        # metrics are answered by the network thread itself, independent of the sleep server's load
+        router.addRoute('metrics', self.answerMetrics)
+        router.addRoute('metrics/prometheus', self.answerPrometheusMetrics)
+
+        # set requests; immediate sleep and reset have their own rate limit and go ahead of every other command
+        router.addRoute('immediateSleep', self.answerImmediateSleep, emergency = True)
+        router.addRoute('setSleepTime/{time:timerTime}', self.answerSetSleepTime,
+                        errorMessage = 'bad sleep time value')
+        router.addRoute('setSilenceTime/{time:timerTime}', self.answerSetSilenceTime, options = fadeOptions,
+                        errorMessage = 'bad silence time value')
+        router.addRoute('setGoodNightTime/{time:timerTime}', self.answerSetGoodNightTime, options = fadeOptions,
+                        errorMessage = 'bad good night time value')
+        router.addRoute('setVolume/{percent:nonNegativeFloat}', self.answerSetVolume,
+                        errorMessage = 'bad volume value')
+        # what the volume (and every fade) controls: master, sink:[name] or app:[name], comma separated
+        router.addRoute('setVolumeTargets/{targets:text}', self.answerSetVolumeTargets, errorMessage = 'missing volume targets')
+        router.addRoute('volumeTargets', self.answerVolumeTargets)
+
+        # unset / reset requests
+        router.addRoute('reset', self.answerReset, emergency = True)
+
+        # several commands (JSON list of sleep server commands) executed as one
+        router.addRoute('batch', self.answerBatch, methods = ('POST',))
+
+        # named timers and recurring schedules: GET lists, POST (JSON entry) adds, DELETE sleepApi/schedule/[name] cancels
+        router.addRoute('schedule', self.answerSchedule, methods = ('GET', 'POST'))
+        router.addRoute('schedule/{name:text}', self.answerScheduleEntry, name = 'scheduleEntry', methods = ('GET', 'DELETE'))
+
+        # profiling of this process, only with the profile token in an 'Authorization: Bearer [token]' header (a query
+        # parameter would end up in the request log and the route cache): sleepApi/profile/start?seconds=[int]&memory=1,
+        # then sleepApi/profile/cpu or sleepApi/profile/memory (format=text or file)
+        if PROFILE_TOKEN:
+            profileOptions = {'seconds': 'positiveInt', 'memory': 'nonNegativeInt', 'format': 'text'}
+            router.addRoute('profile', self.answerProfile, options = profileOptions)
+            router.addRoute('profile/start', self.answerProfileStart, name = 'profileStart', options = profileOptions)
+            router.addRoute('profile/stop', self.answerProfileStop, name = 'profileStop', options = profileOptions)
+            router.addRoute('profile/cpu', self.answerProfileCpu, name = 'profileCpu', options = profileOptions)
+            router.addRoute('profile/memory', self.answerProfileMemory, name = 'profileMemory', options = profileOptions)
+
+        # fleet mode: sleepApi/fleet/[task] is forwarded to every peer as sleepApi/[task]
+        if self.fleet is not None:
+            router.addRoute('fleet/{path:rest}', self.answerFleet, methods = ('GET', 'POST', 'DELETE'), errorMessage = 'missing fleet task')
+
+        # status requests; the stream and the long poll wait in the asyncio engine, the threaded engine has no stream
+        # and lets a long poll (status/since/[version]) wait in its request thread
+        router.addRoute('stream', self.answerStream, streamHandler = self.streamStatusEvents)
+        router.addRoute('status', self.answerStatusRequest)
+        router.addRoute('status/since/{version:nonNegativeInt}', self.answerVersionedStatus, name = 'longPoll',
+                        streamHandler = self.streamLongPoll, errorMessage = 'bad status version')
+        return router
+
+    def parseFadeCurve(self, segment):
+        return segment if segment in FADE_CURVES else None
+
+    def parseTimerTime(self, segment):
+        seconds = positiveInt(segment)
+        return seconds if self.isTimerTime(seconds) else None
+
+    # parse a request path, ask the sleep server and return the response code, content type and encoded message;
+    # this is independent of the serving engine, so every engine answers the same routes. Requests without a client
+    # address (the simulation) aren't rate limited
+    def handleApiRequest(self, path, ifNoneMatch = None, method = 'GET', body = b'', clientAddress = None, authorization = None):
+        startTime = perf_counter()
+        with processProfiler.section():
+            route, responseCode, contentType, message, responseHeaders = self.answerApiRequest(path, ifNoneMatch, method, body, clientAddress, authorization)
+        self.metrics.observeRequest(route, responseCode, perf_counter() - startTime)
+        return responseCode, contentType, message, responseHeaders
+
+    def answerApiRequest(self, path, ifNoneMatch, method, body, clientAddress, authorization):
+        match = self.router.match(path)
+        if match is None:
             if BE_VERBOSE: print('NetworkManager: request with unrecognized arguments')
-            returnDict = {'error': 'wrong address, wrong parameters or no such resource'}
-            self.send_response(404)
+            return ('notFound',) + self.jsonResponse(404, {'error': 'wrong address, wrong parameters or no such resource'}, '')
+
+        if match.parameters is None:
+            if BE_VERBOSE: print('NetworkManager: error parsing the parameters of a', match.route.name, 'request')
+            return (match.route.name,) + self.jsonResponse(400, {'error': match.route.errorMessage}, match.jsonpCallback)
+
+        if method not in match.route.methods:
+            responseCode, contentType, message, responseHeaders = self.jsonResponse(405, {'error': 'method not allowed'}, match.jsonpCallback)
+            responseHeaders['Allow'] = ', '.join(match.route.methods)
+            return match.route.name, responseCode, contentType, message, responseHeaders
+
+        # a client over its rate gets 429 before anything is parsed or queued
+        rateLimiter = self.rateLimiterFor(match.route)
+        if rateLimiter is not None and clientAddress is not None:
+            waitTime = rateLimiter.admit(clientAddress)
+            if waitTime > 0:
+                self.metrics.increment('requests_rate_limited_total', (('route', match.route.name),))
+                responseCode, contentType, message, responseHeaders = self.jsonResponse(429, {'error': 'too many requests'}, match.jsonpCallback)
+                responseHeaders['Retry-After'] = retryAfterHeader(waitTime)
+                return match.route.name, responseCode, contentType, message, responseHeaders
+
+        request = ApiRequest(match.parameters, match.jsonpCallback, ifNoneMatch, method, body, authorization)
+        try:
+            return (match.route.name,) + match.route.handler(request)
+        except CommandQueueFull as error:
+            if BE_VERBOSE: print('NetworkManager:', error)
+            responseCode, contentType, message, responseHeaders = self.jsonResponse(503, {'error': 'sleep server busy, retry later'}, match.jsonpCallback)
+            responseHeaders['Retry-After'] = retryAfterHeader(error.retryAfter)
+            return match.route.name, responseCode, contentType, message, responseHeaders
+        except CommandFailed:
+            return (match.route.name,) + self.jsonResponse(500, {'error': 'sleep server failed to execute the command'}, match.jsonpCallback)
+        except CommandTimeout:
+            if BE_VERBOSE: print('NetworkManager: no reply of the sleep server within', COMMAND_REPLY_TIMEOUT, 'seconds')
+            return (match.route.name,) + self.jsonResponse(504, {'error': 'sleep server didn\'t answer in time'}, match.jsonpCallback)
 
-        # create a message that may be encapsulated in a JSONP callback function
-        if self.jsonpCallback != '':
-            self.send_header('Content-type', 'application/text')
-            jsonMessage = json.dumps(returnDict, ensure_ascii = False)
-            message = self.jsonpCallback + '(' + jsonMessage + ');'
-        else:
-            self.send_header('Content-type', 'application/json')
-            message = json.dumps(returnDict, ensure_ascii = False)
+    # emergency routes have their own, more generous buckets
+    def rateLimiterFor(self, route):
+        return self.emergencyRateLimiter if route.emergency else self.rateLimiter
 
-        self.end_headers()
+    def jsonResponse(self, responseCode, returnDict, jsonpCallback):
+        contentType, message = self.encodeMessage(returnDict, jsonpCallback)
+        return responseCode, contentType, message, {}
 
-        try:
-            self.wfile.write(bytes(message, 'UTF-8'))
-        except BrokenPipeError:
-            if BE_VERBOSE: print('NetworkManager: current connection failed (broken pipe)')
-        return
+    def answerMetrics(self, request):
+        return self.jsonResponse(200, self.metrics.asDictionary(), request.jsonpCallback)
 
+    def answerPrometheusMetrics(self, request):
+        return 200, PROMETHEUS_CONTENT_TYPE, bytes(self.metrics.asPrometheusText(), 'UTF-8'), {}
 
+    def answerImmediateSleep(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest({'set': 'immediateSleep'}), request.jsonpCallback)
 
-class AsyncNetworkManager(Thread, IssetHelper):
-    def __init__(self, queue, serverEvent, event):
-        # define members:
-        self.communicationQueue = queue
-        self.serverEvent = serverEvent
-        self.networkEvent = event
+    def answerSetSleepTime(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest({'set': 'sleepTimer', 'time': request.parameters['time']}), request.jsonpCallback)
 
-        # inital method calls
-        Thread.__init__(self)
+    # the parameters hold the time and the optional fade settings (curve, fadeWindow)
+    def answerSetSilenceTime(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest(dict(request.parameters, set = 'silenceTimer')), request.jsonpCallback)
 
-    def run(self):
-        httpHandler = HTTPHandler
-        httpHandler.setSleepServer(httpHandler, self)
+    def answerSetGoodNightTime(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest(dict(request.parameters, set = 'goodNightTimer')), request.jsonpCallback)
+
+    def answerSetVolume(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest({'set': 'volume', 'percent': request.parameters['percent']}), request.jsonpCallback)
 
+    def answerSetVolumeTargets(self, request):
         try:
-            # Create a web server and define the handler to manage the incoming request
-            server = HTTPServer(('', HTTPSERVERPORT), httpHandler)
-            print('SleepServer is up and running at port:', HTTPSERVERPORT)
+            targets = parseVolumeTargets(request.parameters['targets'])
+        except ValueError as error:
+            return self.jsonResponse(400, {'error': str(error)}, request.jsonpCallback)
+        returnDict = self.sleepServerRequest({'set': 'volumeTargets', 'targets': targets})
+        return self.jsonResponse(409 if self.isset(returnDict, 'error') else 202, returnDict, request.jsonpCallback)
 
-            # Wait forever for incoming http requests
-            server.serve_forever()
+    def answerVolumeTargets(self, request):
+        return self.jsonResponse(200, self.sleepServerRequest({'get': 'volumeTargets'}), request.jsonpCallback)
 
-        except KeyboardInterrupt:
-            print(' AsyncNetworkManager: received interrupt signal; shutting down the HTTP server')
-            server.socket.close()
+    def answerReset(self, request):
+        return self.jsonResponse(202, self.sleepServerRequest({'unset': 'timer'}), request.jsonpCallback)
 
-    def sleepServerRequest(self, message):
-        # send status request to sleep server via communication queue
-        self.communicationQueue.put(message)
-        self.serverEvent.set()
+    # the commands are checked here, so a malformed batch is refused before any of it is executed
+    def answerBatch(self, request):
+        try:
+            commands = json.loads(request.body.decode('UTF-8'))
+        except ValueError:
+            return self.jsonResponse(400, {'error': 'batch body is no valid JSON'}, request.jsonpCallback)
+
+        if isinstance(commands, dict):
+            commands = commands.get('commands')
+        if not isinstance(commands, list) or not 0 < len(commands) <= MAX_BATCH_COMMANDS:
+            return self.jsonResponse(400, {'error': 'a batch is a list of 1 to ' + str(MAX_BATCH_COMMANDS) + ' commands'}, request.jsonpCallback)
+
+        for position, command in enumerate(commands):
+            error = self.checkBatchCommand(command, position == len(commands) - 1)
+            if error is not None:
+                return self.jsonResponse(400, {'error': error, 'command': position}, request.jsonpCallback)
+
+        returnDict = self.sleepServerRequest({'batch': commands})
+        return self.jsonResponse(409 if self.isset(returnDict, 'error') else 202, returnDict, request.jsonpCallback)
+
+    # returns an error message or None for commands the sleep server can execute as part of a batch
+    def checkBatchCommand(self, command, isLastCommand):
+        if not isinstance(command, dict):
+            return 'a command is an object'
+        if command.get('set') == 'immediateSleep':
+            return None if isLastCommand else 'immediateSleep has to be the last command'
+        if command.get('set') in ['sleepTimer', 'silenceTimer', 'goodNightTimer']:
+            if not self.isTimerTime(command.get('time')):
+                return 'bad time value'
+            if command['set'] != 'sleepTimer':
+                if 'curve' in command and command['curve'] not in FADE_CURVES:
+                    return 'bad fade curve'
+                if 'fadeWindow' in command and not self.isTimerTime(command['fadeWindow']):
+                    return 'bad fade window'
+            return None
+        if command.get('set') == 'volume':
+            percent = command.get('percent')
+            if isinstance(percent, bool) or not isinstance(percent, (int, float)) or not percent >= 0:
+                return 'bad volume value'
+            return None
+        if command.get('set') == 'volumeTargets':
+            try:
+                parseVolumeTargets(command.get('targets'))
+            except ValueError as error:
+                return str(error)
+            return None
+        if command.get('unset') == 'timer' or command.get('get') == 'status':
+            return None
+        return 'unrecognized command'
+
+    # the entry's command is checked like a batch command (a list of commands is run as a batch), so a schedule can't
+    # hold anything the sleep server would refuse when it's due
+    def answerSchedule(self, request):
+        if request.method == 'GET':
+            return self.jsonResponse(200, self.sleepServerRequest({'get': 'schedule'}), request.jsonpCallback)
 
-        # wait for answer & process it
-        self.networkEvent.wait()
-        self.networkEvent.clear()
+        try:
+            description = json.loads(request.body.decode('UTF-8'))
+        except ValueError:
+            return self.jsonResponse(400, {'error': 'schedule entry body is no valid JSON'}, request.jsonpCallback)
+        try:
+            parseEntry(description, self.clock.time())
+        except ValueError as error:
+            return self.jsonResponse(400, {'error': str(error)}, request.jsonpCallback)
+
+        commands = description.get('command')
+        if not isinstance(commands, list):
+            commands = [commands]
+        if not 0 < len(commands) <= MAX_BATCH_COMMANDS:
+            return self.jsonResponse(400, {'error': 'a schedule entry runs 1 to ' + str(MAX_BATCH_COMMANDS) + ' commands'}, request.jsonpCallback)
+        for position, command in enumerate(commands):
+            error = self.checkBatchCommand(command, position == len(commands) - 1)
+            if error is not None:
+                return self.jsonResponse(400, {'error': error, 'command': position}, request.jsonpCallback)
+
+        returnDict = self.sleepServerRequest({'schedule': 'add', 'entry': description})
+        return self.jsonResponse(409 if self.isset(returnDict, 'error') else 202, returnDict, request.jsonpCallback)
+
+    def answerScheduleEntry(self, request):
+        if request.method == 'DELETE':
+            returnDict = self.sleepServerRequest({'schedule': 'cancel', 'name': request.parameters['name']})
+            responseCode = 202
+        else:
+            returnDict = self.sleepServerRequest({'get': 'schedule', 'name': request.parameters['name']})
+            responseCode = 200
+        return self.jsonResponse(404 if self.isset(returnDict, 'error') else responseCode, returnDict, request.jsonpCallback)
+
+    # the profile routes are answered by the network thread itself, so a capture can be started and read while the
+    # control thread is busy
+    def answerProfile(self, request):
+        if not self.isProfileTokenValid(request):
+            return self.profileTokenError(request)
+        if processProfiler.lastCapture is None:
+            return self.jsonResponse(404, {'error': 'nothing was profiled yet'}, request.jsonpCallback)
+        return self.jsonResponse(200, {'capture': processProfiler.lastCapture.asDictionary()}, request.jsonpCallback)
+
+    def answerProfileStart(self, request):
+        if not self.isProfileTokenValid(request):
+            return self.profileTokenError(request)
+        try:
+            capture = processProfiler.start(request.parameters.get('seconds', DEFAULT_PROFILE_TIME), bool(request.parameters.get('memory')))
+        except ValueError as error: # another profiling tool (a debugger, a profiler run from outside) is active
+            return self.jsonResponse(409, {'error': 'can\'t profile: ' + str(error)}, request.jsonpCallback)
+        if capture is None:
+            return self.jsonResponse(409, {'error': 'a profile capture is running', 'capture': processProfiler.lastCapture.asDictionary()}, request.jsonpCallback)
+        if BE_VERBOSE: print('NetworkManager: profiling for', capture.seconds, 'seconds')
+        return self.jsonResponse(202, {'capture': capture.asDictionary()}, request.jsonpCallback)
+
+    def answerProfileStop(self, request):
+        if not self.isProfileTokenValid(request):
+            return self.profileTokenError(request)
+        capture = processProfiler.stop()
+        if capture is None:
+            return self.jsonResponse(409, {'error': 'no profile capture is running'}, request.jsonpCallback)
+        return self.jsonResponse(200, {'capture': capture.asDictionary()}, request.jsonpCallback)
+
+    def answerProfileCpu(self, request):
+        return self.answerProfileResult(request, 'cpu.pstats', lambda capture: (capture.cpuReport, capture.cpuStats))
+
+    def answerProfileMemory(self, request):
+        return self.answerProfileResult(request, 'memory.snapshot', lambda capture: (capture.memoryReport, capture.memorySnapshot))
+
+    # the text report of the last capture or, with format=file, its pstats / tracemalloc snapshot file
+    def answerProfileResult(self, request, kind, readResults):
+        if not self.isProfileTokenValid(request):
+            return self.profileTokenError(request)
+        capture = processProfiler.lastCapture
+        if capture is None:
+            return self.jsonResponse(404, {'error': 'nothing was profiled yet'}, request.jsonpCallback)
+        if not capture.resultsReady.is_set():
+            return self.jsonResponse(409, {'error': 'the profile capture is still running', 'capture': capture.asDictionary()}, request.jsonpCallback)
+
+        report, resultFile = readResults(capture)
+        if report is None:
+            return self.jsonResponse(404, {'error': 'the last capture didn\'t trace memory (memory=1)'}, request.jsonpCallback)
+        if request.parameters.get('format') == 'file':
+            return 200, 'application/octet-stream', resultFile, {'Content-Disposition': 'attachment; filename="' + capture.fileName(kind) + '"'}
+        return 200, 'text/plain; charset=utf-8', report.encode('UTF-8'), {}
+
+    def isProfileTokenValid(self, request):
+        import hmac
+        scheme, _, token = (request.authorization or '').strip().partition(' ')
+        if scheme.lower() != 'bearer':
+            return False
+        return hmac.compare_digest(token.strip().encode('UTF-8'), PROFILE_TOKEN.encode('UTF-8'))
+
+    def profileTokenError(self, request):
+        return self.jsonResponse(403, {'error': 'missing or wrong profile token'}, request.jsonpCallback)
+
+    # the answer of every peer (or why it failed) and a count of the peers per status; HTTP 207 if some peers failed
+    def answerFleet(self, request):
+        path = request.parameters['path']
+        if path.split('/')[0] == 'stream' or '/since/' in '/' + path + '/':
+            return self.jsonResponse(400, {'error': 'streams and long polls are not forwarded to the fleet'}, request.jsonpCallback)
+        # a coordinator among its own peers would forward to itself and wait for its own fleet executor
+        if path.split('/')[0] == 'fleet':
+            return self.jsonResponse(400, {'error': 'fleet requests are not forwarded to the fleet'}, request.jsonpCallback)
+
+        peerPath = '/sleepApi/' + quote(path)
+        if request.parameters['query']:
+            peerPath += '?' + urlencode(request.parameters['query'])
+        answers, failures = self.fleet.forward(request.method, peerPath, request.body or None)
+        if BE_VERBOSE: print('NetworkManager: fleet request answered by', len(answers), 'peers,', len(failures), 'failed')
+
+        if not answers:
+            responseCode = 502
+        elif failures or any(peerCode >= 400 for peerCode, answer in answers.values()):
+            responseCode = 207
+        else:
+            responseCode = 200
+        return self.jsonResponse(responseCode, self.fleet.aggregate(answers, failures), request.jsonpCallback)
+
+    def answerStream(self, request):
+        return self.jsonResponse(501, {'error': 'status streaming needs the asyncio engine (-e asyncio)'}, request.jsonpCallback)
+
+    # the long poll of the threaded engine; the request thread waits for the change like the asyncio engine's coroutine
+    def answerVersionedStatus(self, request):
+        if self.statusPublisher.current()[1] is None:
+            self.sleepServerRequest({'get': 'status'}) # publishes the first status
+        version, snapshot, changed = self.statusPublisher.waitForChangeBlocking(request.parameters['version'], LONG_POLL_TIMEOUT)
+        return self.jsonResponse(200, self.versionedStatus(version, snapshot), request.jsonpCallback)
+
+    # status requests are answered from the published status without a round trip to the sleep server, as long as
+    # its volume is younger than the volume cache TTL; the encoded response is reused until the status changes
+    def answerStatusRequest(self, request):
+        version, snapshot, verifiedAt = self.statusPublisher.liveStatus()
+        if snapshot is None or self.clock.monotonic() - verifiedAt >= VOLUME_CACHE_TTL:
+            self.sleepServerRequest({'get': 'status'}) # refreshes the volume and publishes the status
+            version, snapshot, verifiedAt = self.statusPublisher.liveStatus()
+
+        timeLeft = snapshot.get('timeToSleep', snapshot.get('timeToSilence', -1))
+        entityTag = '"' + str(version) + '-' + str(timeLeft) + '"'
+        responseHeaders = {'ETag': entityTag, 'Cache-Control': 'no-cache'}
+
+        contentType = self.encodeMessage({}, request.jsonpCallback)[0]
+        if request.ifNoneMatch is not None and (request.ifNoneMatch.strip() == '*' or entityTag in [tag.strip() for tag in request.ifNoneMatch.split(',')]):
+            return 304, contentType, b'', responseHeaders
+
+        # only the JSON of the latest status is kept, the JSONP callback is wrapped around it per request; the cache is
+        # replaced as a whole, so a request thread still encoding an older status can't spoil it
+        cachedVersion, cachedTimeLeft, message = self.statusResponseCache
+        if cachedVersion != version or cachedTimeLeft != timeLeft:
+            message = self.encodeMessage(snapshot, '')[1]
+            self.statusResponseCache = (version, timeLeft, message)
+        if request.jsonpCallback != '':
+            message = request.jsonpCallback.encode('UTF-8') + b'(' + message + b');'
+        return 200, contentType, message, responseHeaders
+
+    # create a message that may be encapsulated in a JSONP callback function
+    def encodeMessage(self, returnDict, jsonpCallback):
+        if jsonpCallback != '':
+            contentType = 'application/text'
+            jsonMessage = json.dumps(returnDict, ensure_ascii = False)
+            message = jsonpCallback + '(' + jsonMessage + ');'
+        else:
+            contentType = 'application/json'
+            message = json.dumps(returnDict, ensure_ascii = False)
+        return contentType, bytes(message, 'UTF-8')
+
+    # push requests of the asyncio engine; returns None for every other request:
+    # sleepApi/stream (server-sent events) and sleepApi/status/since/[version] (long poll).
+    # A client over its rate gets None as well; the regular request answers it with 429 (a refused token isn't taken)
+    def streamApiRequest(self, path, clientAddress = None):
+        match = self.router.match(path)
+        if match is None or match.route.streamHandler is None or match.parameters is None:
+            return None
+        rateLimiter = self.rateLimiterFor(match.route)
+        if rateLimiter is not None and clientAddress is not None and rateLimiter.admit(clientAddress) > 0:
+            return None
+
+        self.metrics.increment('sleepapi_requests_total', (('route', match.route.name), ('code', '200')))
+        return match.route.streamHandler(ApiRequest(match.parameters, match.jsonpCallback, None, 'GET', b''))
+
+    def streamStatusEvents(self, request):
+        return 200, 'text/event-stream', self.statusEvents()
+
+    def streamLongPoll(self, request):
+        contentType = self.encodeMessage({}, request.jsonpCallback)[0]
+        return 200, contentType, self.longPollStatus(request.parameters['version'], request.jsonpCallback)
+
+    def versionedStatus(self, version, snapshot):
+        returnDict = dict(snapshot)
+        returnDict['version'] = version
+        return returnDict
+
+    async def longPollStatus(self, sinceVersion, jsonpCallback):
+        version, snapshot, changed = await self.statusPublisher.waitForChange(sinceVersion, LONG_POLL_TIMEOUT)
+        yield self.encodeMessage(self.versionedStatus(version, snapshot), jsonpCallback)[1]
+
+    async def statusEvents(self):
+        version = 0
+        while True:
+            newVersion, snapshot, changed = await self.statusPublisher.waitForChange(version, STREAM_KEEP_ALIVE_INTERVAL)
+            if changed:
+                version = newVersion
+                event = json.dumps(self.versionedStatus(version, snapshot), ensure_ascii = False)
+                yield bytes('id: ' + str(version) + '\ndata: ' + event + '\n\n', 'UTF-8')
+            else:
+                # comment line; lets the client know the stream is alive and lets us notice gone clients
+                yield b': keep-alive\n\n'
 
-        communicatedMessage = self.communicationQueue.get()
+    def sleepServerRequest(self, message):
+        # send the request to the sleep server via the command bus and wait for its own reply
+        communicatedMessage = self.commandBus.request(message, COMMAND_REPLY_TIMEOUT)
         if self.isset(communicatedMessage, 'status') or self.isset(communicatedMessage, 'error'):
             return communicatedMessage
         else:
             print('AsyncNetworkManager: can\'t read queued values!')
-            pprint.pprint(communicatedMessage)
+            print(repr(communicatedMessage))
 
 
 
 class SleepServer(Thread, IssetHelper):
     """
     Control object of system sleep.
-    Definition of the dictionary used in the communication queue between the sleep server and the network manager:
+    Definition of the dictionary used in the command bus between the sleep server and the network manager:
 
     {'set': 'immediateSleep'}
     {'set': 'sleepTimer', 'time': [INT]}
-    {'set': 'silenceTimer', 'time': [INT]}
-    {'set': 'goodNightTimer', 'time': [INT]}
+    {'set': 'silenceTimer', 'time': [INT], optional: 'curve': 'linear' | 'logarithmic' | 'exponential', 'fadeWindow': [INT]}
+    {'set': 'goodNightTimer', 'time': [INT], optional: 'curve': 'linear' | 'logarithmic' | 'exponential', 'fadeWindow': [INT]}
     {'set': 'volume', 'percent': [float]}
+    {'set': 'volumeTargets', 'targets': ['master' | 'sink:[name]' | 'app:[name]', ...]}
     {'unset': 'timer'}
     {'get': 'status'}
+    {'batch': [list of the commands above]}
+    {'schedule': 'add', 'entry': {'name': [STRING], 'command': [command above or list of them], 'in': [seconds] | 'at': 'HH:MM', optional: 'days': [...]}}
+    {'schedule': 'cancel', 'name': [STRING]}
+    {'get': 'schedule', optional: 'name': [STRING]}
+    {'get': 'volumeTargets'}
+
+    Besides the one running timer, any number of named schedule entries wait for their deadline; a due entry runs its
+    command like a client would, e.g. a silence timer at 23:30 on weekdays replaces whatever timer runs at that time.
     """
 
-    def __init__(self):
+    # the simulation passes a virtual clock and a fake system control and drives the control loop itself
+    def __init__(self, clock = None, systemControl = None, startNetworkManager = True):
         # define members:
-        self.communicationQueue = Queue()
-        self.checkQueueEvent = Event()
-        self.networkQueueEvent = Event()
-        self.systemControl = SystemControl(BE_VERBOSE)
+        self.clock = clock or SystemClock()
+        self.metrics = ServerMetrics()
+        self.commandBus = CommandBus(self.metrics, COMMAND_QUEUE_DEPTH)
+        self.statusPublisher = StatusPublisher(self.clock)
+        self.publishedState = None
+        self.replyFuture = None
+        self.batchRunning = False
+        self.systemControl = systemControl
+        if systemControl is None:
+            systemControlClass = FakeSystemControl if AUDIO_BACKEND == FAKE_BACKEND else SystemControl
+            self.systemControl = systemControlClass(BE_VERBOSE, VOLUME_CACHE_TTL, WATCH_MIXER_EVENTS, AUDIO_BACKEND, self.metrics, SYSTEM_COMMAND_TIMEOUT)
+            if VOLUME_TARGETS:
+                try:
+                    self.systemControl.setVolumeTargets(VOLUME_TARGETS)
+                except ValueError as error:
+                    print('SleepServer: using the master volume;', error)
+        self.currentVolume = None # read from the mixer once the control thread runs
+        self.volumeCheckedAt = 0
 
         self.sleepTimeRunning = Event()
         self.silenceTimeRunning = Event()
         self.goodNightTimeRunning = Event()
 
-        self.timeLeft = -1
+        self.timerDeadline = None
+        self.wallClockDeadline = None # the same deadline on the wall clock, stored so it survives a restart
+        self.nextTimerEventTime = None
         self.initialTime = -1
         self.volumeAtSilenceTimeStart = -1
+        self.volumeRamp = None
         self.status = NORMAL_STATUS
+        self.scheduler = Scheduler()
+        self.timerStateFile = TimerStateFile(STATE_FILE) if STATE_FILE else None
+        self.storedState = None # (timer state, schedule version) last written to the state file
 
-        # inital method calls
+        # inital method calls; the listener is bound first, requests arriving before the control thread has read the
+        # mixer wait in the command bus
         Thread.__init__(self)
-        self.currentVolume = self.systemControl.getVolume()
-        self.networkManager = AsyncNetworkManager(self.communicationQueue, self.checkQueueEvent, self.networkQueueEvent)
-        self.networkManager.start()
+        self.networkManager = AsyncNetworkManager(self.commandBus, self.metrics, self.statusPublisher, self.clock)
+        if startNetworkManager:
+            self.networkManager.start()
 
     def run(self):
-        self.timerTick()
-
-        while self.checkQueueEvent.wait():
-            self.checkQueueEvent.clear()
-            communicatedMessage = self.communicationQueue.get()
+        self.startControlLoop()
+
+        # an error in a command or timer event is reported and its caller answered; the loop itself keeps running
+        while True:
+            try:
+                with processProfiler.section():
+                    self.runDueEvents()
+            except Exception:
+                self.reportControlLoopError('running the timer events')
+
+            # sleep until the next command arrives or the next timer event is due
+            communicatedMessage, self.replyFuture = self.commandBus.nextCommand(self.secondsToNextTimerEvent())
+            if communicatedMessage is not None:
+                try:
+                    with processProfiler.section():
+                        self.handleCommand(communicatedMessage)
+                except Exception as error:
+                    self.reportControlLoopError('executing ' + repr(communicatedMessage))
+                    if not self.replyFuture.done():
+                        self.replyFuture.set_exception(CommandFailed(str(error)))
+
+    def reportControlLoopError(self, action):
+        print('SleepServer: error', action + ':')
+        traceback.print_exc()
+        self.metrics.increment('control_loop_errors_total')
+
+    def startControlLoop(self):
+        self.recoverState()
+        self.currentVolume = self.systemControl.getVolume()
+        self.volumeCheckedAt = self.clock.monotonic()
+        self.publishStatusIfChanged()
+
+    # one turn of the control loop without waiting: due timer events and schedule entries, then publish and store
+    def runDueEvents(self):
+        self.runDueTimerEvents()
+        self.runDueScheduleEntries()
+        self.publishStatusIfChanged()
+        self.storeTimerState()
+
+    def handleCommand(self, communicatedMessage):
+        # handle set commands
+        if self.isset(communicatedMessage, 'set'):
+            if communicatedMessage['set'] == 'immediateSleep':
+                if BE_VERBOSE: print('SleepServer: receiving a immediateSleep command')
+                self.status = IMMEDIATE_SLEEP_STATUS
+                self.respondToNetworkThread(self.getStatus())
+                self.sleep()
+
+            # handle sleep timer requests
+            elif communicatedMessage['set'] == 'sleepTimer' and self.isset(communicatedMessage, 'time'):
+                if self.isInt(communicatedMessage['time']) and self.setSleepTime(int(communicatedMessage['time'])):
+                    self.respondToNetworkThread(self.getStatus())
+                else:
+                    if BE_VERBOSE: print('SleepServer: error parsing the received setSleepTime command')
+                    self.respondToNetworkThread({'error': 'bad sleep time'})
 
-            # handle set commands
-            if self.isset(communicatedMessage, 'set'):
-                if communicatedMessage['set'] == 'immediateSleep':
-                    if BE_VERBOSE: print('SleepServer: receiving a immediateSleep command')
-                    self.status = 'immediateSleep'
+            # handle silence timer requests
+            elif communicatedMessage['set'] == 'silenceTimer' and self.isset(communicatedMessage, 'time'):
+                if self.isInt(communicatedMessage['time']) and self.setSilenceTime(int(communicatedMessage['time']), communicatedMessage.get('curve', LINEAR_CURVE), communicatedMessage.get('fadeWindow')):
                     self.respondToNetworkThread(self.getStatus())
-                    self.sleep()
+                else:
+                    if BE_VERBOSE: print('SleepServer: error parsing the received setSilenceTime command')
+                    self.respondToNetworkThread({'error': 'bad sleep time'})
 
-                # handle sleep timer requests
-                elif communicatedMessage['set'] == 'sleepTimer' and self.isset(communicatedMessage, 'time'):
-                    if self.isInt(communicatedMessage['time']) and self.setSleepTime(int(communicatedMessage['time'])):
-                        self.respondToNetworkThread(self.getStatus())
+            # handle good night timer requests
+            elif communicatedMessage['set'] == 'goodNightTimer' and self.isset(communicatedMessage, 'time'):
+                if self.isInt(communicatedMessage['time']) and self.setGoodNightTime(int(communicatedMessage['time']), communicatedMessage.get('curve', LINEAR_CURVE), communicatedMessage.get('fadeWindow')):
+                    self.respondToNetworkThread(self.getStatus())
+                else:
+                    if BE_VERBOSE: print('SleepServer: error parsing the received setSleepTime command')
+                    self.respondToNetworkThread({'error': 'bad sleep time'})
+
+             # handle set volume requests
+            elif communicatedMessage['set'] == 'volume' and self.isset(communicatedMessage, 'percent'):
+                if self.isFloat(communicatedMessage['percent']):
+                    if BE_VERBOSE: print('SleepServer: receiving a setVolume command with', float(communicatedMessage['percent']), '%')
+                    if self.isVolumeAutoControlled():
+                        if BE_VERBOSE: print('SleepServer: can\'t set volume; controled by silence- or goodNightTimer')
+                        self.respondToNetworkThread({'error': 'volume is auto-controlled'})
                     else:
-                        if BE_VERBOSE: print('SleepServer: error parsing the received setSleepTime command')
-                        self.respondToNetworkThread({'error': 'bad sleep time'})
-
-                # handle silence timer requests
-                elif communicatedMessage['set'] == 'silenceTimer' and self.isset(communicatedMessage, 'time'):
-                    if self.isInt(communicatedMessage['time']) and self.setSilenceTime(int(communicatedMessage['time'])):
+                        self.volumeControl(float(communicatedMessage['percent']))
+                        self.volumeAtSilenceTimeStart = self.systemControl.getVolume()
+                        self.rebuildVolumeRamp()
                         self.respondToNetworkThread(self.getStatus())
-                    else:
-                        if BE_VERBOSE: print('SleepServer: error parsing the received setSilenceTime command')
-                        self.respondToNetworkThread({'error': 'bad sleep time'})
+                else:
+                    if BE_VERBOSE: print('SleepServer: error parsing the received setVolume command')
+                    self.respondToNetworkThread({'error': 'bad volume percentage'})
 
-                # handle good night timer requests
-                elif communicatedMessage['set'] == 'goodNightTimer' and self.isset(communicatedMessage, 'time'):
-                    if self.isInt(communicatedMessage['time']) and self.setGoodNightTime(int(communicatedMessage['time'])):
-                        self.respondToNetworkThread(self.getStatus())
-                    else:
-                        if BE_VERBOSE: print('SleepServer: error parsing the received setSleepTime command')
-                        self.respondToNetworkThread({'error': 'bad sleep time'})
-
-                 # handle set volume requests
-                elif communicatedMessage['set'] == 'volume' and self.isset(communicatedMessage, 'percent'):
-                    if self.isFloat(communicatedMessage['percent']):
-                        if BE_VERBOSE: print('SleepServer: receiving a setVolume command with', float(communicatedMessage['percent']), '%')
-                        if (self.silenceTimeRunning.isSet() or self.goodNightTimeRunning.isSet()) and self.timeLeft < GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE:
-                            if BE_VERBOSE: print('SleepServer: can\'t set volume; controled by silence- or goodNightTimer')
-                            self.respondToNetworkThread({'error': 'volume is auto-controlled'})
-                        else:
-                            self.volumeControl(float(communicatedMessage['percent']))
-                            self.volumeAtSilenceTimeStart = self.systemControl.getVolume()
-                            self.respondToNetworkThread(self.getStatus())
+            # handle volume target requests; the volume is read from the new targets
+            elif communicatedMessage['set'] == 'volumeTargets' and self.isset(communicatedMessage, 'targets'):
+                if self.isVolumeAutoControlled():
+                    self.respondToNetworkThread({'error': 'volume is auto-controlled'})
+                else:
+                    try:
+                        self.systemControl.setVolumeTargets(communicatedMessage['targets'])
+                    except ValueError as error:
+                        self.respondToNetworkThread({'error': str(error)})
                     else:
-                        if BE_VERBOSE: print('SleepServer: error parsing the received setVolume command')
-                        self.respondToNetworkThread({'error': 'bad volume percentage'})
-
-            # handle reset / unset commands
-            elif self.isset(communicatedMessage, 'unset'):
-                if communicatedMessage['unset'] == 'timer':
-                    if BE_VERBOSE: print('SleepServer: receiving a unset sleepTimer command')
-                    if self.sleepTimeRunning.isSet() or self.silenceTimeRunning.isSet() or self.goodNightTimeRunning.isSet():
-                        self.resetServer()
+                        if BE_VERBOSE: print('SleepServer: controlling the volume of', ', '.join(self.systemControl.volumeTargets))
                         status = self.getStatus()
-                        status['acknowledge'] = 'unsettingTimer'
+                        if self.volumeRamp is not None:
+                            self.volumeAtSilenceTimeStart = self.currentVolume
+                            self.rebuildVolumeRamp()
+                        status['volumeTargets'] = self.systemControl.getTargetVolumes()
+                        self.respondToNetworkThread(status)
+
+        # handle reset / unset commands
+        elif self.isset(communicatedMessage, 'unset'):
+            if communicatedMessage['unset'] == 'timer':
+                if BE_VERBOSE: print('SleepServer: receiving a unset sleepTimer command')
+                if self.isTimerRunning():
+                    self.resetServer()
+                    status = self.getStatus()
+                    status['acknowledge'] = 'unsettingTimer'
+                else:
+                    self.resetServer()
+                    status = self.getStatus()
+                self.respondToNetworkThread(status)
+
+        # handle batches of commands
+        elif self.isset(communicatedMessage, 'batch'):
+            if BE_VERBOSE: print('SleepServer: receiving a batch of', len(communicatedMessage['batch']), 'commands')
+            self.respondToNetworkThread(self.runBatch(communicatedMessage['batch']))
+
+        # handle schedule entries
+        elif self.isset(communicatedMessage, 'schedule'):
+            if communicatedMessage['schedule'] == 'add' and self.isset(communicatedMessage, 'entry'):
+                self.respondToNetworkThread(self.addScheduleEntry(communicatedMessage['entry']))
+            elif communicatedMessage['schedule'] == 'cancel' and self.isset(communicatedMessage, 'name'):
+                if BE_VERBOSE: print('SleepServer: receiving a cancel command for the schedule entry', communicatedMessage['name'])
+                entry = self.scheduler.cancel(communicatedMessage['name'])
+                if entry is None:
+                    self.respondToNetworkThread({'error': 'no such schedule entry'})
+                else:
+                    status = self.getStatus()
+                    status['acknowledge'] = 'cancellingScheduleEntry'
+                    status['entry'] = entry.asDictionary(self.clock.time())
+                    self.respondToNetworkThread(status)
+
+        # handle get status requests
+        elif self.isset(communicatedMessage, 'get'):
+            if communicatedMessage['get'] == 'status':
+                if BE_VERBOSE: print('SleepServer: receiving a status request')
+                self.respondToNetworkThread(self.getStatus())
+            elif communicatedMessage['get'] == 'schedule':
+                now = self.clock.time()
+                if self.isset(communicatedMessage, 'name'):
+                    entry = self.scheduler.get(communicatedMessage['name'])
+                    if entry is None:
+                        self.respondToNetworkThread({'error': 'no such schedule entry'})
                     else:
-                        self.resetServer()
-                        status = self.getStatus()
+                        status = self.statusSnapshot()
+                        status['entry'] = entry.asDictionary(now)
+                        self.respondToNetworkThread(status)
+                else:
+                    status = self.statusSnapshot()
+                    status['schedule'] = [entry.asDictionary(now) for entry in self.scheduler.sortedEntries()]
                     self.respondToNetworkThread(status)
+            elif communicatedMessage['get'] == 'volumeTargets':
+                status = self.getStatus()
+                status['volumeTargets'] = self.systemControl.getTargetVolumes()
+                self.respondToNetworkThread(status)
 
-            # handle get status requests
-            elif self.isset(communicatedMessage, 'get'):
-                if communicatedMessage['get'] == 'status':
-                    if BE_VERBOSE: print('SleepServer: receiving a status request')
-                    self.respondToNetworkThread(self.getStatus())
+        else:
+            if BE_VERBOSE: print('SleepServer: can\'t read values from the network manager thread!')
+            print(repr(communicatedMessage))
+
+        # never leave a caller waiting for a command that got no answer
+        if not self.replyFuture.done():
+            self.respondToNetworkThread({'error': 'unrecognized command'})
+
+    # runs the commands one after another without any other command or timer event in between; if one of them fails,
+    # the timers and the volume are restored and nothing of the batch takes effect. Subscribers only see the result
+    def runBatch(self, commands):
+        savedState = self.captureTimerState()
+        self.batchRunning = True
+        try:
+            for position, command in enumerate(commands):
+                reply = self.executeCommand(command)
+                if self.isset(reply, 'error'):
+                    if BE_VERBOSE: print('SleepServer: batch command', position, 'failed; rolling back the batch')
+                    self.rollBackTimerState(savedState)
+                    return {'error': reply['error'], 'command': position}
+        except Exception:
+            self.rollBackTimerState(savedState)
+            raise
+        finally:
+            self.batchRunning = False
+
+        # every command answers with the status after it, the last one is the status after the whole batch
+        status = dict(reply)
+        status['acknowledge'] = 'batch'
+        return status
+
+    # runs a command of the control thread itself (batch commands, due schedule entries) and returns its reply
+    def executeCommand(self, command):
+        callerFuture = self.replyFuture
+        self.replyFuture = Future()
+        try:
+            self.handleCommand(command)
+            return self.replyFuture.result()
+        finally:
+            self.replyFuture = callerFuture
 
+    def addScheduleEntry(self, description):
+        try:
+            entry = parseEntry(description, self.clock.time())
+        except ValueError as error:
+            return {'error': str(error)}
+        if len(self.scheduler) >= MAX_SCHEDULE_ENTRIES and self.scheduler.get(entry.name) is None:
+            return {'error': 'the schedule is full (' + str(MAX_SCHEDULE_ENTRIES) + ' entries)'}
+
+        if BE_VERBOSE: print('SleepServer: scheduling', entry.name, 'in', int(entry.deadline - self.clock.time()), 'seconds')
+        self.scheduler.add(entry)
+        status = self.getStatus()
+        status['acknowledge'] = 'scheduling'
+        status['entry'] = entry.asDictionary(self.clock.time())
+        return status
+
+    # the scheduler only looks at the top of its heap, so this costs nothing until an entry is due
+    def runDueScheduleEntries(self):
+        now = self.clock.time()
+        for deadline, entry in self.scheduler.popDue(now):
+            self.metrics.observe('schedule_entry_lateness_seconds', now - deadline)
+            if BE_VERBOSE: print('SleepServer: running the schedule entry', entry.name)
+            command = {'batch': entry.command} if isinstance(entry.command, list) else entry.command
+            reply = self.executeCommand(command)
+            if self.isset(reply, 'error'):
+                print('SleepServer: schedule entry', entry.name, 'failed:', reply['error'])
+
+    def captureTimerState(self):
+        return {
+            'status': self.status,
+            'events': [event.isSet() for event in self.timerEvents()],
+            'timerDeadline': self.timerDeadline,
+            'wallClockDeadline': self.wallClockDeadline,
+            'initialTime': self.initialTime,
+            'volumeAtSilenceTimeStart': self.volumeAtSilenceTimeStart,
+            'volumeRamp': self.volumeRamp,
+            'currentVolume': self.currentVolume,
+            'volumeTargets': self.systemControl.volumeTargets,
+        }
+
+    def rollBackTimerState(self, savedState):
+        for event, isSet in zip(self.timerEvents(), savedState['events']):
+            if isSet:
+                event.set()
             else:
-                if BE_VERBOSE: print('SleepServer: can\'t read values from the network manager thread!')
-                pprint.pprint(communicatedMessage)
+                event.clear()
+        self.status = savedState['status']
+        self.timerDeadline = savedState['timerDeadline']
+        self.wallClockDeadline = savedState['wallClockDeadline']
+        self.initialTime = savedState['initialTime']
+        self.volumeAtSilenceTimeStart = savedState['volumeAtSilenceTimeStart']
+        self.volumeRamp = savedState['volumeRamp']
+        if self.systemControl.volumeTargets != savedState['volumeTargets']:
+            self.systemControl.setVolumeTargets(savedState['volumeTargets'])
+        if self.currentVolume != savedState['currentVolume']:
+            self.volumeControl(savedState['currentVolume'])
+        self.scheduleNextTimerEvent()
+
+    def timerEvents(self):
+        return [self.sleepTimeRunning, self.silenceTimeRunning, self.goodNightTimeRunning]
+
+    def isTimerRunning(self):
+        return self.sleepTimeRunning.isSet() or self.silenceTimeRunning.isSet() or self.goodNightTimeRunning.isSet()
+
+    # remaining whole seconds until the running timer expires; computed from its deadline, so it doesn't drift
+    def getTimeLeft(self):
+        if self.timerDeadline is None:
+            return -1
+        return max(0, int(math.ceil(self.timerDeadline - self.clock.monotonic())))
+
+    # compute the monotonic time of the next moment the running timer needs attention; that is the next step of
+    # the volume ramp (if any) or the deadline itself
+    def scheduleNextTimerEvent(self):
+        if not self.isTimerRunning():
+            self.nextTimerEventTime = None
+            return
+
+        secondsLeft = self.timerDeadline - self.clock.monotonic()
+        nextRampChange = None
+        if secondsLeft > 0 and self.volumeRamp is not None:
+            nextRampChange = self.volumeRamp.nextChange(secondsLeft)
+
+        if nextRampChange is None:
+            self.nextTimerEventTime = self.timerDeadline
+        else:
+            self.nextTimerEventTime = self.timerDeadline - nextRampChange
+
+    # the earlier of the running timer's next event and the first schedule entry (a wall clock deadline)
+    def secondsToNextTimerEvent(self):
+        seconds = None
+        if self.nextTimerEventTime is not None:
+            seconds = max(0, self.nextTimerEventTime - self.clock.monotonic())
+        scheduleDeadline = self.scheduler.nextDeadline()
+        if scheduleDeadline is not None:
+            scheduleSeconds = max(0, scheduleDeadline - self.clock.time())
+            seconds = scheduleSeconds if seconds is None else min(seconds, scheduleSeconds)
+        return seconds
+
+    def runDueTimerEvents(self):
+        now = self.clock.monotonic()
+        if self.nextTimerEventTime is not None and self.nextTimerEventTime <= now:
+            self.metrics.observe('timer_tick_lateness_seconds', now - self.nextTimerEventTime)
+            self.timerTick()
+            self.scheduleNextTimerEvent()
 
     def timerTick(self):
-        if self.sleepTimeRunning.isSet() or self.silenceTimeRunning.isSet() or self.goodNightTimeRunning.isSet():
-
-            # good night time handling; sleep timer and volume decreasing
-            if self.goodNightTimeRunning.isSet():
-                if BE_VERBOSE: print('good night timer tick:', self.timeLeft)
-                if self.timeLeft > 0:
-                    self.timeLeft -= 1
-
-                    # start changing the volume after getting below 10 min:
-                    if self.initialTime > GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE and self.timeLeft <= GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE:
-                        self.volumeControl((self.volumeAtSilenceTimeStart * self.timeLeft) / GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE)
-                    elif self.initialTime <= GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE:
-                        self.volumeControl((self.volumeAtSilenceTimeStart * self.timeLeft) / self.initialTime)
-                else:
-                    self.sleep()
+        secondsLeft = self.timerDeadline - self.clock.monotonic()
+        if BE_VERBOSE: print(self.status, 'timer tick:', self.getTimeLeft())
 
-            # handle only the sleep time
-            elif self.sleepTimeRunning.isSet():
-                if BE_VERBOSE: print('sleep timer tick:', self.timeLeft)
-                if self.timeLeft > 0:
-                    self.timeLeft -= 1
-                else:
-                    self.sleep()
-
-            # handle only the volume-down-to-silence-time
-            elif self.silenceTimeRunning.isSet():
-                if BE_VERBOSE: print('silence timer tick:', self.timeLeft)
-                if self.timeLeft > 0:
-                    self.timeLeft -= 1
-                    self.volumeControl((self.volumeAtSilenceTimeStart * self.timeLeft) / self.initialTime)
-                else:
-                    self.resetServer()
+        # only write the mixer if the ramp reached another volume step
+        if self.volumeRamp is not None:
+            rampVolume = self.volumeRamp.volumeAt(max(0, secondsLeft))
+            if rampVolume != self.currentVolume:
+                self.volumeControl(rampVolume)
 
-        # keep the timer alive
-        Timer(1, self.timerTick).start()
+        if secondsLeft <= 0:
+            if self.silenceTimeRunning.isSet():
+                self.resetServer()
+            else:
+                self.sleep()
+
+    # the volume fade of silence and good night timers; the schedule is precomputed once per timer
+    def buildVolumeRamp(self, fadeTime, curve):
+        self.volumeRamp = VolumeRamp(self.volumeAtSilenceTimeStart, fadeTime, curve, VOLUME_STEP)
+        if BE_VERBOSE: print('SleepServer: volume ramp with', self.volumeRamp.numberOfSteps(), 'mixer steps within', fadeTime, 'seconds')
+
+    # both clocks are read when the timer is set: the wall clock may be stepped later (e.g. by NTP after the boot),
+    # which must neither move the running timer nor the one stored for a restart
+    def startTimerDeadline(self, time):
+        self.timerDeadline = self.clock.monotonic() + time
+        self.wallClockDeadline = self.clock.time() + time
+
+    # a timer waiting for its fade window fades from the new volume; a silence timer that already fades goes on from
+    # the new volume over the time it has left
+    def rebuildVolumeRamp(self):
+        if self.volumeRamp is None:
+            return
+        self.buildVolumeRamp(max(1, min(self.volumeRamp.fadeTime, self.getTimeLeft())), self.volumeRamp.curve)
+        self.scheduleNextTimerEvent()
+
+    # the fade of a good night timer and the last 10 minutes of a silence timer can't be overridden; before that a
+    # silence timer takes a new volume and fades from it
+    def isVolumeAutoControlled(self):
+        if self.volumeRamp is None:
+            return False
+        secondsLeft = self.timerDeadline - self.clock.monotonic()
+        if self.status == SILENCE_TIMER_STATUS and secondsLeft >= GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE:
+            return False
+        return self.volumeRamp.isFading(secondsLeft)
 
     def setSleepTime(self, time):
         if self.isInt(time):
             time = int(time)
-            if time > 0:
+            if 0 < time <= MAX_TIMER_TIME:
                 if BE_VERBOSE: print('SleepServer: receiving a setSleepTime command with', time, 'seconds')
                 self.resetServer()
                 self.status = SLEEP_TIMER_STATUS
-                self.timeLeft = time
+                self.startTimerDeadline(time)
 
                 self.sleepTimeRunning.set()
+                self.scheduleNextTimerEvent()
                 return True
         return False
 
-    def setSilenceTime(self, time):
-        if self.isInt(time):
+    # the volume is decreased from the beginning of the call unless a shorter fade window is given
+    def setSilenceTime(self, time, curve = LINEAR_CURVE, fadeWindow = None):
+        if self.isInt(time) and curve in FADE_CURVES and (fadeWindow is None or self.isInt(fadeWindow)):
             time = int(time)
-            if time > 0:
+            fadeWindow = time if fadeWindow is None else int(fadeWindow)
+            if 0 < time <= MAX_TIMER_TIME and fadeWindow > 0:
                 if BE_VERBOSE: print('SleepServer: receiving a setSilenceTime command with', time, 'seconds')
                 self.resetServer()
                 self.status = SILENCE_TIMER_STATUS
-                self.initialTime = self.timeLeft = time
+                self.initialTime = time
+                self.startTimerDeadline(time)
                 self.currentVolume = self.systemControl.getVolume()
                 self.volumeAtSilenceTimeStart = self.currentVolume
+                self.buildVolumeRamp(min(time, fadeWindow), curve)
 
                 self.silenceTimeRunning.set()
+                self.scheduleNextTimerEvent()
                 return True
         return False
 
-    def setGoodNightTime(self, time):
-        if self.isInt(time):
+    # the volume is kept until the last fade window (10 minutes by default) of the good night time
+    def setGoodNightTime(self, time, curve = LINEAR_CURVE, fadeWindow = None):
+        if self.isInt(time) and curve in FADE_CURVES and (fadeWindow is None or self.isInt(fadeWindow)):
             time = int(time)
-            if time > 0:
+            fadeWindow = GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE if fadeWindow is None else int(fadeWindow)
+            if 0 < time <= MAX_TIMER_TIME and fadeWindow > 0:
                 if BE_VERBOSE: print('SleepServer: receiving a setGoodNightTime command with', time, 'seconds')
                 self.resetServer()
                 self.status = GOOD_NIGHT_TIMER_STATUS
-                self.initialTime = self.timeLeft = time
+                self.initialTime = time
+                self.startTimerDeadline(time)
                 self.currentVolume = self.systemControl.getVolume()
                 self.volumeAtSilenceTimeStart = self.currentVolume
+                self.buildVolumeRamp(min(time, fadeWindow), curve)
 
                 self.goodNightTimeRunning.set()
+                self.scheduleNextTimerEvent()
                 return True
         return False
 
@@ -414,26 +1037,155 @@ class SleepServer(Thread, IssetHelper):
         self.goodNightTimeRunning.clear()
 
         # reset members
-        self.timeLeft = -1
+        self.timerDeadline = None
+        self.wallClockDeadline = None
+        self.nextTimerEventTime = None
         self.initialTime = -1
         self.volumeAtSilenceTimeStart = -1
+        self.volumeRamp = None
         self.status = NORMAL_STATUS
 
     def getStatus(self):
         self.currentVolume = self.systemControl.getVolume()
+        self.volumeCheckedAt = self.clock.monotonic()
+        return self.statusSnapshot()
+
+    # the status without asking the mixer for the current volume
+    def statusSnapshot(self):
         statusDictionary = {'status': self.status, 'currentVolume': self.currentVolume}
 
         if self.sleepTimeRunning.isSet() or self.goodNightTimeRunning.isSet():
-            statusDictionary['timeToSleep'] = self.timeLeft
+            statusDictionary['timeToSleep'] = self.getTimeLeft()
         elif self.silenceTimeRunning.isSet():
-            statusDictionary['timeToSilence'] = self.timeLeft
+            statusDictionary['timeToSilence'] = self.getTimeLeft()
         return statusDictionary
 
+    # push the status to stream subscribers if the state changed (timer set or unset, volume step, sleep); the
+    # countdown itself isn't a change, subscribers get the remaining time with every snapshot
+    def publishStatusIfChanged(self):
+        state = (self.status, self.currentVolume, self.timerDeadline)
+        if state != self.publishedState:
+            self.publishedState = state
+            self.statusPublisher.publish(self.statusSnapshot(), self.timerDeadline, self.volumeCheckedAt)
+        else:
+            self.statusPublisher.confirm(self.volumeCheckedAt)
+
+    # the status is published and the timer stored before the reply, so a client reading the status after a command
+    # sees its effect and an acknowledged timer survives a crash; the commands of a batch don't publish their
+    # intermediate states
     def respondToNetworkThread(self, dictionary):
-        self.communicationQueue.put(dictionary)
-        self.networkQueueEvent.set()
+        if not self.batchRunning:
+            self.publishStatusIfChanged()
+            self.storeTimerState()
+        self.replyFuture.set_result(dictionary)
+
+    # the running timer with its absolute (wall clock) deadline and ramp parameters or None
+    def timerState(self):
+        if not self.isTimerRunning():
+            return None
+
+        state = {
+            'status': self.status,
+            'deadline': round(self.wallClockDeadline, 3),
+            'initialTime': self.initialTime,
+        }
+        if self.volumeRamp is not None:
+            state['startVolume'] = self.volumeRamp.startVolume
+            state['fadeTime'] = self.volumeRamp.fadeTime
+            state['curve'] = self.volumeRamp.curve
+        return state
+
+    # writes the state file if the timer (set, unset, new ramp) or the schedule changed; the countdown doesn't change
+    # them, and an unchanged schedule isn't even encoded
+    def storeTimerState(self):
+        if self.timerStateFile is None:
+            return
+        timerState = self.timerState()
+        if (timerState, self.scheduler.version) == self.storedState:
+            return
+
+        state = None
+        if timerState is not None or len(self.scheduler) > 0:
+            state = {'timer': timerState, 'schedule': [entry.asDictionary() for entry in self.scheduler.sortedEntries()]}
+        try:
+            self.timerStateFile.save(state)
+            self.storedState = (timerState, self.scheduler.version)
+        except OSError as error:
+            print('SleepServer: can\'t store the timer state:', error)
+
+    # the timer and the schedule stored by a previous run
+    def recoverState(self):
+        if self.timerStateFile is None:
+            return
+        state = self.timerStateFile.load()
+        if state is None:
+            return
+
+        # state files of older versions only hold the timer
+        if 'status' in state:
+            state = {'timer': state}
+        if state.get('timer') is not None:
+            self.recoverTimer(state['timer'])
+        if isinstance(state.get('schedule'), list):
+            self.recoverSchedule(state['schedule'])
+
+    # continues the timer stored by a previous run; a timer that expired during a short downtime expires right away,
+    # an older one is dropped. The first tick runs immediately and puts the mixer on the ramp's current step
+    def recoverTimer(self, state):
+        startTime = perf_counter()
+        timerEvents = {
+            SLEEP_TIMER_STATUS: self.sleepTimeRunning,
+            SILENCE_TIMER_STATUS: self.silenceTimeRunning,
+            GOOD_NIGHT_TIMER_STATUS: self.goodNightTimeRunning,
+        }
+        try:
+            wallClockDeadline = float(state['deadline'])
+            secondsLeft = wallClockDeadline - self.clock.time()
+            timerEvent = timerEvents[state['status']]
+            volumeRamp = None
+            if 'fadeTime' in state:
+                volumeRamp = VolumeRamp(float(state['startVolume']), int(state['fadeTime']), state['curve'], VOLUME_STEP)
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            print('SleepServer: ignoring an unreadable timer state')
+            return
+
+        if secondsLeft < -RECOVERY_GRACE_PERIOD:
+            if BE_VERBOSE: print('SleepServer: dropping a timer that expired', int(-secondsLeft), 'seconds ago')
+            return
+
+        self.status = state['status']
+        self.timerDeadline = self.clock.monotonic() + secondsLeft
+        self.wallClockDeadline = wallClockDeadline
+        self.initialTime = state.get('initialTime', -1)
+        self.volumeRamp = volumeRamp
+        if volumeRamp is not None:
+            self.volumeAtSilenceTimeStart = volumeRamp.startVolume
+        timerEvent.set()
+        self.nextTimerEventTime = self.clock.monotonic()
+        if BE_VERBOSE: print('SleepServer: recovered the', self.status, 'timer with', self.getTimeLeft(), 'seconds left in',
+                             round((perf_counter() - startTime) * 1000, 3), 'ms')
+
+    # like the timer, entries due during a short downtime run right away; a recurring entry that missed its time for
+    # longer waits for its next occurrence, an older one-shot entry is dropped
+    def recoverSchedule(self, entries):
+        now = self.clock.time()
+        for dictionary in entries:
+            try:
+                entry = entryFromDictionary(dictionary)
+                if entry.deadline < now - RECOVERY_GRACE_PERIOD:
+                    if not entry.isRecurring():
+                        if BE_VERBOSE: print('SleepServer: dropping the schedule entry', entry.name, 'that was due', int(now - entry.deadline), 'seconds ago')
+                        continue
+                    entry.deadline = entry.nextOccurrence(now)
+            except (KeyError, TypeError, ValueError):
+                print('SleepServer: ignoring an unreadable schedule entry')
+                continue
+            self.scheduler.add(entry)
+        if BE_VERBOSE: print('SleepServer: recovered', len(self.scheduler), 'schedule entries')
 
     def sleep(self):
+        self.status = IMMEDIATE_SLEEP_STATUS
+        self.publishStatusIfChanged()
         self.resetServer()
         self.systemControl.setSleep()
 
@@ -445,6 +1197,7 @@ class SleepServer(Thread, IssetHelper):
 
         self.currentVolume = percent
         self.systemControl.setVolume(self.currentVolume)
+        self.volumeCheckedAt = self.clock.monotonic()
 
 
 
@@ -453,23 +1206,120 @@ class SleepServer(Thread, IssetHelper):
 # ************************************************
 # defining constants and globals:
 HTTPSERVERPORT = 4444
+NETWORK_ENGINE = 'threaded'
+ASYNCIO_ENGINE = 'asyncio'
+CONNECTION_READ_TIMEOUT = 10 # seconds a client may take to send its (next) request
+MAX_REQUEST_BODY_SIZE = 65536 # bytes; request bodies only carry batches of commands
+COMMAND_REPLY_TIMEOUT = 60 # seconds a request waits for the sleep server's reply (HTTP 504 beyond); a batch may run several system commands
+MAX_BATCH_COMMANDS = 16
+MAX_SCHEDULE_ENTRIES = 4096
+MAX_TIMER_TIME = 30 * 24 * 3600 # seconds; longest timer and fade window
 GOOD_NIGHT_TIME_TO_START_WITH_VOLUME_DECREASE = 600 # 10 minutes
+VOLUME_STEP = 1 # smallest volume change (percent) the mixer resolves; ramps only write when crossing a step
 BE_VERBOSE = False
+VOLUME_CACHE_TTL = 2 # seconds a read system volume is served from memory
+SYSTEM_COMMAND_TIMEOUT = 5 # seconds a mixer, sleep or shutdown command may take before it is given up
+WATCH_MIXER_EVENTS = False
+VOLUME_TARGETS = None # sinks and application streams the volume controls instead of the master volume, e.g. ['app:spotify']
+AUDIO_BACKEND = SESSION_BACKEND
 NORMAL_STATUS = 'running'
 SLEEP_TIMER_STATUS = 'goingToSleep'
 SILENCE_TIMER_STATUS = 'goingToSilence'
 GOOD_NIGHT_TIMER_STATUS = 'goingToSleepAndSilence'
+IMMEDIATE_SLEEP_STATUS = 'immediateSleep'
+LONG_POLL_TIMEOUT = 30 # seconds a long poll waits for a status change
+STATE_FILE = None # path of the state file of the running timer and the schedule; None keeps them in memory only
+RECOVERY_GRACE_PERIOD = 60 # seconds; a timer that expired less long ago while the server was down expires at restart
+FLEET_PEERS = [] # host:port of the SleepServers sleepApi/fleet requests are forwarded to
+FLEET_TIMEOUT = 2 # seconds a fleet peer may take to connect and to answer
+STREAM_KEEP_ALIVE_INTERVAL = 15 # seconds between keep-alive comments of an idle status stream
+COMMAND_QUEUE_DEPTH = 64 # waiting commands at which status reads are shed (HTTP 503), other commands at twice that; 0 never sheds
+CLIENT_REQUEST_RATE = 0 # requests per second a client address may send (HTTP 429 beyond); 0 doesn't limit
+CLIENT_REQUEST_BURST = 20 # requests a client may send at once before its rate applies
+EMERGENCY_REQUEST_RATE = 2 # immediate sleep and reset requests per second a client address may send (HTTP 429 beyond); 0 doesn't limit
+EMERGENCY_REQUEST_BURST = 10 # immediate sleep and reset requests a client may send at once
+PROFILE_TOKEN = os.environ.get('SLEEPSERVER_PROFILE_TOKEN') # enables the sleepApi/profile routes for requests carrying it
+DEFAULT_PROFILE_TIME = 30 # seconds a profile capture runs unless the request gives its seconds
+PROFILE_DIRECTORY = '/tmp' # the --profile capture is written there
+PROFILE_AT_START = 0 # seconds profiled from the start (--profile); 0 doesn't
+PROFILE_MEMORY_AT_START = False # the --profile capture traces memory too
+HTTP_WORKERS = 0 # HTTP worker processes sharing the port; 0 serves HTTP in the process of the sleep server
+WORKER_USER = None # user the HTTP workers switch to when started as root
 
 def main():
+    if HTTP_WORKERS > 0:
+        mainWithWorkers()
+        return
+    startProfileCapture()
     serverInstance = SleepServer()
     serverInstance.start()
+    serverInstance.join()
+
+# the control process owns the sleep server and the system control, the HTTP workers only talk to it through their
+# control channel. The workers are forked before any thread is started
+def mainWithWorkers():
+    from multiProcess import forkWorkers, stopWorkers, ControlChannelServer
+    workers = forkWorkers(HTTP_WORKERS, runHTTPWorker)
+    startProfileCapture()
+    try:
+        serverInstance = SleepServer(startNetworkManager = False)
+        ControlChannelServer(list(workers.values()), serverInstance.commandBus, serverInstance.statusPublisher, BE_VERBOSE).start()
+        print('SleepServer control process', os.getpid(), 'is up with', HTTP_WORKERS, 'HTTP workers')
+        serverInstance.start()
+        serverInstance.join()
+    except KeyboardInterrupt:
+        print(' SleepServer: received interrupt signal; stopping the HTTP workers')
+    finally:
+        stopWorkers(workers)
+
+def runHTTPWorker(controlConnection):
+    from multiProcess import listenOnPort, dropPrivileges, ControlChannelClient
+    listeningSocket = listenOnPort(HTTPSERVERPORT)
+    if WORKER_USER:
+        dropPrivileges(WORKER_USER)
+    startProfileCapture()
+
+    statusPublisher = StatusPublisher()
+    channel = ControlChannelClient(controlConnection, statusPublisher)
+    networkManager = AsyncNetworkManager(channel, ServerMetrics(), statusPublisher, SystemClock())
+    networkManager.listeningSocket = listeningSocket
+    networkManager.run()
+
+# the --profile capture; its timer is a thread, so with HTTP workers every process starts its own after the fork
+def startProfileCapture():
+    if PROFILE_AT_START:
+        try:
+            processProfiler.start(PROFILE_AT_START, PROFILE_MEMORY_AT_START, PROFILE_DIRECTORY)
+        except ValueError as error:
+            print('SleepServer: can\'t profile:', error)
 
 # check if this code is run as a module or was included into another project
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser(description = "Backend for receiving time-to-sleep signals.")
     parser.add_argument("-d", "--daemon", action = "store_true", dest = "daemon", help = "enables daemon mode")
     parser.add_argument("-v", "--verbose", action = "store_true", dest = "verbose", help = "enables verbose mode")
     parser.add_argument("-p", "--port", type=int, help = "specifies the networking port number")
+    parser.add_argument("-e", "--engine", choices = ['threaded', ASYNCIO_ENGINE], help = "specifies the network engine; asyncio serves many concurrent connections")
+    parser.add_argument("--volume-cache-ttl", type=float, dest = "volumeCacheTTL", help = "seconds a read system volume is reused (default 2, 0 disables the cache)")
+    parser.add_argument("--command-timeout", type=float, dest = "commandTimeout", help = "seconds a mixer, sleep or shutdown command may take before it is given up (default 5)")
+    parser.add_argument("--watch-mixer", action = "store_true", dest = "watchMixer", help = "invalidates the volume cache on mixer change events (PulseAudio only)")
+    parser.add_argument("-b", "--audio-backend", choices = [SESSION_BACKEND, SUBPROCESS_BACKEND, FAKE_BACKEND], dest = "audioBackend", help = "specifies how the volume is accessed (default: one long-lived mixer session; fake: in-memory mixer, sleep is only simulated)")
+    parser.add_argument("--volume-targets", dest = "volumeTargets", help = "comma separated sinks and application streams the volume and the fades control instead of the master volume: sink:[name], app:[name] or master (PulseAudio)")
+    parser.add_argument("--state-file", dest = "stateFile", help = "file the running timer and the schedule are stored in, so they survive a restart (default ~/.local/state/sleepServer/state-[port].json, private to the user; not used with the fake audio backend)")
+    parser.add_argument("--no-state-file", action = "store_true", dest = "noStateFile", help = "keeps timers in memory only")
+    parser.add_argument("--queue-depth", type=int, dest = "queueDepth", help = "waiting commands at which status reads are answered with 503, other commands at twice that (default 64, 0 never sheds)")
+    parser.add_argument("--rate-limit", type=float, dest = "rateLimit", help = "requests per second a client address may send before it gets 429 (default: no limit)")
+    parser.add_argument("--rate-burst", type=int, dest = "rateBurst", help = "requests a client may send at once before the rate limit applies (default 20)")
+    parser.add_argument("--emergency-rate-limit", type=float, dest = "emergencyRateLimit", help = "immediate sleep and reset requests per second a client address may send after a burst of 10 (default 2, 0: no limit)")
+    parser.add_argument("--profile", type=int, help = "profiles the first [seconds] (cProfile, all threads) and writes the results to the profile directory")
+    parser.add_argument("--profile-memory", action = "store_true", dest = "profileMemory", help = "takes tracemalloc snapshots at the start and the end of the --profile capture")
+    parser.add_argument("--profile-dir", dest = "profileDirectory", help = "directory of the --profile results (default /tmp)")
+    parser.add_argument("--profile-token", dest = "profileToken", help = "enables sleepApi/profile for requests with an 'Authorization: Bearer [token]' header (or set SLEEPSERVER_PROFILE_TOKEN, which ps doesn't show)")
+    parser.add_argument("-w", "--workers", type=int, help = "serves HTTP from this many worker processes sharing the port; the sleep server runs in a separate control process")
+    parser.add_argument("--worker-user", dest = "workerUser", help = "user the HTTP workers switch to when the server is started as root")
+    parser.add_argument("--fleet", help = "comma separated host:port list of SleepServer peers; enables forwarding sleepApi/fleet/[task] to all of them")
+    parser.add_argument("--fleet-timeout", type=float, dest = "fleetTimeout", help = "seconds a fleet peer may take to answer (default 2)")
     args = parser.parse_args()
 
     if args.verbose:
@@ -478,8 +1328,77 @@ if __name__ == "__main__":
     if args.port:
         HTTPSERVERPORT = args.port
 
+    if args.engine:
+        NETWORK_ENGINE = args.engine
+
+    if args.volumeCacheTTL is not None:
+        VOLUME_CACHE_TTL = args.volumeCacheTTL
+
+    if args.commandTimeout:
+        SYSTEM_COMMAND_TIMEOUT = args.commandTimeout
+
+    if args.watchMixer:
+        WATCH_MIXER_EVENTS = True
+
+    if args.audioBackend:
+        AUDIO_BACKEND = args.audioBackend
+
+    if args.volumeTargets:
+        try:
+            VOLUME_TARGETS = parseVolumeTargets(args.volumeTargets)
+        except ValueError as error:
+            parser.error(str(error))
+
+    if args.stateFile:
+        STATE_FILE = args.stateFile
+    elif not args.noStateFile and AUDIO_BACKEND != FAKE_BACKEND:
+        try:
+            STATE_FILE = defaultStatePath(HTTPSERVERPORT)
+        except OSError as error:
+            print('SleepServer: keeping timers in memory only; no state directory:', error)
+    if args.noStateFile:
+        STATE_FILE = None
+
+    if args.queueDepth is not None:
+        COMMAND_QUEUE_DEPTH = args.queueDepth
+
+    if args.rateLimit:
+        CLIENT_REQUEST_RATE = args.rateLimit
+
+    if args.rateBurst:
+        CLIENT_REQUEST_BURST = args.rateBurst
+
+    if args.emergencyRateLimit is not None:
+        EMERGENCY_REQUEST_RATE = args.emergencyRateLimit
+
+    if args.profile:
+        PROFILE_AT_START = args.profile
+        PROFILE_MEMORY_AT_START = args.profileMemory
+
+    if args.profileDirectory:
+        PROFILE_DIRECTORY = args.profileDirectory
+
+    if args.profileToken:
+        PROFILE_TOKEN = args.profileToken
+
+    if args.workers:
+        HTTP_WORKERS = args.workers
+
+    if args.workerUser:
+        WORKER_USER = args.workerUser
+
+    if args.fleet:
+        FLEET_PEERS = [peer.strip() for peer in args.fleet.split(',') if peer.strip()]
+        for peer in FLEET_PEERS:
+            if not peer.rpartition(':')[2].isdigit():
+                parser.error('fleet peers are given as host:port, not ' + peer)
+
+    if args.fleetTimeout:
+        FLEET_TIMEOUT = args.fleetTimeout
+
     if args.daemon:
         pidFile = "/tmp/sleepServerDaemon.pid"
+        from daemonize import Daemonize
         daemon = Daemonize(app='SleepServer Daemon', pid=pidFile, action=main)
         daemon.start()
     else:
@@ -0,0 +1,119 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+import math
+from threading import Condition, Lock
+from clock import SystemClock
+
+# defining constants
+TIME_LEFT_KEYS = ['timeToSleep', 'timeToSilence']
+
+class StatusPublisher:
+    """
+    Versioned status snapshots published by the sleep server thread whenever its state changes.
+    Subscribers of the asyncio engine are futures waiting in its event loop, so idle subscribers cost no thread; the
+    threaded engine's request threads wait on a condition instead.
+    """
+
+    def __init__(self, clock = None):
+        # define members:
+        self.clock = clock or SystemClock()
+        self.lock = Lock()
+        self.changed = Condition(self.lock) # notified on every new version
+        self.version = 0
+        self.snapshot = None
+        self.deadline = None # monotonic deadline of the running timer; the countdown is computed when it's read
+        self.verifiedAt = 0 # monotonic time the volume in the snapshot was last read from (or written to) the mixer
+        self.waiters = []
+        self.subscribers = [] # callables (version, snapshot, deadline, verifiedAt, changed), e.g. forwarding to workers
+
+    # called by the sleep server thread; wakes every subscriber waiting for a newer version. A mirror of another
+    # process' publisher takes over its version
+    def publish(self, snapshot, deadline = None, verifiedAt = None, version = None):
+        with self.lock:
+            self.version = self.version + 1 if version is None else version
+            self.snapshot = snapshot
+            self.deadline = deadline
+            self.verifiedAt = self.clock.monotonic() if verifiedAt is None else verifiedAt
+            waiters = self.waiters
+            self.waiters = []
+            self.notifySubscribers(True)
+            self.changed.notify_all()
+
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(wakeWaiter, waiter)
+
+    # called by the sleep server thread when it checked the volume and found the status unchanged
+    def confirm(self, verifiedAt):
+        with self.lock:
+            if verifiedAt > self.verifiedAt:
+                self.verifiedAt = verifiedAt
+                self.notifySubscribers(False)
+
+    # the subscriber is called with the current status right away and then after every change or newer check; it's
+    # called with the lock held, in order, so it must only hand the status on (e.g. put it in a queue)
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.append(subscriber)
+            if self.snapshot is not None:
+                subscriber(self.version, self.snapshot, self.deadline, self.verifiedAt, True)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    # expects the lock to be held
+    def notifySubscribers(self, changed):
+        for subscriber in self.subscribers:
+            subscriber(self.version, self.snapshot, self.deadline, self.verifiedAt, changed)
+
+    def current(self):
+        with self.lock:
+            return self.version, self.snapshot
+
+    # (version, snapshot, verifiedAt) with the remaining timer seconds counted down to now
+    def liveStatus(self):
+        with self.lock:
+            return self.version, self.liveSnapshot(), self.verifiedAt
+
+    # expects the lock to be held
+    def liveSnapshot(self):
+        if self.snapshot is None or self.deadline is None:
+            return self.snapshot
+        snapshot = dict(self.snapshot)
+        for key in TIME_LEFT_KEYS:
+            if key in snapshot:
+                snapshot[key] = max(0, math.ceil(self.deadline - self.clock.monotonic()))
+        return snapshot
+
+    # coroutine; returns (version, snapshot, changed) as soon as the version is newer than sinceVersion or, with
+    # changed being False, after the timeout
+    async def waitForChange(self, sinceVersion, timeout):
+        import asyncio # only the asyncio engine waits; the threaded one shouldn't pay for importing it
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.version > sinceVersion:
+                return self.version, self.liveSnapshot(), True
+            waiter = loop.create_future()
+            self.waiters.append((loop, waiter))
+
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                if (loop, waiter) in self.waiters:
+                    self.waiters.remove((loop, waiter))
+
+        version, snapshot, verifiedAt = self.liveStatus()
+        return version, snapshot, version > sinceVersion
+
+    # the same for a thread, which blocks until then
+    def waitForChangeBlocking(self, sinceVersion, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version > sinceVersion, timeout)
+            return self.version, self.liveSnapshot(), self.version > sinceVersion
+
+
+def wakeWaiter(waiter):
+    if not waiter.done():
+        waiter.set_result(True)
@@ -0,0 +1,80 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+from time import monotonic
+from profiling import profiledCall
+
+# defining constants
+ABORT_GRACE_PERIOD = 0.25 # seconds after the timeout; a forking command ends itself first and is never aborted
+
+class SystemCommandPool:
+    """
+    A few worker threads for the system commands (mixer reads and writes, sleep, shutdown), so a hung process only
+    blocks a worker and never the sleep server's control thread. Every command gets a Future; queued ones can be
+    cancelled through it.
+    Forking commands enforce the timeout themselves (subprocess timeout). Commands talking to a long-lived process
+    (mixer sessions) run with a deadline instead: a watchdog thread calls their abort callable (e.g. kills the
+    session) shortly after the timeout, which makes the stuck call fail and frees the worker.
+    Without workers, commands run inline in the caller and without deadline (the simulation needs its mixer writes in
+    order).
+    """
+
+    def __init__(self, workers, timeout, metrics = None):
+        # define members:
+        self.timeout = timeout # seconds a single command may take
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers = workers) if workers > 0 else None
+        self.condition = Condition()
+        self.deadlines = {} # running command -> (deadline, call name, abort callable)
+        self.watchdog = None
+
+    def submit(self, function, *arguments):
+        if self.executor is not None:
+            return self.executor.submit(profiledCall, function, *arguments)
+
+        future = Future()
+        try:
+            future.set_result(function(*arguments))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    # runs the function on the calling worker; if it takes longer than the timeout, abort is called from the watchdog
+    def runWithDeadline(self, call, abort, function, *arguments):
+        if self.executor is None:
+            return function(*arguments)
+        token = object()
+        with self.condition:
+            self.deadlines[token] = (monotonic() + self.timeout + ABORT_GRACE_PERIOD, call, abort)
+            if self.watchdog is None:
+                self.watchdog = Thread(target = self.watchDeadlines)
+                self.watchdog.daemon = True
+                self.watchdog.start()
+            self.condition.notify()
+        try:
+            return function(*arguments)
+        finally:
+            with self.condition:
+                self.deadlines.pop(token, None)
+
+    def watchDeadlines(self):
+        with self.condition:
+            while True:
+                now = monotonic()
+                for token, (deadline, call, abort) in list(self.deadlines.items()):
+                    if deadline <= now:
+                        del self.deadlines[token]
+                        if self.metrics is not None:
+                            self.metrics.increment('system_call_timeouts_total', (('call', call),))
+                        abort()
+
+                waitTime = None
+                if self.deadlines:
+                    waitTime = min(deadline for deadline, call, abort in self.deadlines.values()) - now
+                self.condition.wait(waitTime)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
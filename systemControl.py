@@ -2,47 +2,129 @@
 # -*- coding: utf-8 -*-
 
 import subprocess
-import platform
-import re
+import sys
+from threading import Thread, Lock
+from time import monotonic, perf_counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from systemCommandPool import SystemCommandPool
+from audioBackends import PulseAudioBackend, PulseAudioSessionBackend, OsascriptBackend, OsascriptSessionBackend, UnsupportedAudioBackend, FakeAudioBackend
+from audioBackends import MASTER_TARGET, parseVolumeTargets
 
 # defining constants
 UNSUPPORTED_PLATFORM = 'notSupported'
 MAC_OS_X = 'Darwin'
 LINUX = 'Linux'
+SESSION_BACKEND = 'session'
+SUBPROCESS_BACKEND = 'subprocess'
+FAKE_BACKEND = 'fake'
+SYSTEM_COMMAND_WORKERS = 3 # a volume write, a volume read and a sleep / shutdown command may run at the same time
+DEFAULT_COMMAND_TIMEOUT = 5 # seconds
+
 
 class SystemControl:
-    def __init__(self, beVerbose):
+    """
+    Every system interaction of the sleep server. The commands run on a small worker pool with a timeout each, so the
+    calling control thread never waits on a hung process: volume writes and sleep / shutdown return a Future right
+    away, a volume read is waited for at most the command timeout. Volume writes are coalesced; while one is written,
+    only the latest requested volume waits, the ones it supersedes are dropped.
+    The volume belongs to the volume targets: the master volume by default, or a set of sinks and application streams
+    (see audioBackends). The volume of several targets is the loudest of them; writes scale them all and keep the
+    balance between them that the last read found.
+    """
+
+    def __init__(self, beVerbose, volumeCacheTTL = 0, watchMixerEvents = False, audioBackendName = SESSION_BACKEND, metrics = None,
+                 commandTimeout = DEFAULT_COMMAND_TIMEOUT, commandWorkers = SYSTEM_COMMAND_WORKERS):
         # define members:
         self.beVerbose = beVerbose
+        self.metrics = metrics
+        self.commandTimeout = commandTimeout
+        self.commandPool = SystemCommandPool(commandWorkers, commandTimeout, metrics)
+        self.volumeCacheTTL = volumeCacheTTL # seconds a read volume is trusted; 0 disables the cache
+        self.cachedVolume = None
+        self.cachedVolumeTime = None
+        self.volumeCacheGeneration = 0 # bumped on every invalidation, so a read that raced with a change isn't cached
+        self.lastKnownVolume = 0 # answered when the mixer doesn't; 0 until it answered once
+        self.volumeReader = None # Future of the latest volume read
+
+        self.volumeWriteLock = Lock()
+        self.requestedVolume = None # latest volume given to setVolume
+        self.pendingVolume = None # volume waiting to be written; None if the writer has nothing left to do
+        self.volumeWriter = None # Future of the running volume writer
+        self.volumeWriterRunning = False
+        self.volumeTargets = [MASTER_TARGET] # replaced as a whole under the volume write lock
+        self.targetBalance = {} # target -> its share of the loudest target's volume at the last read
+        self.targetVolumes = {} # target -> volume at the last read
 
-        # define OS identification for OS dependent sleep / volume commands:
-        if MAC_OS_X in platform.platform():
+        # define OS identification for OS dependent sleep / volume commands (sys.platform is known without asking the
+        # system, unlike platform.platform()):
+        if sys.platform == 'darwin':
             self.currentOSIdentifier = MAC_OS_X
-        elif LINUX in platform.platform():
+        elif sys.platform.startswith('linux'):
             self.currentOSIdentifier = LINUX
         else:
             self.currentOSIdentifier = UNSUPPORTED_PLATFORM
 
+        self.audioBackend = self.createAudioBackend(audioBackendName)
+        self.audioBackend.timeout = commandTimeout
+
+        if watchMixerEvents:
+            self.startMixerWatch()
+
+    # the OS identification picks the backend; session backends keep one process alive instead of forking per call
+    def createAudioBackend(self, audioBackendName):
+        if audioBackendName == FAKE_BACKEND:
+            return FakeAudioBackend()
+        elif self.currentOSIdentifier == MAC_OS_X:
+            if audioBackendName == SUBPROCESS_BACKEND:
+                return OsascriptBackend()
+            return OsascriptSessionBackend(self.beVerbose)
+        elif self.currentOSIdentifier == LINUX:
+            if audioBackendName == SUBPROCESS_BACKEND:
+                return PulseAudioBackend()
+            return PulseAudioSessionBackend(self.beVerbose)
+        return UnsupportedAudioBackend()
+
+    # returns the Future of the command; it runs after the volume writes requested before it, so a timer's last
+    # fade step reaches the mixer before the system sleeps
     def setSleep(self):
         if self.beVerbose: print('Sleep now. Good night!')
 
         if self.currentOSIdentifier == MAC_OS_X:
-            subprocess.call(['osascript', '-e', 'tell application "System Events" to sleep'])
+            return self.submitPowerCommand('setSleep', ['osascript', '-e', 'tell application "System Events" to sleep'])
         elif self.currentOSIdentifier == LINUX:
-            subprocess.call('dbus-send --system --print-reply --dest=org.freedesktop.UPower /org/freedesktop/UPower org.freedesktop.UPower.Suspend', shell = True)
+            return self.submitPowerCommand('setSleep', ['dbus-send', '--system', '--print-reply', '--dest=org.freedesktop.UPower', '/org/freedesktop/UPower', 'org.freedesktop.UPower.Suspend'])
         elif self.currentOSIdentifier == UNSUPPORTED_PLATFORM:
             print('sleep for this platform not yet implemented!')
+        return completedFuture(None)
 
     def setShutdown(self):
         if self.beVerbose: print('Shutdown now. Good night!')
         
         if self.currentOSIdentifier == MAC_OS_X:
-            subprocess.call(['osascript', '-e', 'tell application "System Events" to shut down'])
+            return self.submitPowerCommand('setShutdown', ['osascript', '-e', 'tell application "System Events" to shut down'])
         elif self.currentOSIdentifier == LINUX:
-            subprocess.call('dbus-send --system --print-reply --dest=org.freedesktop.ConsoleKit /org/freedesktop/ConsoleKit/Manager org.freedesktop.ConsoleKit.Manager.Stop', shell = True)
+            return self.submitPowerCommand('setShutdown', ['dbus-send', '--system', '--print-reply', '--dest=org.freedesktop.ConsoleKit', '/org/freedesktop/ConsoleKit/Manager', 'org.freedesktop.ConsoleKit.Manager.Stop'])
         elif self.currentOSIdentifier == UNSUPPORTED_PLATFORM:
             print('shutdown for this platform not yet implemented!')
+        return completedFuture(None)
+
+    def submitPowerCommand(self, call, command):
+        with self.volumeWriteLock:
+            volumeWriter = self.volumeWriter if self.volumeWriterRunning else None
+        return self.commandPool.submit(self.runPowerCommand, call, command, volumeWriter)
+
+    def runPowerCommand(self, call, command, volumeWriter):
+        if volumeWriter is not None:
+            try:
+                volumeWriter.result(timeout = self.commandTimeout)
+            except Exception:
+                pass
+        try:
+            return self.timedSystemCall(call, subprocess.call, command, timeout = self.commandTimeout, checkExitCode = True)
+        except (OSError, subprocess.SubprocessError) as error:
+            print('SystemControl:', call, 'failed:', error)
 
+    # returns the Future of the volume writer that will write this volume (or a later one that supersedes it)
     def setVolume(self, percent):
         if percent > 100:
             if self.beVerbose: print('setting the volume to', str(percent), 'is not possible; cutting it at 100%')
@@ -51,25 +133,193 @@ class SystemControl:
             if self.beVerbose: print('setting the volume to', str(percent), 'is not possible; settint it to 0%')
             percent = 0
 
-        if self.currentOSIdentifier == MAC_OS_X:
-            targetVolume = (7 * percent) / 100
-            subprocess.call(['osascript', '-e', 'Set volume ' + str(targetVolume)])
-        if self.currentOSIdentifier == LINUX:
-            subprocess.call('amixer -D pulse sset Master ' + str(percent) + '%', shell = True)
-        elif self.currentOSIdentifier == UNSUPPORTED_PLATFORM:
-            print('setting the volume for this platform not yet implemented!')
+        with self.volumeWriteLock:
+            if self.pendingVolume is not None and self.metrics is not None:
+                self.metrics.increment('system_volume_writes_dropped_total')
+            self.requestedVolume = percent
+            self.pendingVolume = percent
+            self.targetVolumes = {target: round(percent * self.targetBalance.get(target, 1), 2) for target in self.targetVolumes}
+            startWriter = not self.volumeWriterRunning
+            self.volumeWriterRunning = True
+        # setVolume is only called by the control thread; submitted outside the lock, an inline pool writes right away
+        if startWriter:
+            self.volumeWriter = self.commandPool.submit(self.writePendingVolumes)
+        volumeWriter = self.volumeWriter
 
+        # write through; the mixer may round the value, the next read after the TTL corrects that
+        self.invalidateVolumeCache()
+        self.storeCachedVolume(percent, self.volumeCacheGeneration)
+        self.lastKnownVolume = percent
+        return volumeWriter
+
+    # runs on a worker until no volume is pending; a volume requested during a write replaces any not yet written
+    def writePendingVolumes(self):
+        while True:
+            with self.volumeWriteLock:
+                percent = self.pendingVolume
+                self.pendingVolume = None
+                if percent is None:
+                    self.volumeWriterRunning = False
+                    return
+            try:
+                self.commandPool.runWithDeadline('setVolume', self.audioBackend.abort, self.timedSystemCall, 'setVolume', self.writeVolume, percent)
+            except Exception as error:
+                print('SystemControl: writing the volume failed:', error)
+
+    # one backend operation for all targets
+    def writeVolume(self, percent):
+        with self.volumeWriteLock:
+            targets, balance = self.volumeTargets, self.targetBalance
+        if targets == [MASTER_TARGET]:
+            self.audioBackend.setVolume(percent)
+        else:
+            self.audioBackend.setVolumes({target: percent * balance.get(target, 1) for target in targets})
+
+    # a read is waited for at most the command timeout; a mixer that doesn't answer in time (or whose last read still
+    # hangs) gets the last known volume, a volume that is about to be written is answered without asking the mixer
     def getVolume(self):
-        if self.currentOSIdentifier == MAC_OS_X:
-            volume = subprocess.check_output(['osascript', '-e', 'get volume settings'])
-            volume = re.search('([0-9]+)', str(volume))
-            volume = volume.group(1)
-            return int(volume)
-        elif self.currentOSIdentifier == LINUX:
-            volume = subprocess.check_output('amixer -D pulse get Master', shell = True)
-            volume = re.search('([0-9]+)%', str(volume))
-            volume = volume.group(1)
-            return int(volume)
-        elif self.currentOSIdentifier == UNSUPPORTED_PLATFORM:
-            print('setting the volume for this platform not yet implemented!')
-            return 100
+        if self.isVolumeCacheValid():
+            return self.cachedVolume
+        with self.volumeWriteLock:
+            if self.volumeWriterRunning:
+                return self.requestedVolume
+        if self.volumeReader is not None and not self.volumeReader.done():
+            return self.lastKnownVolume
+
+        generation = self.volumeCacheGeneration
+        self.volumeReader = self.commandPool.submit(self.readVolume)
+        try:
+            volume = self.volumeReader.result(timeout = self.commandTimeout)
+        except FutureTimeoutError:
+            print('SystemControl: the mixer didn\'t answer within', self.commandTimeout, 'seconds; using the last known volume')
+            return self.lastKnownVolume
+        except Exception as error:
+            print('SystemControl: reading the volume failed:', error)
+            return self.lastKnownVolume
+
+        self.storeCachedVolume(volume, generation)
+        self.lastKnownVolume = volume
+        return volume
+
+    def isVolumeCacheValid(self):
+        return (self.cachedVolumeTime is not None and
+                monotonic() - self.cachedVolumeTime < self.volumeCacheTTL)
+
+    def storeCachedVolume(self, volume, generation):
+        if self.volumeCacheTTL > 0 and generation == self.volumeCacheGeneration:
+            self.cachedVolume = volume
+            self.cachedVolumeTime = monotonic()
+
+    def invalidateVolumeCache(self):
+        self.volumeCacheGeneration += 1
+        self.cachedVolumeTime = None
+
+    # invalidate the cached volume whenever the mixer reports a change (e.g. volume keys or another application);
+    # only PulseAudio offers such events, on other platforms the cache relies on its TTL
+    def startMixerWatch(self):
+        if self.currentOSIdentifier != LINUX:
+            if self.beVerbose: print('SystemControl: mixer events not supported on this platform; using the cache TTL only')
+            return
+
+        try:
+            watcher = subprocess.Popen(['pactl', 'subscribe'], stdout = subprocess.PIPE, universal_newlines = True)
+        except OSError:
+            if self.beVerbose: print('SystemControl: can\'t start pactl subscribe; using the cache TTL only')
+            return
+
+        watchThread = Thread(target = self.watchMixerEvents, args = (watcher,))
+        watchThread.daemon = True
+        watchThread.start()
+
+    def watchMixerEvents(self, watcher):
+        for line in watcher.stdout:
+            if "'change'" in line and 'sink' in line:
+                self.invalidateVolumeCache()
+
+        # pactl exited (e.g. the sound server restarted); fall back to the TTL
+        if self.beVerbose: print('SystemControl: mixer event watch ended')
+        self.invalidateVolumeCache()
+
+    def readVolume(self):
+        return self.commandPool.runWithDeadline('getVolume', self.audioBackend.abort, self.timedSystemCall, 'getVolume', self.readTargetVolumes)
+
+    # one backend operation for all targets; targets that don't exist right now (an application that isn't playing)
+    # don't count, if none exists the last known volume stands
+    def readTargetVolumes(self):
+        with self.volumeWriteLock:
+            targets = self.volumeTargets
+        if targets == [MASTER_TARGET]:
+            return self.audioBackend.getVolume()
+
+        volumes = self.audioBackend.getVolumes(targets)
+        if not volumes:
+            return self.lastKnownVolume
+        volume = max(volumes.values())
+        with self.volumeWriteLock:
+            if targets is self.volumeTargets:
+                self.targetVolumes = volumes
+                if volume > 0:
+                    self.targetBalance = {target: targetVolume / volume for target, targetVolume in volumes.items()}
+        return round(volume, 2)
+
+    # called by the control thread; raises ValueError for malformed targets or ones the audio backend can't control
+    def setVolumeTargets(self, targets):
+        targets = parseVolumeTargets(targets)
+        if targets != [MASTER_TARGET] and not self.audioBackend.supportsTargets:
+            raise ValueError('sinks and application streams need PulseAudio (Linux)')
+        with self.volumeWriteLock:
+            self.volumeTargets = targets
+            self.targetBalance = {}
+            self.targetVolumes = {}
+        self.invalidateVolumeCache()
+
+    # {target: volume at the last read or None if it wasn't found}
+    def getTargetVolumes(self):
+        with self.volumeWriteLock:
+            if self.volumeTargets == [MASTER_TARGET]:
+                return {MASTER_TARGET: self.lastKnownVolume}
+            return {target: self.targetVolumes.get(target) for target in self.volumeTargets}
+
+    # run a system interaction and record its duration and failure (an exception or, for commands, an exit code)
+    def timedSystemCall(self, call, function, *arguments, checkExitCode = False, **keywordArguments):
+        startTime = perf_counter()
+        failed = True
+        try:
+            result = function(*arguments, **keywordArguments)
+            failed = checkExitCode and result != 0
+            return result
+        except subprocess.TimeoutExpired:
+            if self.metrics is not None:
+                self.metrics.increment('system_call_timeouts_total', (('call', call),))
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observeSystemCall(call, perf_counter() - startTime, failed)
+
+
+def completedFuture(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class FakeSystemControl(SystemControl):
+    """
+    System control without side effects for tests and benchmarks: an in-memory mixer, sleep and shutdown are only
+    recorded in powerEvents.
+    """
+
+    def __init__(self, beVerbose, volumeCacheTTL = 0, watchMixerEvents = False, audioBackendName = FAKE_BACKEND, metrics = None,
+                 commandTimeout = DEFAULT_COMMAND_TIMEOUT, commandWorkers = SYSTEM_COMMAND_WORKERS):
+        SystemControl.__init__(self, beVerbose, volumeCacheTTL, False, FAKE_BACKEND, metrics, commandTimeout, commandWorkers)
+        self.powerEvents = []
+
+    def setSleep(self):
+        if self.beVerbose: print('Sleep now (fake). Good night!')
+        self.powerEvents.append('sleep')
+        return completedFuture(None)
+
+    def setShutdown(self):
+        if self.beVerbose: print('Shutdown now (fake). Good night!')
+        self.powerEvents.append('shutdown')
+        return completedFuture(None)
@@ -0,0 +1,58 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# defining constants
+LISTEN_BACKLOG = 128 # connections the kernel queues until they are accepted; beyond it a client waits for a SYN retransmit (1 s)
+
+class SleepHTTPServer(ThreadingHTTPServer):
+    # socketserver listens with a backlog of 5, too short for a burst of new connections
+    request_queue_size = LISTEN_BACKLOG
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the threaded network engine; the network manager answers the requests.
+    """
+
+    # persistent connections; an idle connection is closed after the read timeout. Head and body are written
+    # separately, without TCP_NODELAY the body would wait for the client's delayed ACK of the head
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    maxBodySize = 0
+    beVerbose = False
+
+    def setSleepServer(self, networkManager):
+        self.networkManager = networkManager
+
+    def do_GET(self):
+        self.answer(*self.networkManager.handleApiRequest(self.path, self.headers.get('If-None-Match'), 'GET', b'', self.client_address[0], self.headers.get('Authorization')))
+
+    def do_DELETE(self):
+        self.answer(*self.networkManager.handleApiRequest(self.path, self.headers.get('If-None-Match'), 'DELETE', b'', self.client_address[0], self.headers.get('Authorization')))
+
+    def do_POST(self):
+        contentLength = self.headers.get('Content-Length', '')
+        if not contentLength.isdigit():
+            self.close_connection = True
+            self.answer(411, 'text/plain', b'length required', {})
+        elif int(contentLength) > self.maxBodySize:
+            self.close_connection = True
+            self.answer(413, 'text/plain', b'request body too large', {})
+        else:
+            body = self.rfile.read(int(contentLength))
+            self.answer(*self.networkManager.handleApiRequest(self.path, self.headers.get('If-None-Match'), 'POST', body, self.client_address[0], self.headers.get('Authorization')))
+
+    def answer(self, responseCode, contentType, message, responseHeaders):
+        self.send_response(responseCode)
+        self.send_header('Content-type', contentType)
+        self.send_header('Content-Length', str(len(message)))
+        for name, value in responseHeaders.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        try:
+            self.wfile.write(message)
+        except BrokenPipeError:
+            if self.beVerbose: print('NetworkManager: current connection failed (broken pipe)')
+        return
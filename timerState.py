@@ -0,0 +1,95 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+# defining constants
+STATE_DIRECTORY_NAME = 'sleepServer'
+NO_FOLLOW = getattr(os, 'O_NOFOLLOW', 0) # not available on Windows
+
+# the state file of the server on the port in a directory only the user running the server can access:
+# $XDG_STATE_HOME/sleepServer or ~/.local/state/sleepServer, created with mode 0700
+def defaultStatePath(port):
+    stateHome = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    directory = os.path.join(stateHome, STATE_DIRECTORY_NAME)
+    os.makedirs(directory, mode = 0o700, exist_ok = True)
+    return os.path.join(directory, 'state-' + str(port) + '.json')
+
+
+class TimerStateFile:
+    """
+    The running timer of the sleep server on disk, so a restarted server can pick it up.
+    The state is a small dictionary (absolute deadline, ramp parameters) stored as compact JSON. It is written to a
+    temporary file, synced and renamed over the old one, so a crash leaves either the old or the new state behind.
+    Writes only happen when the encoded state differs from the one on disk; the countdown itself never causes one.
+    The temporary file is created exclusively with mode 0600 and symlinks are never followed, and a state file owned
+    by another user is ignored, so nobody else can plant a timer or redirect the write.
+    """
+
+    def __init__(self, path):
+        # define members:
+        self.path = path
+        self.temporaryPath = path + '.tmp'
+        self.lastWritten = None # encoded state on disk; None if there is no state file
+
+    # stores the state or, for None, removes the state file; returns whether the disk was touched
+    def save(self, state):
+        encodedState = None if state is None else json.dumps(state, separators = (',', ':'), sort_keys = True).encode('UTF-8')
+        if encodedState == self.lastWritten:
+            return False
+
+        if encodedState is None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        else:
+            with os.fdopen(self.createTemporaryFile(), 'wb') as stateFile:
+                stateFile.write(encodedState)
+                stateFile.flush()
+                os.fsync(stateFile.fileno())
+            os.replace(self.temporaryPath, self.path)
+            self.syncDirectory()
+
+        self.lastWritten = encodedState
+        return True
+
+    # a temporary file left by a crash (or anything else at its path) is removed, never written through
+    def createTemporaryFile(self):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | NO_FOLLOW
+        try:
+            return os.open(self.temporaryPath, flags, 0o600)
+        except FileExistsError:
+            os.remove(self.temporaryPath)
+            return os.open(self.temporaryPath, flags, 0o600)
+
+    # the stored state or None if there is none (or it can't be read or belongs to another user)
+    def load(self):
+        try:
+            with os.fdopen(os.open(self.path, os.O_RDONLY | NO_FOLLOW), 'rb') as stateFile:
+                if hasattr(os, 'getuid') and os.fstat(stateFile.fileno()).st_uid != os.getuid():
+                    print('TimerStateFile: ignoring', self.path, '(owned by another user)')
+                    return None
+                encodedState = stateFile.read()
+            state = json.loads(encodedState.decode('UTF-8'))
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(state, dict):
+            return None
+        self.lastWritten = encodedState
+        return state
+
+    # makes the rename itself durable
+    def syncDirectory(self):
+        try:
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
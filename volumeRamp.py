@@ -0,0 +1,95 @@
+#!/usr/local/bin/python3.4
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+import math
+
+# defining constants
+LINEAR_CURVE = 'linear'
+LOGARITHMIC_CURVE = 'logarithmic'
+EXPONENTIAL_CURVE = 'exponential'
+FADE_CURVES = [LINEAR_CURVE, LOGARITHMIC_CURVE, EXPONENTIAL_CURVE]
+DYNAMIC_RANGE = 3 # decades (60 dB) covered by the logarithmic and exponential curves
+
+# share of the start volume left at fadeProgress (1 at the start of the fade, 0 at its end)
+def curveFactor(curve, fadeProgress):
+    if curve == LOGARITHMIC_CURVE:
+        # falls linearly in dB, which sounds like an even fade: drops quickly at first, then gently
+        return (10 ** (DYNAMIC_RANGE * fadeProgress) - 1) / (10 ** DYNAMIC_RANGE - 1)
+    elif curve == EXPONENTIAL_CURVE:
+        # mirror of the logarithmic curve: stays loud for long and drops towards the end
+        return 1 - (10 ** (DYNAMIC_RANGE * (1 - fadeProgress)) - 1) / (10 ** DYNAMIC_RANGE - 1)
+    return fadeProgress
+
+# fadeProgress at which curveFactor reaches factor (0 to 1)
+def inverseCurveFactor(curve, factor):
+    if curve == LOGARITHMIC_CURVE:
+        return math.log10(factor * (10 ** DYNAMIC_RANGE - 1) + 1) / DYNAMIC_RANGE
+    elif curve == EXPONENTIAL_CURVE:
+        return 1 - math.log10((1 - factor) * (10 ** DYNAMIC_RANGE - 1) + 1) / DYNAMIC_RANGE
+    return factor
+
+class VolumeRamp:
+    """
+    Precomputed volume fade towards silence at the end of a timer.
+    The schedule holds only the seconds (counted backwards to the timer deadline) at which the volume crosses a mixer
+    step, so a slow fade writes the mixer once per step instead of once per second.
+    """
+
+    def __init__(self, startVolume, fadeTime, curve = LINEAR_CURVE, volumeStep = 1):
+        # define members:
+        self.startVolume = startVolume
+        self.fadeTime = fadeTime
+        self.curve = curve
+        self.volumeStep = volumeStep
+
+        # schedule in ascending order of the remaining seconds; the volume at index i applies from secondsLeft[i] on
+        self.secondsLeft = []
+        self.volumes = []
+        self.precompute()
+
+    def quantize(self, volume):
+        return round(volume / self.volumeStep) * self.volumeStep
+
+    # the mixer volume at a whole second of the fade
+    def volumeAtSecond(self, second):
+        return self.quantize(self.startVolume * curveFactor(self.curve, second / self.fadeTime))
+
+    # one inversion of the curve per mixer step instead of one evaluation per second, so the cost doesn't grow with
+    # the fade time: the last second at which the volume is at or below each step, corrected to whole seconds by
+    # evaluating the curve next to it. Steps passed within the same second end up in one entry
+    def precompute(self):
+        changes = {}
+        numberOfLevels = int(round(self.quantize(self.startVolume) / self.volumeStep))
+        for level in range(numberOfLevels - 1, -1, -1):
+            volume = level * self.volumeStep
+            factor = min(1, (volume + self.volumeStep / 2) / self.startVolume)
+            second = min(self.fadeTime, max(0, int(self.fadeTime * inverseCurveFactor(self.curve, factor))))
+            while second < self.fadeTime and self.volumeAtSecond(second + 1) <= volume:
+                second += 1
+            while second > 0 and self.volumeAtSecond(second) > volume:
+                second -= 1
+            changes[second] = self.volumeAtSecond(second)
+
+        self.secondsLeft = sorted(changes)
+        self.volumes = [changes[second] for second in self.secondsLeft]
+
+    def isFading(self, secondsLeft):
+        return secondsLeft <= self.fadeTime
+
+    # the volume the mixer should have with secondsLeft until the deadline
+    def volumeAt(self, secondsLeft):
+        index = bisect_left(self.secondsLeft, secondsLeft)
+        if index == len(self.secondsLeft):
+            return self.quantize(self.startVolume)
+        return self.volumes[index]
+
+    # the remaining seconds of the next volume change after secondsLeft or None if the fade is done
+    def nextChange(self, secondsLeft):
+        index = bisect_left(self.secondsLeft, secondsLeft) - 1
+        if index < 0:
+            return None
+        return self.secondsLeft[index]
+
+    def numberOfSteps(self):
+        return len(self.secondsLeft)